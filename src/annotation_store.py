@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import argparse
+import threading
+
+import numpy as np
+
+# Columnar store of the box annotations of many frames: one raw binary file per column,
+# memory-mappable, plus the end offset of every frame's boxes. meta.json holds the counts
+# that are committed; anything appended past them (a crash mid-write) is cut off on open.
+
+COLUMNS = {
+    "class_id": (np.int16, ()),     # Index into meta["classes"]
+    "inst_id": (np.int32, ()),      # Instance id of the object in the rendered frame
+    "bbox": (np.float32, (4,)),     # x_center, y_center, width, height, normalized (YOLO)
+    "pixels": (np.int32, ()),       # Visible pixel count
+}
+FRAME_ENDS = "frame_ends"           # int64 end offset of each frame's boxes
+FRAME_NAMES = "frames.txt"          # "<folder>/<frame name>" per line
+
+
+
+# === WRITING ===
+
+def read_meta(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        return json.load(f)
+
+def write_meta(path, meta):
+    # Replace in one step: the meta file is the commit record of the store
+    tmp_path = os.path.join(path, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+def column_path(path, name):
+    return os.path.join(path, f"{name}.bin")
+
+class AnnotationStoreWriter:
+    '''
+    Append frames to a store, skipping frames that are already in it. With extend_classes
+    an existing store takes classes it doesn't have yet at the end of its list instead of
+    refusing a different one (callers then remap their class ids with class_map).
+    '''
+    def __init__(self, path, classes, width, height, extend_classes=False):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self.meta = read_meta(path)
+            if extend_classes:
+                self.meta["classes"] += [c for c in classes if c not in self.meta["classes"]]
+            elif self.meta["classes"] != list(classes):
+                raise ValueError(f"{path} was written with classes {self.meta['classes']}, not {list(classes)}")
+        else:
+            self.meta = {"classes": list(classes), "width": width, "height": height, "num_frames": 0, "num_boxes": 0,
+                         "columns": {name: [np.dtype(dtype).str, list(shape)] for name, (dtype, shape) in COLUMNS.items()}}
+            write_meta(path, self.meta)
+
+        self._truncate_to_committed()
+
+        with open(os.path.join(path, FRAME_NAMES)) as f:
+            self.names = set(f.read().splitlines())
+
+        self.files = {name: open(column_path(path, name), "ab") for name in list(COLUMNS) + [FRAME_ENDS]}
+        self.names_file = open(os.path.join(path, FRAME_NAMES), "a")
+
+    def class_map(self, classes):
+        '''
+        Class ids of the store for the ids of another class list.
+        '''
+        return np.array([self.meta["classes"].index(c) for c in classes], dtype=COLUMNS["class_id"][0])
+
+    def _truncate_to_committed(self):
+        '''
+        Drop rows appended after the last commit.
+        '''
+        num_frames, num_boxes = self.meta["num_frames"], self.meta["num_boxes"]
+
+        for name, (dtype, shape) in COLUMNS.items():
+            size = num_boxes * np.dtype(dtype).itemsize * int(np.prod(shape))
+            with open(column_path(self.path, name), "ab") as f:
+                f.truncate(size)
+
+        with open(column_path(self.path, FRAME_ENDS), "ab") as f:
+            f.truncate(num_frames * 8)
+
+        names_path = os.path.join(self.path, FRAME_NAMES)
+        open(names_path, "a").close()
+        with open(names_path, "rb+") as f:
+            lines = f.read().split(b"\n")[:num_frames]
+            f.seek(0)
+            f.truncate()
+            f.write(b"".join(line + b"\n" for line in lines))
+
+    def add(self, frame, annotations, commit=True):
+        '''
+        Append one frame; annotations is a list of dicts with the COLUMNS as keys.
+        Returns False if the frame is already in the store.
+        '''
+        with self.lock:
+            if frame in self.names:
+                return False
+
+            for name, (dtype, shape) in COLUMNS.items():
+                column = np.array([a[name] for a in annotations], dtype=dtype).reshape((len(annotations),) + shape)
+                self.files[name].write(column.tobytes())
+
+            self.meta["num_boxes"] += len(annotations)
+            self.meta["num_frames"] += 1
+            self.files[FRAME_ENDS].write(np.int64(self.meta["num_boxes"]).tobytes())
+            self.names_file.write(f"{frame}\n")
+            self.names.add(frame)
+
+            if commit:
+                self._commit()
+            return True
+
+    def add_columns(self, frames, ends, columns):
+        '''
+        Append many frames at once from column arrays (used to merge and filter stores).
+        '''
+        with self.lock:
+            start = 0
+            for frame, end in zip(frames, ends):
+                if frame not in self.names:
+                    for name, (dtype, _shape) in COLUMNS.items():
+                        self.files[name].write(np.ascontiguousarray(columns[name][start:end], dtype=dtype).tobytes())
+
+                    self.meta["num_boxes"] += int(end - start)
+                    self.meta["num_frames"] += 1
+                    self.files[FRAME_ENDS].write(np.int64(self.meta["num_boxes"]).tobytes())
+                    self.names_file.write(f"{frame}\n")
+                    self.names.add(frame)
+                start = end
+
+            self._commit()
+
+    def commit(self):
+        '''
+        Make the frames added with commit=False part of the store.
+        '''
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        for f in list(self.files.values()) + [self.names_file]:
+            f.flush()
+            os.fsync(f.fileno())
+        write_meta(self.path, self.meta)
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            for f in list(self.files.values()) + [self.names_file]:
+                f.close()
+
+
+
+# === READING ===
+
+class AnnotationStore:
+    '''
+    Read-only view of a store; the columns are memory-mapped and cut to the committed counts.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        self.classes = self.meta["classes"]
+        self.width, self.height = self.meta["width"], self.meta["height"]
+        self.num_frames, self.num_boxes = self.meta["num_frames"], self.meta["num_boxes"]
+
+        self.columns = {name: self._map(column_path(path, name), dtype, (self.num_boxes,) + shape)
+                        for name, (dtype, shape) in COLUMNS.items()}
+        self.ends = self._map(column_path(path, FRAME_ENDS), np.int64, (self.num_frames,))
+        self.starts = np.concatenate([[0], self.ends[:-1]]).astype(np.int64)
+        self._names = None
+
+    @staticmethod
+    def _map(path, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+    @property
+    def names(self):
+        if self._names is None:
+            with open(os.path.join(self.path, FRAME_NAMES)) as f:
+                self._names = f.read().splitlines()[:self.num_frames]
+        return self._names
+
+    def frame_index(self):
+        '''
+        Frame index of every box.
+        '''
+        return np.repeat(np.arange(self.num_frames), self.ends - self.starts)
+
+    def iter_frames(self, mask=None, chunk_size=100000):
+        '''
+        Yield (frame name, {column : rows}) frame by frame, reading the columns in chunks of
+        frames so only one chunk is in memory. mask optionally selects boxes.
+        '''
+        names = self.names
+        for first in range(0, self.num_frames, chunk_size):
+            last = min(first + chunk_size, self.num_frames)
+            lo, hi = self.starts[first], self.ends[last - 1]
+            chunk = {name: np.asarray(column[lo:hi]) for name, column in self.columns.items()}
+            keep = None if mask is None else np.asarray(mask[lo:hi])
+
+            for i in range(first, last):
+                s, e = self.starts[i] - lo, self.ends[i] - lo
+                if keep is None:
+                    yield names[i], {name: column[s:e] for name, column in chunk.items()}
+                else:
+                    k = keep[s:e]
+                    yield names[i], {name: column[s:e][k] for name, column in chunk.items()}
+
+    def select(self, classes=None, min_pixels=0, min_area=0.0):
+        '''
+        Boolean mask of the boxes of the given class names with at least min_pixels visible
+        pixels and at least min_area of the image.
+        '''
+        mask = np.asarray(self.columns["pixels"]) >= min_pixels
+
+        if min_area > 0:
+            bbox = np.asarray(self.columns["bbox"])
+            mask &= bbox[:, 2] * bbox[:, 3] >= min_area
+
+        if classes is not None:
+            wanted = [self.classes.index(c) for c in classes]
+            mask &= np.isin(np.asarray(self.columns["class_id"]), wanted)
+
+        return mask
+
+    def stats(self, mask=None):
+        class_id = np.asarray(self.columns["class_id"])
+        pixels = np.asarray(self.columns["pixels"])
+        bbox = np.asarray(self.columns["bbox"])
+        frames = self.frame_index()
+
+        if mask is not None:
+            class_id, pixels, bbox, frames = class_id[mask], pixels[mask], bbox[mask], frames[mask]
+
+        counts = np.bincount(class_id, minlength=len(self.classes))
+        area = bbox[:, 2] * bbox[:, 3]
+        area_sum = np.bincount(class_id, weights=area, minlength=len(self.classes))
+        boxes_per_frame = np.bincount(frames, minlength=self.num_frames)
+
+        report = {
+            "frames": int(self.num_frames),
+            "boxes": int(class_id.size),
+            "empty_frames": int((boxes_per_frame == 0).sum()),
+            "boxes_per_frame": {"mean": round(float(boxes_per_frame.mean()), 2) if self.num_frames else 0.0,
+                                "max": int(boxes_per_frame.max()) if self.num_frames else 0},
+            "classes": {},
+        }
+
+        for c, name in enumerate(self.classes):
+            in_class = class_id == c
+            report["classes"][name] = {
+                "boxes": int(counts[c]),
+                "frames": int(np.unique(frames[in_class]).size),
+                "mean_area": round(float(area_sum[c] / counts[c]), 5) if counts[c] else 0.0,
+                "median_pixels": int(np.median(pixels[in_class])) if counts[c] else 0,
+            }
+
+        return report
+
+
+
+# === EXPORT ===
+
+def export_yolo(store, output_path, mask=None):
+    '''
+    One YOLO label file per frame (class names as labels, like generate_data.py writes them).
+    '''
+    for frame, rows in store.iter_frames(mask):
+        label_path = os.path.join(output_path, f"{frame}.txt")
+        os.makedirs(os.path.dirname(label_path), exist_ok=True)
+
+        with open(label_path, "w") as f:
+            for class_id, (x_center, y_center, width, height) in zip(rows["class_id"], rows["bbox"]):
+                f.write(f"{store.classes[class_id]} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
+
+def export_coco(store, output_file, mask=None, image_format="jpg"):
+    '''
+    COCO detection JSON, written while reading the store so it never holds all boxes.
+    '''
+    with open(output_file, "w") as f:
+        f.write('{"images": [')
+        for i, name in enumerate(store.names):
+            f.write("," if i else "")
+            f.write(json.dumps({"id": i + 1, "file_name": f"{name}.{image_format}",
+                                "width": store.width, "height": store.height}))
+
+        f.write('],\n"annotations": [')
+        annotation_id = 0
+        for i, (_name, rows) in enumerate(store.iter_frames(mask)):
+            for class_id, inst_id, (x_center, y_center, width, height), pixels in zip(
+                    rows["class_id"], rows["inst_id"], rows["bbox"], rows["pixels"]):
+                w, h = float(width) * store.width, float(height) * store.height
+                x, y = float(x_center) * store.width - w / 2, float(y_center) * store.height - h / 2
+
+                f.write("," if annotation_id else "")
+                annotation_id += 1
+                f.write(json.dumps({"id": annotation_id, "image_id": i + 1, "category_id": int(class_id) + 1,
+                                    "bbox": [round(x, 2), round(y, 2), round(w, 2), round(h, 2)],
+                                    "area": round(w * h, 2), "iscrowd": 0,
+                                    "inst_id": int(inst_id), "visible_pixels": int(pixels)}))
+
+        categories = [{"id": c + 1, "name": name} for c, name in enumerate(store.classes)]
+        f.write('],\n"categories": ' + json.dumps(categories) + "}\n")
+
+def copy_store(store, output_path, mask=None):
+    '''
+    Append the (selected) boxes of a store to another one; frames already there are skipped
+    and class ids are remapped to the class list of the output store.
+    '''
+    writer = AnnotationStoreWriter(output_path, store.classes, store.width, store.height, extend_classes=True)
+    columns = {name: np.asarray(column) for name, column in store.columns.items()}
+    ends = store.ends
+
+    # Stores written with the classes in another order (or other classes) are matched by name
+    if writer.meta["classes"] != store.classes:
+        columns["class_id"] = writer.class_map(store.classes)[columns["class_id"]]
+
+    if mask is not None:
+        columns = {name: column[mask] for name, column in columns.items()}
+
+        # Boxes kept before each frame's end
+        kept = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+        ends = kept[store.ends]
+
+    writer.add_columns(store.names, ends, columns)
+    writer.close()
+
+
+
+# === ARGUMENT PARSING ===
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Statistics, filtering and YOLO/COCO export of an annotation store.")
+
+    parser.add_argument("command",
+        help = "stats, yolo, coco, filter or merge.",
+        choices = ["stats", "yolo", "coco", "filter", "merge"])
+
+    parser.add_argument("store",
+        help = "The annotation store folder (merge: the stores to merge, separated by commas).")
+
+    parser.add_argument("--output",
+        help = "Output folder (yolo, filter, merge) or JSON file (coco).",
+        default = None)
+
+    parser.add_argument("--classes",
+        help = "Only keep boxes of these classes, separated by commas.",
+        default = None)
+
+    parser.add_argument("--min_pixels",
+        help = "Only keep boxes with at least this many visible pixels.",
+        default = 0,
+        type = int)
+
+    parser.add_argument("--min_area",
+        help = "Only keep boxes covering at least this fraction of the image.",
+        default = 0.0,
+        type = float)
+
+    parser.add_argument("--image_format",
+        help = "Image extension used in the COCO file names.",
+        default = "jpg")
+
+    return parser.parse_args(argv)
+
+def main(args):
+    if args.command == "merge":
+        for path in args.store.split(","):
+            copy_store(AnnotationStore(path), args.output)
+        print(json.dumps(AnnotationStore(args.output).stats(), indent=2))
+        return 0
+
+    store = AnnotationStore(args.store)
+    classes = args.classes.split(",") if args.classes else None
+    mask = None
+    if classes is not None or args.min_pixels > 0 or args.min_area > 0:
+        mask = store.select(classes, args.min_pixels, args.min_area)
+
+    if args.command == "stats":
+        print(json.dumps(store.stats(mask), indent=2))
+    elif args.command == "yolo":
+        export_yolo(store, args.output, mask)
+    elif args.command == "coco":
+        export_coco(store, args.output, mask, args.image_format)
+    elif args.command == "filter":
+        copy_store(store, args.output, mask if mask is not None else np.ones(store.num_boxes, dtype=bool))
+
+    return 0
+
+
+
+# === ENTRY POINT ===
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(main(args))
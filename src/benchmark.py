@@ -0,0 +1,415 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import struct
+import zlib
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import yaml
+
+# === ADJUSTABLE VARIABLES ===
+
+FIXTURE_PATH = os.path.join(tempfile.gettempdir(), "3d_rp_benchmark") # Fixtures and outputs, rebuilt on every run
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+FIXTURE_CLASSES = ["can", "toy_car", "distractor"] # Must contain the TARGET_CLASSES of generate_data.py
+MODELS_PER_CLASS = 4        # Fixture models generated per class
+NUM_HDRIS = 2               # Fixture backgrounds
+HDRI_WIDTH = 256            # Width of the equirectangular fixture backgrounds
+TEXTURE_SIZE = 64           # Side of the fixture textures
+
+ITERATION = 2               # Backgrounds rendered by the benchmark
+ARRANGEMENT = 2             # Arrangements per background
+NUM_PICS = 2                # Pictures per selected object
+RESOLUTION_X = 160          # Low resolution so the loop overhead is visible next to the render time
+RESOLUTION_Y = 90
+SAMPLES = 4
+
+TOLERANCE = 0.15            # Relative slowdown (or memory growth) reported as a regression
+
+GENERATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_data.py")
+
+
+
+# === FIXTURE ASSETS ===
+
+def box_mesh(size):
+    '''
+    Vertices, uvs and quads of an axis-aligned box centered on the origin.
+    '''
+    sx, sy, sz = np.asarray(size) / 2
+    vertices = [(x, y, z) for x in (-sx, sx) for y in (-sy, sy) for z in (-sz, sz)]
+    uvs = [(0, 0), (1, 0), (1, 1), (0, 1)]
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    return vertices, uvs, [[(v, t) for v, t in zip(face, range(4))] for face in faces]
+
+def cylinder_mesh(radius, height, segments=24):
+    '''
+    Vertices, uvs and faces of a closed cylinder along Z.
+    '''
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    ring = [(radius * np.cos(a), radius * np.sin(a)) for a in angles]
+    vertices = [(x, y, -height / 2) for x, y in ring] + [(x, y, height / 2) for x, y in ring]
+    uvs = [(i / segments, v) for v in (0, 1) for i in range(segments + 1)]
+
+    faces = []
+    for i in range(segments):
+        j = (i + 1) % segments
+        faces.append([(i, i), (j, i + 1), (segments + j, segments + 1 + i + 1), (segments + i, segments + 1 + i)])
+
+    # Caps reuse the first uv, only the sides are textured
+    faces.append([(i, 0) for i in reversed(range(segments))])
+    faces.append([(segments + i, 0) for i in range(segments)])
+    return vertices, uvs, faces
+
+def sphere_mesh(radius, rings=12, segments=24):
+    '''
+    Vertices, uvs and faces of a UV sphere.
+    '''
+    vertices, uvs = [], []
+    for r in range(rings + 1):
+        theta = np.pi * r / rings
+        for s in range(segments + 1):
+            phi = 2 * np.pi * s / segments
+            vertices.append((radius * np.sin(theta) * np.cos(phi), radius * np.sin(theta) * np.sin(phi), radius * np.cos(theta)))
+            uvs.append((s / segments, 1 - r / rings))
+
+    faces = []
+    for r in range(rings):
+        for s in range(segments):
+            a = r * (segments + 1) + s
+            b = a + segments + 1
+            faces.append([(a, a), (b, b), (b + 1, b + 1), (a + 1, a + 1)])
+    return vertices, uvs, faces
+
+def write_png(path, image):
+    '''
+    Write an (h, w, 3) uint8 image as PNG with zlib only.
+    '''
+    height, width, _ = image.shape
+    raw = b"".join(b"\x00" + image[y].tobytes() for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw)))
+        f.write(chunk(b"IEND", b""))
+
+def write_exr(path, image):
+    '''
+    Write an (h, w, 3) float image as an uncompressed half-float scanline EXR.
+    '''
+    height, width, _ = image.shape
+
+    def attribute(name, kind, value):
+        return name.encode() + b"\x00" + kind.encode() + b"\x00" + struct.pack("<i", len(value)) + value
+
+    # Channels are stored in alphabetical order
+    channels = b"".join(name + b"\x00" + struct.pack("<iB3xii", 1, 0, 1, 1) for name in (b"B", b"G", b"R")) + b"\x00"
+    window = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+
+    header = b"".join([
+        struct.pack("<ii", 20000630, 2),
+        attribute("channels", "chlist", channels),
+        attribute("compression", "compression", b"\x00"),
+        attribute("dataWindow", "box2i", window),
+        attribute("displayWindow", "box2i", window),
+        attribute("lineOrder", "lineOrder", b"\x00"),
+        attribute("pixelAspectRatio", "float", struct.pack("<f", 1.0)),
+        attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0)),
+        attribute("screenWindowWidth", "float", struct.pack("<f", 1.0)),
+        b"\x00",
+    ])
+
+    # One scanline per block: y, byte count, then each channel's row
+    bgr = image[:, :, ::-1].astype("<f2")
+    line_size = width * 3 * 2
+    first_line = len(header) + 8 * height
+
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(struct.pack(f"<{height}Q", *[first_line + y * (8 + line_size) for y in range(height)]))
+        for y in range(height):
+            f.write(struct.pack("<ii", y, line_size))
+            f.write(np.ascontiguousarray(bgr[y].T).tobytes())
+
+def write_obj(folder, name, mesh, texture):
+    '''
+    Write an OBJ with its MTL and PNG texture in the layout import_obj expects.
+    '''
+    vertices, uvs, faces = mesh
+    os.makedirs(folder, exist_ok=True)
+    write_png(os.path.join(folder, f"{name}.png"), texture)
+
+    with open(os.path.join(folder, f"{name}.mtl"), "w") as f:
+        f.write(f"newmtl {name}\nKd 1.0 1.0 1.0\nmap_Kd {name}.png\n")
+
+    with open(os.path.join(folder, f"{name}.obj"), "w") as f:
+        f.write(f"mtllib {name}.mtl\no {name}\n")
+        f.writelines(f"v {x:.5f} {y:.5f} {z:.5f}\n" for x, y, z in vertices)
+        f.writelines(f"vt {u:.5f} {v:.5f}\n" for u, v in uvs)
+        f.write(f"usemtl {name}\n")
+        f.writelines("f " + " ".join(f"{v + 1}/{t + 1}" for v, t in face) + "\n" for face in faces)
+
+def make_texture(rng, size):
+    # Checkerboard of two random colors, so bad UVs are visible in the renders
+    colors = rng.integers(0, 256, (2, 3), dtype=np.uint8)
+    cells = (np.indices((size, size)) // (size // 8)).sum(axis=0) % 2
+    return colors[cells]
+
+def make_hdri(rng, width):
+    # Sky gradient over a darker ground with one bright sun spot
+    height = width // 2
+    v = np.linspace(1, 0, height)[:, None, None]
+    sky = rng.uniform(0.2, 1.0, 3) * v + rng.uniform(0.0, 0.3, 3) * (1 - v)
+    image = np.broadcast_to(sky, (height, width, 3)).copy()
+
+    y, x = rng.integers(0, height // 2), rng.integers(0, width)
+    image[max(0, y - 2):y + 3, max(0, x - 2):x + 3] = 50.0
+    return image
+
+def make_fixtures(fixture_path, seed=0):
+    '''
+    Build the models/<class>/<object>/ tree and hdri/ folder used by the benchmark.
+    '''
+    rng = np.random.default_rng(seed)
+    obj_path = os.path.join(fixture_path, "models")
+    hdri_path = os.path.join(fixture_path, "hdri")
+    os.makedirs(hdri_path, exist_ok=True)
+
+    shapes = [
+        lambda: box_mesh(rng.uniform(0.05, 0.3, 3)),
+        lambda: cylinder_mesh(rng.uniform(0.03, 0.08), rng.uniform(0.1, 0.25)),
+        lambda: sphere_mesh(rng.uniform(0.04, 0.12)),
+    ]
+
+    for c, class_name in enumerate(FIXTURE_CLASSES):
+        for m in range(MODELS_PER_CLASS):
+            name = f"{class_name}_{m}"
+            mesh = shapes[(c + m) % len(shapes)]()
+            write_obj(os.path.join(obj_path, class_name, name), name, mesh, make_texture(rng, TEXTURE_SIZE))
+
+    for h in range(NUM_HDRIS):
+        write_exr(os.path.join(hdri_path, f"fixture_{h}.exr"), make_hdri(rng, HDRI_WIDTH))
+
+    return obj_path, hdri_path
+
+
+
+# === BENCHMARK ===
+
+def run_generate(args, obj_path, hdri_path, output_path):
+    '''
+    Run one headless CPU generation and return its wall time and peak RSS.
+    '''
+    script_args = [
+        "--obj_path", obj_path,
+        "--hdri_path", hdri_path,
+        "--output_path", output_path,
+        # Compiled assets next to the fixtures, so every run starts cold instead of reusing
+        # (possibly stale) .blend files of an earlier one from the default cache
+        "--asset_cache_path", os.path.join(args.fixture_path, "asset_cache"),
+        "--seed", "0",
+        "--iteration", str(args.iteration),
+        "--arrangement", str(args.arrangement),
+        "--num_pics", str(args.num_pics),
+        "--resolution_x", str(args.resolution_x),
+        "--resolution_y", str(args.resolution_y),
+        "--samples", str(args.samples),
+        "--device", "CPU",
+        "--render_mode", args.render_mode,
+        "--profile",
+    ]
+
+    if args.blender:
+        cmd = [args.blender, "-b", "-P", GENERATE_SCRIPT, "--"] + script_args
+    else:
+        cmd = [sys.executable, GENERATE_SCRIPT] + script_args
+
+    log_path = os.path.join(output_path, "benchmark.log")
+    os.makedirs(output_path, exist_ok=True)
+
+    start_time = time.time()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+        # wait4 gives the peak RSS of this child alone
+        _pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    seconds = time.time() - start_time
+    if process.returncode != 0:
+        raise RuntimeError(f"generate_data.py failed with code {process.returncode}, see {log_path}")
+
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+def collect_metrics(output_path, seconds, peak_rss_mb):
+    attempt_folder = sorted(glob.glob(os.path.join(output_path, "attempt_*")))[-1]
+    num_images = len(glob.glob(os.path.join(attempt_folder, "*", "images", "*")))
+
+    summary_path = glob.glob(os.path.join(attempt_folder, "profile_*_summary.yaml"))[0]
+    with open(summary_path) as f:
+        summary = yaml.full_load(f)
+
+    startup = summary.get("session.startup", {}).get("mean", 0.0) / 1000
+    metrics = {
+        "images": num_images,
+        "seconds": round(seconds, 2),
+        "startup_s": round(startup, 2),
+        "images_per_s": round(num_images / max(seconds - startup, 1e-6), 3),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+    # Median time of every per-frame stage
+    for stage, values in summary.items():
+        if stage != "session.startup":
+            metrics[f"{stage}_ms"] = values["p50"]
+
+    return metrics
+
+def compare(metrics, baseline, tolerance):
+    '''
+    Print the metrics next to the baseline and return the names of the regressed ones.
+    '''
+    regressions = []
+    print(f"\n{'metric':<32}{'current':>12}{'baseline':>12}{'change':>10}")
+
+    for name, value in metrics.items():
+        base = baseline.get(name)
+        if base is None or name == "images":
+            print(f"{name:<32}{value:>12}{'-':>12}{'':>10}")
+            continue
+
+        change = (value - base) / base if base else 0.0
+
+        # Throughput regresses when it drops, everything else when it grows
+        worse = -change if name == "images_per_s" else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+
+        print(f"{name:<32}{value:>12}{base:>12}{change:>+10.1%}{flag}")
+
+    return regressions
+
+
+
+# === MAIN FUNCTION ===
+
+def main(args):
+    shutil.rmtree(args.fixture_path, ignore_errors=True)
+    obj_path, hdri_path = make_fixtures(args.fixture_path)
+    output_path = os.path.join(args.fixture_path, "output")
+
+    print(f"Fixtures in {args.fixture_path}, running generate_data.py on CPU...")
+    seconds, peak_rss_mb = run_generate(args, obj_path, hdri_path, output_path)
+    metrics = collect_metrics(output_path, seconds, peak_rss_mb)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(metrics, f, indent=2)
+        compare(metrics, {}, args.tolerance)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        compare(metrics, {}, args.tolerance)
+        print(f"\nNo baseline at {args.baseline}, run with --update_baseline to store one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(metrics, baseline, args.tolerance)
+    if regressions:
+        print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+
+    print("\nNo regressions")
+    return 0
+
+
+
+# === ARGUMENT PARSING ===
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Benchmark generate_data.py on procedural fixtures, headless on CPU.")
+
+    parser.add_argument("--fixture_path",
+        help = "Scratch directory for the fixtures and the benchmark output (wiped on every run).",
+        default = FIXTURE_PATH)
+
+    parser.add_argument("--baseline",
+        help = "JSON file with the stored baseline metrics.",
+        default = BASELINE_PATH)
+
+    parser.add_argument("--update_baseline",
+        help = "Store this run as the new baseline instead of comparing against it.",
+        action = "store_true")
+
+    parser.add_argument("--tolerance",
+        help = "Relative slowdown or memory growth reported as a regression.",
+        default = TOLERANCE,
+        type = float)
+
+    parser.add_argument("--iteration",
+        help = "Number of backgrounds rendered.",
+        default = ITERATION,
+        type = int)
+
+    parser.add_argument("--arrangement",
+        help = "Number of arrangements per background.",
+        default = ARRANGEMENT,
+        type = int)
+
+    parser.add_argument("--num_pics",
+        help = "Number of pictures taken around per object.",
+        default = NUM_PICS,
+        type = int)
+
+    parser.add_argument("--resolution_x",
+        help = "Width of the rendered images.",
+        default = RESOLUTION_X,
+        type = int)
+
+    parser.add_argument("--resolution_y",
+        help = "Height of the rendered images.",
+        default = RESOLUTION_Y,
+        type = int)
+
+    parser.add_argument("--samples",
+        help = "Cycles samples per image.",
+        default = SAMPLES,
+        type = int)
+
+    parser.add_argument("--render_mode",
+        help = "Render mode passed to generate_data.py.",
+        choices = ["bpycv", "index_pass"],
+        default = "bpycv")
+
+    parser.add_argument("--blender",
+        help = "Path to the Blender binary; if omitted the standalone bpy module is used.",
+        default = None)
+
+    return parser.parse_args(argv)
+
+
+
+# === ENTRY POINT ===
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(main(args))
@@ -1,51 +1,243 @@
 import os
 import sys
-import glob
+import json
 import shutil
+import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-output = "/home/data/3D_RP/output" # Example
+import annotation_store
 
-combined_output = os.path.join(
-    os.path.dirname(output), 
-    "combined_" + os.path.basename(output)
-)
+output = "/home/data/3D_RP/output" # Example (merged into combined_output next to it)
 
-def combine():
+NUM_THREADS = 16            # Parallel link/copy operations
+STATE_FILE = "combined_attempts.json" # Inside the combined folder: attempts already merged and their counts
+
+
+
+# === ATTEMPTS ===
+
+def is_complete(attempt_folder):
+    '''
+    An attempt is complete once its configs end with the execution time and it wasn't
+    stopped early by the memory watermark (a resumed run appends a new execution time).
+    '''
+    config_path = attempt_folder / f"configs_{attempt_folder.name.split('_')[-1]}.yaml"
+    if not config_path.exists():
+        return False
+
+    markers = []
+    with open(config_path) as f:
+        for line in f:
+            if line.startswith(("# Total execution time", "# Stopped early", "# Resumed")):
+                markers.append(line.split(":")[0])
+
+    if not markers or markers[-1] != "# Total execution time":
+        return False
+    return len(markers) < 2 or markers[-2] != "# Stopped early"
+
+def list_files(attempt_folder, kind):
+    '''
+    {file name : path} of the images or labels of all iterations of an attempt.
+    '''
+    files = {}
+    for background_folder in attempt_folder.iterdir():
+        folder = background_folder / kind
+        if not folder.is_dir():
+            continue
+
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                # Files still being written end with .tmp
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    files[entry.name] = Path(entry.path)
+    return files
+
+
+
+# === LINKING ===
+
+def link_or_copy(src, dst):
+    '''
+    Hardlink src to dst, or let the kernel copy (or reflink) it, or copy it.
+    Returns the method used, "exists" if dst is src already, or "collision".
+    '''
+    try:
+        os.link(src, dst)
+        return "link"
+    except FileExistsError:
+        return "exists" if os.path.samefile(src, dst) else "collision"
+    except OSError:
+        pass  # Other filesystem or no hardlink support
+
+    if os.path.exists(dst):
+        return "collision"
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        return "copy_file_range"
+    except FileExistsError:
+        # Created by someone else since the check above, never overwrite it
+        return "collision"
+    except (AttributeError, OSError):
+        # copy_file_range is Linux only, and not every filesystem pair supports it
+        shutil.copyfile(src, dst)
+        return "copy"
+
+def merge_attempt(attempt_folder, combined_dir, pool):
+    '''
+    Link the images, labels and shards of one attempt into the combined folder.
+    '''
+    images = list_files(attempt_folder, "images")
+    labels = list_files(attempt_folder, "labels")
+
+    tasks = [(src, combined_dir / "images" / name) for name, src in images.items()]
+    tasks += [(src, combined_dir / "labels" / name) for name, src in labels.items()]
+
+    shard_folder = attempt_folder / "shards"
+    shards = sorted(shard_folder.glob("*.tar")) if shard_folder.is_dir() else []
+    tasks += [(src, combined_dir / "shards" / src.name) for src in shards]
+
+    results = list(pool.map(lambda task: link_or_copy(*task), tasks))
+
+    methods = {}
+    collisions = []
+    merged = {"images": 0, "labels": 0, "shards": 0}
+    for (src, dst), result in zip(tasks, results):
+        methods[result] = methods.get(result, 0) + 1
+        if result == "collision":
+            collisions.append(str(src))
+        else:
+            merged[dst.parent.name] += 1
+
+    # Merge the shard index (lines of an interrupted earlier run are already there)
+    index_path = shard_folder / "index.jsonl"
+    combined_index_path = combined_dir / "shards" / "index.jsonl"
+    if index_path.exists():
+        known = set()
+        if combined_index_path.exists():
+            with open(combined_index_path) as f:
+                known = {json.loads(line)["shard"] for line in f if line.strip()}
+
+        with open(index_path) as fsrc, open(combined_index_path, "a") as fdst:
+            for line in fsrc:
+                if line.strip() and json.loads(line)["shard"] not in known:
+                    fdst.write(line)
+
+    # Append the attempt's annotation store (frames already merged are skipped)
+    store_path = attempt_folder / "annotations"
+    if (store_path / "meta.json").exists():
+        annotation_store.copy_store(annotation_store.AnnotationStore(store_path), combined_dir / "annotations")
+
+    # Images without a label and labels without an image
+    image_stems = {os.path.splitext(name)[0] for name in images}
+    label_stems = {os.path.splitext(name)[0] for name in labels}
+    orphans = sorted(image_stems ^ label_stems)
+
+    # Frame count from the attempt's manifest, not from a glob of the output
+    manifest_path = attempt_folder / "manifest.jsonl"
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            # A frame rendered again after a crash has a second entry
+            frames = len({json.loads(line)["frame"] for line in f if line.strip()})
+    else:
+        frames = len(image_stems)
+
+    return dict(frames=frames, **merged, methods=methods, collisions=collisions, orphans=orphans)
+
+
+
+# === STATE ===
+
+def load_state(state_path):
+    if not state_path.exists():
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    # Replace the file in one step so an interrupted run never leaves a broken state
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+
+# === MAIN FUNCTION ===
+
+def combine(output_path, combined_path, num_threads=NUM_THREADS):
     # Paths
-    base_dir = Path(output)
-    combined_dir = Path(combined_output)
+    base_dir = Path(output_path)
+    combined_dir = Path(combined_path)
+
+    # Create combined_output/images, combined_output/labels and combined_output/shards
+    for kind in ("images", "labels", "shards"):
+        (combined_dir / kind).mkdir(parents=True, exist_ok=True)
 
-    # Create combined_output/images and combined_output/labels
-    (combined_dir / "images").mkdir(parents=True, exist_ok=True)
-    (combined_dir / "labels").mkdir(parents=True, exist_ok=True)
+    state_path = combined_dir / STATE_FILE
+    state = load_state(state_path)
 
-    # Loop through each attempt folder
-    for attempt_folder in base_dir.glob("attempt_*"):
-        for background_folder in attempt_folder.iterdir():
-            if not background_folder.is_dir():
+    attempts = sorted(base_dir.glob("attempt_*"), key=lambda p: int(p.name.split("_")[-1]))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for attempt_folder in attempts:
+            if attempt_folder.name in state:
                 continue
 
-            images_dir = background_folder / "images"
-            labels_dir = background_folder / "labels"
+            if not is_complete(attempt_folder):
+                print(f"Skipping {attempt_folder.name}: still running or stopped early")
+                continue
 
-            # Copy images
-            if images_dir.exists():
-                for img_file in images_dir.iterdir():
-                    if img_file.is_file():
-                        shutil.copy(img_file, combined_dir / "images" / img_file.name)
+            report = merge_attempt(attempt_folder, combined_dir, pool)
+            state[attempt_folder.name] = report
+            save_state(state_path, state)
 
-            # Copy labels
-            if labels_dir.exists():
-                for label_file in labels_dir.iterdir():
-                    if label_file.is_file():
-                        shutil.copy(label_file, combined_dir / "labels" / label_file.name)
+            print(f"Merged {attempt_folder.name}: {report['frames']} frames {report['methods']}")
+            if report["collisions"]:
+                print(f"    {len(report['collisions'])} name collisions kept the existing file, e.g. {report['collisions'][0]}")
+            if report["orphans"]:
+                print(f"    {len(report['orphans'])} images or labels without their pair, e.g. {report['orphans'][0]}")
 
     print("Files combined successfully.")
+    return state
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Merge the complete attempts of the output folder into one folder.")
+
+    parser.add_argument("--output_path",
+        help = "The output directory of generate_data.py.",
+        default = output)
+
+    parser.add_argument("--combined_path",
+        help = "The directory the attempts are merged into.",
+        default = None)
+
+    parser.add_argument("--threads",
+        help = "Parallel link/copy operations.",
+        default = NUM_THREADS,
+        type = int)
+
+    args = parser.parse_args(argv)
+    if args.combined_path is None:
+        args.combined_path = os.path.join(os.path.dirname(args.output_path), "combined_" + os.path.basename(args.output_path))
+    return args
 
-combine()
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    state = combine(args.output_path, args.combined_path, args.threads)
 
-img = glob.glob(os.path.join(combined_output, "images/*"))
-lbl = glob.glob(os.path.join(combined_output, "labels/*"))
+    # Counts come from the recorded merges instead of a glob of the combined folder
+    img = sum(report["images"] for report in state.values())
+    lbl = sum(report["labels"] for report in state.values())
+    shards = sum(report["shards"] for report in state.values())
 
-print(f"number of images: {len(img)}, number of labels: {len(lbl)}")
\ No newline at end of file
+    print(f"number of images: {img}, number of labels: {lbl}, number of shards: {shards}")
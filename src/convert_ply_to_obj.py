@@ -1,119 +1,321 @@
 import pymeshlab
+import cv2
 import os
 import sys
+import json
 import shutil
+import hashlib
+import argparse
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 input_path = "/home/data/pace/models" # Example
 output_path = "/home/data/raw/[dataset_name]/3d_models" # Example
 
 models = {
     "can" : [74, 57, 58],
-    "toy_car" : [456, 458, 461, 470], 
-    "distractors" : [56, 82, 87, 101, 153, 207, 228, 229, 249, 257, 286, 317, 
+    "toy_car" : [456, 458, 461, 470],
+    "distractors" : [56, 82, 87, 101, 153, 207, 228, 229, 249, 257, 286, 317,
                      338, 361, 404, 410, 415, 434, 435, 436, 528, 543, 635, 636]
 } # Example
 
+NUM_WORKERS = 4             # Models converted at the same time
+STATE_FILE = ".convert_state.json" # Inside output_path: input hash and LOD settings of the converted models
+
+LOD_FOLDER = "lod"          # Inside each model folder (not picked up as the model itself by generate_data.py)
+LOD_FACE_COUNTS = [20000, 5000, 1000] # Target faces of LOD 1, 2, 3, ... (each decimated from the previous one)
+LOD_TEXTURE_SIZES = [1024, 512, 256]  # Longest texture side of the same levels (never upscaled)
+
+# MeshLab reads the texture coordinates of PACE models only under these names
+HEADER_RENAMES = {
+    b"property float u": b"property float texture_u",
+    b"property float v": b"property float texture_v",
+}
+
+
+
+# === PLY ===
+
 def rewrite_ply(input_ply):
-    with open(input_ply, "r") as f:
+    '''
+    Copy the PLY with the u/v properties renamed: only the header is rewritten,
+    the (ASCII or binary) body is streamed through unchanged.
+    '''
+    with open(input_ply, "rb") as src, tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tmp:
+        while True:
+            line = src.readline()
+            if not line:
+                raise ValueError(f"{input_ply} has no end_header")
+
+            key = line.rstrip(b"\r\n")
+            ending = line[len(key):]
+            tmp.write(HEADER_RENAMES.get(b" ".join(key.split()), key) + ending)
+
+            if key == b"end_header":
+                break
+
+        shutil.copyfileobj(src, tmp, length=1024 * 1024)
+        return tmp.name
+
+
+
+# === MODELS ===
+
+def inputs_sha1(paths):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+def model_files(label, name, num_lods=0):
+    input_ply = os.path.join(input_path, f"{name}.ply")
+    src_texture = os.path.join(input_path, f"{name}.png")
+    output_obj_folder = os.path.join(output_path, label, name)
+
+    files = [f"{name}.obj", f"{name}.obj.mtl", f"{name}.png"]
+    for level in range(1, num_lods + 1):
+        files += [os.path.join(LOD_FOLDER, f"{name}_lod{level}{ext}") for ext in (".obj", ".obj.mtl", ".png")]
+
+    outputs = [os.path.join(output_obj_folder, f) for f in files]
+    return [input_ply, src_texture], output_obj_folder, outputs
+
+def is_up_to_date(inputs, outputs, previous_sha1):
+    '''
+    Returns (up to date, sha1 of the inputs if it had to be computed).
+    '''
+    if not all(os.path.exists(path) for path in outputs):
+        return False, None
+
+    # Outputs are only in place once complete, so being newer means they were made from these inputs
+    if min(os.path.getmtime(path) for path in outputs) >= max(os.path.getmtime(path) for path in inputs):
+        return True, previous_sha1
+
+    # Inputs were touched (e.g. copied again) but may still be the same
+    sha1 = inputs_sha1(inputs)
+    return sha1 == previous_sha1, sha1
+
+def add_texture_to_mtl(mtl_file, texture_file):
+    with open(mtl_file, "r", encoding="utf-8") as f:
         lines = f.readlines()
 
-    # Prepare new lines
     new_lines = []
-
     for line in lines:
-        if line.startswith("property float u"):
-            # Eename u -> texture_u
-            new_lines.append("property float texture_u\n")
-        elif line.startswith("property float v"):
-            # Eename v -> texture_v
-            new_lines.append("property float texture_v\n")
-        else:
-            new_lines.append(line)
-
-    ply_string = "".join(new_lines)
-
-    # Create a temporary file for the converted PLY file
-    with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tmp:
-        tmp.write(ply_string.encode())
-        tmp_path = tmp.name
-
-    return tmp_path
-
-def convert_ply_to_obj():
-    # ---- Clear output folder ----
-    for filename in os.listdir(output_path):
-        file_path = os.path.join(output_path, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
-    print(f"Cleared folder: {output_path}")
-
-    for label, nums in models.items():
-        # Make directory for the category
-        output_folder = os.path.join(output_path, label)
-        os.makedirs(output_folder, exist_ok=True)
-
-        padded_nums = [str(n).zfill(6) for n in nums]
-        
-        for num in padded_nums:
-            name = f"obj_{num}"
-
-            # Make directory for the object
-            output_obj_folder = os.path.join(output_folder, name)
-            os.makedirs(output_obj_folder, exist_ok=True)
-
-            # Input and output files
-            input_ply = os.path.join(input_path, f"{name}.ply")
-            output_obj = os.path.join(output_obj_folder, f"{name}.obj")
-
-            # Convert PLY file into temporaray, MeshLab-readable version
-            tmp_path = rewrite_ply(input_ply)
-
-            # Create a MeshSet object and load the temporaray PLY file
-            ms = pymeshlab.MeshSet()
-            ms.load_new_mesh(tmp_path)
-
-            # Save the MeshSet as OBJ
-            ms.save_current_mesh(
-                output_obj,
-                save_vertex_color=True,
-                save_textures=True
-            )
-
-            # Remove temp file
-            os.remove(tmp_path)
-
-            # Remove dummy.png if present
-            dummy_texture = os.path.join(output_obj_folder, "dummy.png")
-            if os.path.exists(dummy_texture):
-                os.remove(dummy_texture)
-
-            # ---- Copy texture file to destination ----
-            texture_file = f"{name}.png"
-            src_texture = os.path.join(input_path, texture_file)
-            dst_texture = os.path.join(output_obj_folder, texture_file)
-            shutil.copy(src_texture, dst_texture)
-
-            # ---- Add map_Kd line to MTL to ensure texture ----
-            mtl_file = os.path.splitext(output_obj)[0] + ".obj.mtl"
-
-            with open(mtl_file, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-                new_lines = []
-                for line in lines:
-                    new_lines.append(line)
-                    if line.startswith("newmtl "):
-                        new_lines.append(f"\nmap_Kd {texture_file}\n")  # Insert texture
-
-                with open(mtl_file, "w", encoding="utf-8") as f:
-                    f.writelines(new_lines)
-
-            print(f"Converted {name}.ply -> {name}.obj")
-
-convert_ply_to_obj()
\ No newline at end of file
+        new_lines.append(line)
+        if line.startswith("newmtl "):
+            new_lines.append(f"\nmap_Kd {texture_file}\n")  # Insert texture
+
+    with open(mtl_file, "w", encoding="utf-8") as f:
+        f.writelines(new_lines)
+
+def save_obj(ms, folder, name, texture):
+    '''
+    Save the current mesh as <name>.obj with its texture <name>.png, either copied from a path or written from an image.
+    '''
+    output_obj = os.path.join(folder, f"{name}.obj")
+
+    # Save the MeshSet as OBJ
+    ms.save_current_mesh(
+        output_obj,
+        save_vertex_color=True,
+        save_textures=True
+    )
+
+    # Remove dummy.png if present
+    dummy_texture = os.path.join(folder, "dummy.png")
+    if os.path.exists(dummy_texture):
+        os.remove(dummy_texture)
+
+    # ---- Copy texture file to destination ----
+    texture_file = f"{name}.png"
+    if isinstance(texture, str):
+        shutil.copy(texture, os.path.join(folder, texture_file))
+    elif not cv2.imwrite(os.path.join(folder, texture_file), texture):
+        raise RuntimeError(f"Could not write {texture_file}")
+
+    # ---- Add map_Kd line to MTL to ensure texture ----
+    add_texture_to_mtl(output_obj + ".mtl", texture_file)
+
+
+
+# === LOD ===
+
+def prepare_decimation(ms):
+    '''
+    The texture-preserving decimation works on per-wedge texture coordinates, PACE meshes have per-vertex ones.
+    Returns whether the mesh has texture coordinates at all.
+    '''
+    mesh = ms.current_mesh()
+    if mesh.has_wedge_tex_coord():
+        return True
+    if mesh.has_vertex_tex_coord():
+        ms.compute_texcoord_transfer_vertex_to_wedge()
+        return True
+    return False
+
+def decimate(ms, face_count, with_texture):
+    # Levels the mesh is already below are written unchanged
+    if ms.current_mesh().face_number() <= face_count:
+        return
+
+    if with_texture:
+        ms.meshing_decimation_quadric_edge_collapse_with_texture(targetfacenum=face_count, preserveboundary=True)
+    else:
+        ms.meshing_decimation_quadric_edge_collapse(targetfacenum=face_count, preserveboundary=True,
+                                                    preservenormal=True, planarquadric=True)
+
+def downscale(texture, size):
+    height, width = texture.shape[:2]
+    if max(height, width) <= size:
+        return texture
+
+    scale = size / max(height, width)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(texture, new_size, interpolation=cv2.INTER_AREA)
+
+def convert_model(label, name, previous=None, force=False, lods=()):
+    '''
+    previous is the state entry of the last conversion ({"sha1", "lods"}), if any.
+    Returns (label, name, status, new state entry).
+    '''
+    inputs, output_obj_folder, outputs = model_files(label, name, len(lods))
+    input_ply, src_texture = inputs
+    lods = [list(lod) for lod in lods]
+    previous = previous or {}
+
+    sha1 = None
+    # Levels made with other face counts or texture sizes are stale even if the inputs are not
+    if not force and previous.get("lods") == lods:
+        up_to_date, sha1 = is_up_to_date(inputs, outputs, previous.get("sha1"))
+        if up_to_date:
+            if not lods:
+                shutil.rmtree(os.path.join(output_obj_folder, LOD_FOLDER), ignore_errors=True)
+            return label, name, "skipped", {"sha1": sha1 or previous.get("sha1"), "lods": lods}
+
+    # Convert into a hidden folder (not picked up by generate_data.py) and swap it in once everything is written
+    tmp_folder = os.path.join(output_path, ".converting", label, name)
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    # Convert PLY file into temporaray, MeshLab-readable version
+    tmp_path = rewrite_ply(input_ply)
+
+    try:
+        # Create a MeshSet object and load the temporaray PLY file
+        ms = pymeshlab.MeshSet()
+        ms.load_new_mesh(tmp_path)
+
+        save_obj(ms, tmp_folder, name, src_texture)
+
+        # LOD levels: quadric decimation of the previous level with a matching smaller texture
+        if lods:
+            os.makedirs(os.path.join(tmp_folder, LOD_FOLDER))
+            texture = cv2.imread(src_texture, cv2.IMREAD_UNCHANGED)
+            if texture is None:
+                raise RuntimeError(f"Could not read {src_texture}")
+
+            with_texture = prepare_decimation(ms)
+            for level, (face_count, texture_size) in enumerate(lods, start=1):
+                decimate(ms, face_count, with_texture)
+                save_obj(ms, os.path.join(tmp_folder, LOD_FOLDER), f"{name}_lod{level}", downscale(texture, texture_size))
+    finally:
+        # Remove temp file
+        os.remove(tmp_path)
+
+    shutil.rmtree(output_obj_folder, ignore_errors=True)
+    os.makedirs(os.path.dirname(output_obj_folder), exist_ok=True)
+    os.rename(tmp_folder, output_obj_folder)
+
+    # The output folder is replaced as a whole, so no levels means no lod/ folder either
+    return label, name, "converted", {"sha1": sha1 or inputs_sha1(inputs), "lods": lods}
+
+
+
+# === MAIN FUNCTION ===
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        state = json.load(f)
+
+    # Entries that only hold the input sha1 don't say which levels were made, so those are redone
+    return {key: entry if isinstance(entry, dict) else {"sha1": entry, "lods": None} for key, entry in state.items()}
+
+def save_state(state_path, state):
+    with open(f"{state_path}.tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f"{state_path}.tmp", state_path)
+
+def convert_ply_to_obj(num_workers=NUM_WORKERS, force=False, lods=()):
+    os.makedirs(output_path, exist_ok=True)
+    state_path = os.path.join(output_path, STATE_FILE)
+    state = load_state(state_path)
+
+    tasks = [(label, f"obj_{str(n).zfill(6)}") for label, nums in models.items() for n in nums]
+
+    # Folders of models that were removed from the dict are kept, only reported
+    wanted = {f"{label}/{name}" for label, name in tasks}
+    for key in sorted(set(state) - wanted):
+        print(f"Not in models anymore (kept): {os.path.join(output_path, key)}")
+
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = {pool.submit(convert_model, label, name, state.get(f"{label}/{name}"), force, lods): (label, name)
+                   for label, name in tasks}
+
+        for future in as_completed(futures):
+            label, name = futures[future]
+            try:
+                _label, _name, status, entry = future.result()
+            except Exception as e:
+                print(f"Failed to convert {name}.ply: {e}")
+                counts["failed"] += 1
+                continue
+
+            counts[status] += 1
+            state[f"{label}/{name}"] = entry
+            save_state(state_path, state)
+
+            if status == "converted":
+                print(f"Converted {name}.ply -> {name}.obj")
+
+    print(f"converted: {counts['converted']}, skipped: {counts['skipped']}, failed: {counts['failed']}")
+    return 1 if counts["failed"] else 0
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Convert the PACE models listed in `models` from PLY to OBJ.")
+
+    parser.add_argument("--workers",
+        help = "Models converted at the same time.",
+        default = NUM_WORKERS,
+        type = int)
+
+    parser.add_argument("--force",
+        help = "Convert every model again, even if its outputs are up to date.",
+        action = "store_true")
+
+    parser.add_argument("--lod_faces",
+        help = "Target face counts of the LOD levels, separated by commas (empty for none). "
+               "Models made with other levels are converted again.",
+        default = ",".join(str(n) for n in LOD_FACE_COUNTS))
+
+    parser.add_argument("--lod_textures",
+        help = "Longest texture side of the LOD levels, separated by commas.",
+        default = ",".join(str(n) for n in LOD_TEXTURE_SIZES))
+
+    args = parser.parse_args(argv)
+
+    face_counts = [int(n) for n in args.lod_faces.split(",") if n.strip()]
+    texture_sizes = [int(n) for n in args.lod_textures.split(",") if n.strip()]
+    if len(texture_sizes) < len(face_counts):
+        parser.error("--lod_textures needs a size for every level of --lod_faces")
+    args.lods = list(zip(face_counts, texture_sizes))
+    return args
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(convert_ply_to_obj(args.workers, args.force, args.lods))
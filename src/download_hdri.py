@@ -1,43 +1,204 @@
-import requests
 import os
+import sys
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 save_folder = "/home/data/raw/[dataset_name]/backgrounds/HDRI" # Example
-ids_file = "hdri_ids.txt"   
+ids_file = "hdri_ids.txt"
+
+API_URL = "https://api.polyhaven.com" # Poly Haven API (point it at a local server for testing)
+RESOLUTION = "8k"           # Resolution key of the Poly Haven file metadata ("1k", "2k", "4k", "8k", ...)
+FILE_FORMAT = "exr"         # File format key ("exr" or "hdr")
+NUM_WORKERS = 4             # Files downloaded at the same time
+RETRIES = 5                 # Attempts per file; each one resumes where the last one stopped
+CHUNK_SIZE = 1024 * 1024    # Bytes read per chunk
+
+
+
+# === SESSION ===
+
+def make_session(num_workers):
+    '''
+    One session shared by all workers, with a connection pool per host big enough for all of them.
+    '''
+    session = requests.Session()
+
+    # Retry metadata requests and connection errors; the download loop resumes partial files itself
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_file_info(session, api_url, asset_id, resolution, file_format):
+    '''
+    URL, size and md5 of one asset file from the Poly Haven file metadata.
+    '''
+    response = session.get(f"{api_url}/files/{asset_id}", timeout=30)
+    response.raise_for_status()
+    data = response.json()
 
-os.makedirs(save_folder, exist_ok=True)
+    try:
+        return data["hdri"][resolution][file_format]
+    except KeyError:
+        raise KeyError(f"{asset_id} has no {resolution} {file_format} file") from None
+
+
+
+# === DOWNLOAD ===
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5
+
+def is_complete(save_path, info, verify):
+    if not os.path.exists(save_path):
+        return False
+    if info.get("size") is not None and os.path.getsize(save_path) != info["size"]:
+        return False
+    if verify and info.get("md5"):
+        return file_md5(save_path).hexdigest() == info["md5"]
+    return True
+
+def download_file(session, info, save_path, retries=RETRIES):
+    '''
+    Download into <save_path>.part, resuming it with a Range request after a dropped connection,
+    and move it into place once its size (and md5) match the metadata.
+    '''
+    url, size, expected_md5 = info["url"], info.get("size"), info.get("md5")
+    part_path = f"{save_path}.part"
+
+    for attempt in range(retries):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        # The file changed on the server since the partial download, start over
+        if size is not None and offset > size:
+            os.remove(part_path)
+            offset = 0
+
+        try:
+            if size is not None and offset == size:
+                break
 
-def download_file(url, save_path):
-    print(f"Downloading {url} ...")
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                # Nothing left to send for this range: the partial file is already complete
+                if offset and r.status_code == 416:
+                    break
+                r.raise_for_status()
 
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
+                # 206 continues the partial file, anything else starts over
+                mode = "ab" if offset and r.status_code == 206 else "wb"
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+            break
 
-    with open(save_path, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            f.write(chunk)
+        except requests.RequestException as e:
+            print(f"    {os.path.basename(save_path)}: {e}, retrying ({attempt + 1}/{retries})")
+            time.sleep(min(2 ** attempt, 30))
+    else:
+        raise RuntimeError(f"Gave up on {url} after {retries} attempts")
 
+    if size is not None and os.path.getsize(part_path) != size:
+        raise RuntimeError(f"{url}: got {os.path.getsize(part_path)} bytes, expected {size}")
+
+    if expected_md5 and file_md5(part_path).hexdigest() != expected_md5:
+        # A corrupted partial file can't be resumed, start from zero next time
+        os.remove(part_path)
+        raise RuntimeError(f"{url}: md5 mismatch")
+
+    os.replace(part_path, save_path)
+
+def download_asset(session, args, asset_id):
+    info = get_file_info(session, args.api_url, asset_id, args.resolution, args.format)
+    save_path = os.path.join(args.save_folder, os.path.basename(info["url"]))
+
+    if is_complete(save_path, info, args.verify):
+        return asset_id, "skipped"
+
+    print(f"Downloading {info['url']} ...")
+    download_file(session, info, save_path, args.retries)
     print(f"Saved to {save_path}")
+    return asset_id, "downloaded"
 
-def download_all_files():
+
+
+# === MAIN FUNCTION ===
+
+def download_all_files(args):
     # ids_file ocntains one asset id per line
-    with open(ids_file, "r", encoding="utf-8") as f:
+    with open(args.ids_file, "r", encoding="utf-8") as f:
         ids = [line.strip() for line in f if line.strip()]
 
-    for asset_id in ids:
-        api_url = f"https://api.polyhaven.com/files/{asset_id}"
-        try:
-            response = requests.get(api_url)
-            response.raise_for_status()
-            data = response.json()
+    os.makedirs(args.save_folder, exist_ok=True)
+    session = make_session(args.workers)
+
+    counts = {"downloaded": 0, "skipped": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(download_asset, session, args, asset_id): asset_id for asset_id in ids}
+
+        for future in as_completed(futures):
+            try:
+                _asset_id, status = future.result()
+                counts[status] += 1
+            except Exception as e:
+                print(f"Failed for {futures[future]}: {e}")
+                counts["failed"] += 1
+
+    print(f"downloaded: {counts['downloaded']}, skipped: {counts['skipped']}, failed: {counts['failed']}")
+    return 1 if counts["failed"] else 0
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Download HDRI backgrounds from Poly Haven.")
+
+    parser.add_argument("--save_folder",
+        help = "The directory the HDRI files are saved to.",
+        default = save_folder)
+
+    parser.add_argument("--ids_file",
+        help = "Text file with one Poly Haven asset id per line.",
+        default = ids_file)
+
+    parser.add_argument("--api_url",
+        help = "Base URL of the Poly Haven API (or a local stand-in server).",
+        default = API_URL)
+
+    parser.add_argument("--resolution",
+        help = "Resolution of the files, e.g. 2k, 4k or 8k.",
+        default = RESOLUTION)
+
+    parser.add_argument("--format",
+        help = "File format, exr or hdr.",
+        default = FILE_FORMAT)
+
+    parser.add_argument("--workers",
+        help = "Files downloaded at the same time.",
+        default = NUM_WORKERS,
+        type = int)
 
-            # Get 8k EXR URL
-            exr_url = data["hdri"]["8k"]["exr"]["url"]
-            filename = os.path.basename(exr_url)
-            save_path = os.path.join(save_folder, filename)
+    parser.add_argument("--retries",
+        help = "Attempts per file, each resuming the partial download.",
+        default = RETRIES,
+        type = int)
 
-            download_file(exr_url, save_path)
+    parser.add_argument("--verify",
+        help = "Check the md5 of existing files, not only their size.",
+        action = "store_true")
 
-        except Exception as e:
-            print(f"Failed for {asset_id}: {e}")
+    return parser.parse_args(argv)
 
-download_all_files()
\ No newline at end of file
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(download_all_files(args))
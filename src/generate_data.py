@@ -12,13 +12,33 @@ import sys
 import argparse
 
 import yaml
+import json
 import time
+import contextlib
+import itertools
+import atexit
+import shutil
+import hashlib
+import tempfile
+import tarfile
+import io
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Blender doesn't put the script folder on the path, sibling modules need it
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scene_geometry
+import scene_planner
+import annotation_store
 
 # === ADJUSTABLE VARIABLES ===
 
 HDRI_PATH = "/home/data/raw/[dataset_name]/backgrounds/HDRI" # Example
 OBJ_PATH = "/home/data/raw/[dataset_name]/3d_models" # Example
 OUTPUT_PATH = "/home/data/3D_RP/output" # Example
+ASSET_CACHE_PATH = "/home/data/raw/[dataset_name]/asset_cache" # Example, compiled .blend copies of the 3D models
 
 RANDOM_SEED = 0             # Set the random seed for reproducibility
 
@@ -36,90 +56,161 @@ MAX_TARGET_OBJ = 2          # Maximum target objects appearing in a scene
 MIN_TOTAL_OBJ = 3           # Minimum total objects appearing in a scene
 MAX_TOTAL_OBJ = 6           # Maximum total objects appearing in a scene
 
+CLASS_BALANCE = False       # Pick targets of under-represented classes and models (by the labels produced so far) more often
+BALANCE_STRENGTH = 1.0      # Exponent of the balancing weights (0 picks uniformly, higher corrects faster)
+RUN_ID = ""                 # Only attempts of the same run count towards the balance and quotas (empty: a new id per run)
+CLASS_QUOTAS = {}           # {target class : visible instances}; classes at their quota aren't picked and generation stops once all are met
+
+LAZY_LOADING = False        # Import models the first time they are selected instead of all at startup
+MAX_RESIDENT_MODELS = 200   # Lazy loading: models kept in memory at most (0 for no limit)
+MAX_RESIDENT_MB = 0         # Lazy loading: approximate memory (MB) of resident models at most (0 for no limit)
+LOD_ENABLED = False         # Swap in the decimated levels from convert_ply_to_obj.py (<model>/lod/) by projected size
+LOD_MIN_PIXELS = [256, 96, 32] # Projected size (px) of an object below which LOD 1, 2, 3, ... is rendered
+
 MAX_LIGHT_ENERGY = 50       # Maximum light intensity for the scene
 MIN_EXPOSURE = 0.5          # Minimum exposure rate for hdri backgrounds
 MAX_EXPOSURE = 10           # Maximum exposure rate for hdri backgrounds
+HDRI_CACHE_BUDGET = 2048    # Memory budget (MB) for loaded hdri images; least recently used ones are freed beyond it
+HDRI_INDEX = ""             # hdri_index.json written by preprocess_hdri.py ("" uses <hdri_path>/preprocessed/hdri_index.json if it exists)
+HDRI_MIN_PIXEL_RATIO = 1.0  # Background texels per rendered pixel the chosen hdri variant has to provide at least
+HDRI_TARGET_LUMINANCE = 0.0 # Mean luminance every indexed background is scaled to before the random exposure (0 to keep the original brightness)
 
 RESOLUTION_X = 1920 // 2
 RESOLUTION_Y = 1080 // 2
 
+RENDER_MODE = "bpycv"       # "bpycv" renders image, instances and depth separately; "index_pass" reads instances from the object index pass of the same render
+RENDER_DEPTH = False        # Produce and save depth maps (always computed by bpycv, only on request with "index_pass")
+PERSISTENT_DATA = True      # Keep Cycles' scene data (BVH, textures) between the views of one arrangement
+PERSISTENT_MAX_RSS = 12000  # Render views without persistent data once the resident memory exceeds this (MB, 0 for no limit)
+
+DEVICE = "AUTO"             # Cycles device: "AUTO" (first available GPU backend, else CPU), "CPU", "CUDA", "OPTIX", "HIP", "METAL" or "ONEAPI"
 SAMPLES = 16                # Number of samples per image. The higher the lesser artifacts (Renderer setup)
 TILE_SIZE = 4096            # Tile size for rendering. The higher the faster and more GRU compute (Renderer setup)
+ADAPTIVE_THRESHOLD = 0.01   # Noise threshold of adaptive sampling (0 disables adaptive sampling)
+DENOISER = "OPENIMAGEDENOISE" # Cycles denoiser ("OPENIMAGEDENOISE", "OPTIX") or "NONE"
+
+AUTOTUNE_FRAMES = 3         # Calibration frames rendered for every candidate render configuration
+AUTOTUNE_REFERENCE_SAMPLES = 1024 # Samples of the (not denoised) reference render the noise is measured against
+AUTOTUNE_MAX_NOISE = 0.02   # Highest accepted RMSE (0-1 range) against the reference render
+AUTOTUNE_GRID = {           # Render configurations tried by the autotuner
+    "device": ["AUTO"],
+    "threads": [0],
+    "tile_size": [512, 2048],
+    "samples": [8, 16, 32],
+    "adaptive_threshold": [0.01, 0.05],
+    "denoiser": ["OPENIMAGEDENOISE", "NONE"],
+}
+AUTOTUNE_RESULT = {}        # Filled by the autotuner with the chosen configuration and its measurements
 
 SAVE_FILES = True
 
+IMAGE_FORMAT = "jpg"        # Format of the saved images ("jpg" or "png")
+JPEG_QUALITY = 95           # JPEG quality (0-100) of the saved images
+WRITER_THREADS = 4          # Background threads that encode and write the output files
+WRITER_QUEUE_SIZE = 32      # Frames allowed to wait for the writer before rendering blocks
+
+OUTPUT_FORMAT = "files"     # "files" writes images/ and labels/ folders; "tar" streams frames into WebDataset-style tar shards
+SHARD_MAX_FRAMES = 1000     # Frames per tar shard
+SHARD_MAX_MB = 1024         # A tar shard is also closed once it holds this many MB
+ANNOTATION_STORE = True     # Also write every frame's boxes to the columnar store in attempt_<num>/annotations
+
+PROFILE = True              # Write per-stage timings and memory of every frame to profile_<num>.jsonl
+STARTUP_TIME = 0.0          # Seconds spent setting up the session (clear, render setup, imports), filled in main
+
+MIN_VISIBLE_PIXELS = 0      # Objects with fewer visible pixels than this are not labeled (filters tiny slivers)
+
+PLAN_FILE = ""              # Scene plan of scene_planner.py to render instead of sampling scenes ("" to sample)
+PLAN_SLICE = ""             # Part of the plan rendered by this process, "k/N" for worker k of N ("" for all)
+
+MEMORY_WATERMARK = 16000    # Restart the generation daemon once its resident memory exceeds this (MB)
+
 CENTER = mathutils.Vector((0, 0, 0)) # Center of the box where objects will be placed
 X_RANGE = 0.4 # Range for X-axis
 Y_RANGE = 0.4 # Range for Y-axis
 Z_RANGE = 0.2 # Range for Z-axis
 
+PLACEMENT_MODE = "uniform" # "uniform" places objects anywhere in the box, "non_overlapping" rejects overlapping poses
+PLACEMENT_TOLERANCE = 0.0 # Non-overlapping mode: allowed overlap as a fraction of the smaller bounding box
+PLACEMENT_CANDIDATES = 64 # Non-overlapping mode: poses tested together per object
+PLACEMENT_MAX_BATCHES = 8 # Non-overlapping mode: batches tried before leaving the object out of the scene
+
 RESCALE_SIZE = 0.2 # Mean size for objects after scaling
 EPS = 0.05 # Size deviation for randomness
 
+CAMERA_CANDIDATES = 32 # Viewpoints sampled and scored together
+CAMERA_MAX_BATCHES = 8 # Batches of viewpoints tried before falling back to the best one
+MIN_CAMERA_DISTANCE = 0.4 # Minimum camera-to-object distance, relative to the distance that fits all objects in view
 
+ASSET_CACHE_VERSION = 1 # Bump to rebuild every cached asset after changing how models are normalized
 
-# === DEFINE CAMERA BEHAVIOR ===
-
-def get_viewpoint(center, max_dist):
-    z = 2 * random.random() - 1  # z is in [-1, 1]
-    theta = 2 * np.pi * random.random()
-    r_xy = np.sqrt(1 - z * z)
 
-    x = r_xy * np.cos(theta)
-    y = r_xy * np.sin(theta)
 
-    # Apply radius and center offset
-    pos = (
-        center[0] + max_dist * x,
-        center[1] + max_dist * y,
-        center[2] + max_dist * z
-    )
-    return pos
+# === DEFINE CAMERA BEHAVIOR ===
 
 def look_at(obj, target):
     direction = (target - obj.location).normalized()
     quat = direction.to_track_quat('-Z', 'Y') 
     obj.rotation_euler = quat.to_euler()
 
-def zoom_on_object(camera, center, bbox_corners, depsgraph):
-    # Point camera at the target center
-    look_at(camera, center)
+def get_world_corners(all_objects):
+    # Bounding box corners of every object in world space, shape (n, 8, 3)
+    local = np.array([[tuple(corner) for corner in obj.bound_box] for obj, _label in all_objects])
+    matrices = np.array([[tuple(row) for row in obj.matrix_world] for obj, _label in all_objects])
+    return scene_geometry.transform_points(matrices, local)
 
-    coords = [coord for corner in bbox_corners for coord in corner]
-    
-    # Zoom to where the entire object will fit in view
-    bpy.context.view_layer.update()
-    location, _scale = camera.camera_fit_coords(depsgraph, coords)
-    camera.location = location
+def get_camera_tan_half_fov(camera, scene):
+    return scene_geometry.camera_tan_half_fov(camera.data.angle, camera.data.sensor_fit,
+                                              scene.render.resolution_x, scene.render.resolution_y)
 
-    # Find the line of sight from the camera to the center of the object
-    forward = camera.matrix_world.to_quaternion() @ mathutils.Vector((0.0, 0.0, -1.0))
-    min_distance = (camera.location - center).length
+def sample_camera(corners, centers, all_corners, tan_half_x, tan_half_y):
+    '''
+    Randomly pick an object to focus on and a viewpoint around it. Returns (location, target).
+    '''
+    # Randomly select one object to focus on
+    focus = random.choice(range(len(centers)))
+    center = centers[focus]
+    max_dist = np.linalg.norm(corners[focus] - center, axis=1).max()
 
-    # Randomly zoom in or out
-    fill_ratio = random.uniform(0.3, 1.3)  
-    camera.location += forward - forward / fill_ratio
+    # Score batches of random viewpoints and only move the camera to the chosen one
+    rng = np.random.default_rng(random.getrandbits(64))
+    location, _min_distance, found = scene_geometry.solve_viewpoint(
+        rng, center, max_dist, centers, all_corners, tan_half_x, tan_half_y,
+        num_candidates=CAMERA_CANDIDATES, max_batches=CAMERA_MAX_BATCHES,
+        min_distance_ratio=MIN_CAMERA_DISTANCE)
 
-    # return the minimum distance for future checks
-    return min_distance
+    if not found:
+        print("No viewpoint kept enough distance to every object, using the best candidate")
 
-def distance_too_close(camera, all_objects, min_distance):
-    # Check if the camera is too close to any object
-    for obj, _label in all_objects:
-        bbox_corners = [obj.matrix_world @ mathutils.Vector(corner) for corner in obj.bound_box]
-        center = sum(bbox_corners, mathutils.Vector((0, 0, 0))) / 8
-        distance = (camera.location - center).length
-        
-        if distance < min_distance:
-            return True  # Camera is too close to an object
-        
-    return False  # Camera is at a safe distance from all objects
+    return location, center
+
+def point_camera(camera, corners, centers, all_corners, tan_half_x, tan_half_y):
+    location, center = sample_camera(corners, centers, all_corners, tan_half_x, tan_half_y)
+    camera.location = tuple(location)
+    look_at(camera, mathutils.Vector(tuple(center)))
+
+def select_lods(all_objects, corners, centers, cameras, tan_half_x, resolution_x, min_pixels=LOD_MIN_PIXELS):
+    '''
+    Give every object the level of detail that matches its largest projected size over the
+    (k, 3) camera locations of an arrangement's views, so no mesh changes between the views.
+    '''
+    if not model_catalog.lods or len(cameras) == 0:
+        return
+
+    # Approximate on-screen diameter (px) from the bounding sphere, seen from the nearest camera
+    radii = np.linalg.norm(corners - centers[:, None], axis=2).max(axis=1)
+    distances = np.linalg.norm(centers[:, None] - np.asarray(cameras)[None], axis=2).min(axis=1)
+    distances = np.maximum(distances, 1e-6)
+    pixels = radii / (distances * tan_half_x) * resolution_x
+
+    levels = (pixels[:, None] < np.array(min_pixels, dtype=np.float64)[None, :]).sum(axis=1)
+    for (obj, _label), level in zip(all_objects, levels):
+        model_catalog.set_lod(obj["catalog_index"], int(level))
 
 
 
 # === OBJECTS AUGMENTATION ===
 
-def rescale_object(obj, target_size=RESCALE_SIZE, eps=EPS, apply=True): 
+def rescale_object(obj, target_size=RESCALE_SIZE, eps=EPS, apply=True, rng=random): 
     # Get bounding box corners in world space
     bbox_corners = [obj.matrix_world @ mathutils.Vector(corner) for corner in obj.bound_box]
     
@@ -130,21 +221,27 @@ def rescale_object(obj, target_size=RESCALE_SIZE, eps=EPS, apply=True):
 
     # Calculate and apply the scale factor
     current_size = max(dimensions)
-    final_size = target_size + random.uniform(-eps, eps)
+    final_size = target_size + rng.uniform(-eps, eps)
     scale_factor = final_size / current_size
     obj.scale *= scale_factor
 
     if apply:
+        # transform_apply works on the selection, and appended objects are neither selected nor active
+        for other in bpy.context.selected_objects:
+            other.select_set(False)
+        obj.select_set(True)
+        bpy.context.view_layer.objects.active = obj
+
         bpy.context.view_layer.update()
         bpy.ops.object.transform_apply(location=False, rotation=False, scale=True)
 
-def translate_object(obj, center=CENTER, x_range=X_RANGE, y_range=Y_RANGE, z_range=Z_RANGE):
+def translate_object(obj, center=CENTER, x_range=X_RANGE, y_range=Y_RANGE, z_range=Z_RANGE, rng=random):
     '''
     Randomly place the object inside a cube-shaped area.
     '''
-    x = random.uniform(center.x - x_range, center.x + x_range)
-    y = random.uniform(center.y - y_range, center.y + y_range)
-    z = random.uniform(center.z - z_range, center.z + z_range)
+    x = rng.uniform(center.x - x_range, center.x + x_range)
+    y = rng.uniform(center.y - y_range, center.y + y_range)
+    z = rng.uniform(center.z - z_range, center.z + z_range)
     obj.location = (x, y, z)
 
 def translate_object_on_surface(obj, x_range, y_range, z_range, center=CENTER):
@@ -187,6 +284,28 @@ def translate_object_on_surface(obj, x_range, y_range, z_range, center=CENTER):
 
     obj.location = (x, y, z)
 
+def place_without_overlap(obj, placement_index, tolerance):
+    '''
+    Randomly rotate and place the object inside the cube-shaped area without overlapping
+    the objects already in placement_index. Returns False if no free pose was found.
+    '''
+    # Local bounding box with the object's current scale
+    local_corners = np.array([tuple(corner) for corner in obj.bound_box]) * np.array(tuple(obj.scale))
+
+    rng = np.random.default_rng(random.getrandbits(64))
+    pose = scene_geometry.sample_placement(
+        rng, local_corners, placement_index, np.array(tuple(CENTER)), np.array([X_RANGE, Y_RANGE, Z_RANGE]),
+        num_candidates=PLACEMENT_CANDIDATES, max_batches=PLACEMENT_MAX_BATCHES, tolerance=tolerance)
+
+    if pose is None:
+        return False
+
+    angles, location = pose
+    obj.rotation_mode = 'XYZ'
+    obj.rotation_euler = tuple(angles)
+    obj.location = tuple(location)
+    return True
+
 def rotate_object(obj):
     # Make sure the rotation mode is Euler
     obj.rotation_mode = 'XYZ'
@@ -202,6 +321,98 @@ def rotate_object(obj):
 
 # === ADD AND ADJUST HDRI BACKGROUND ===
 
+class HDRICache:
+    '''
+    Reuse loaded hdri images and free the least recently used ones once over the memory budget.
+    '''
+    def __init__(self, budget_mb=HDRI_CACHE_BUDGET):
+        self.budget_mb = budget_mb
+        self.images = OrderedDict() # {path : (image, size in MB)}
+
+    @staticmethod
+    def image_size_mb(image):
+        width, height = image.size
+        bytes_per_channel = 4 if image.is_float else 1
+        return width * height * image.channels * bytes_per_channel / 2**20
+
+    def total_mb(self):
+        return sum(size for _image, size in self.images.values())
+
+    def get(self, path):
+        if path in self.images:
+            image, _size = self.images[path]
+            try:
+                image.name  # Raises if the datablock was removed behind our back
+                self.images.move_to_end(path)
+                return image
+            except ReferenceError:
+                del self.images[path]
+
+        image = bpy.data.images.load(path, check_existing=True)
+        image.use_fake_user = True  # Keep cached images when orphans are purged
+
+        self.images[path] = (image, self.image_size_mb(image))
+        self.evict()
+
+        return image
+
+    def evict(self):
+        # Always keep the most recently used image
+        while len(self.images) > 1 and self.total_mb() > self.budget_mb:
+            path, (image, size) = self.images.popitem(last=False)
+            print(f"Evicting hdri {os.path.basename(path)} ({size:.0f} MB)")
+            try:
+                bpy.data.images.remove(image)
+            except ReferenceError:
+                pass
+
+hdri_cache = HDRICache()
+
+class HDRIIndex:
+    '''
+    Downscaled variants and mean luminance of the backgrounds, written by preprocess_hdri.py.
+    '''
+    def __init__(self):
+        self.entries = {}           # {hdri name : entry}
+        self.folder = None
+        self.required_width = 0     # Smallest equirectangular width that is sharp enough for the render
+        self.target_luminance = 0.0
+        self.scale = 1.0            # Luminance normalization of the current background
+
+    def load(self, path):
+        self.folder = os.path.dirname(path)
+        with open(path) as f:
+            self.entries = json.load(f)
+        print(f"Loaded {len(self.entries)} preprocessed hdris from {path}")
+
+    def set_required_width(self, camera, scene, min_pixel_ratio):
+        # The render covers the horizontal field of view with resolution_x pixels, the map covers 2 pi
+        tan_half_x, _tan_half_y = get_camera_tan_half_fov(camera, scene)
+        pixels_per_radian = scene.render.resolution_x / (2 * np.arctan(tan_half_x))
+        self.required_width = int(np.ceil(2 * np.pi * pixels_per_radian * min_pixel_ratio))
+
+    def resolve(self, hdri_path):
+        '''
+        The smallest variant of the background that is sharp enough, and its luminance normalization.
+        '''
+        entry = self.entries.get(os.path.basename(hdri_path).split('.')[0])
+        if entry is None:
+            return hdri_path, 1.0
+
+        chosen = hdri_path
+        for width, file_name in sorted((int(w), f) for w, f in entry["variants"].items()):
+            if width >= self.required_width:
+                chosen = os.path.join(self.folder, file_name)
+                break
+
+        scale = 1.0
+        if self.target_luminance > 0 and entry["mean_luminance"] > 0:
+            scale = self.target_luminance / entry["mean_luminance"]
+
+        return chosen, scale
+
+hdri_index = HDRIIndex()
+
 def add_hdri_background(scene, selected_hdri):
     if scene.world is None:
         scene.world = bpy.data.worlds.new("GeneratedWorld")
@@ -225,7 +436,8 @@ def add_hdri_background(scene, selected_hdri):
     # Create Environment Texture (HDRI)
     env_tex = nodes.new(type="ShaderNodeTexEnvironment")
     env_tex.name = "EnvironmentTexture"
-    env_tex.image = bpy.data.images.load(selected_hdri)
+    hdri_file, hdri_index.scale = hdri_index.resolve(selected_hdri)
+    env_tex.image = hdri_cache.get(hdri_file)
     
     # Create Background node
     background = nodes.new(type="ShaderNodeBackground")
@@ -266,151 +478,729 @@ def update_hdri_settings(scene, hdri_path=None, brightness=1):
     multiply = nodes.get("HDRIMultiply")
 
     if hdri_path:
-        env_tex.image = bpy.data.images.load(hdri_path)
+        hdri_file, hdri_index.scale = hdri_index.resolve(hdri_path)
+        env_tex.image = hdri_cache.get(hdri_file)
 
+    # Exposures are relative to the background's normalized luminance
+    brightness *= hdri_index.scale
     multiply.inputs['Color2'].default_value = (brightness, brightness, brightness, 1.0)
 
 
 
-# === RENDER AND SAVE FILES ===
+# === PROFILING ===
+
+class FrameProfiler:
+    '''
+    Per-stage timings and memory of the render loop, written as one JSON record per line.
+    '''
+    def __init__(self):
+        self.file = None
+        self.path = None
+        self.current = None     # Record being filled on the render thread
+        self.stages = {}        # {stage : [seconds]} for the summary
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.stages = {}
+
+    def begin(self, kind, **fields):
+        self.current = dict(type=kind, **fields)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                self.current[name] = self.current.get(name, 0.0) + time.perf_counter() - start_time
+
+    def end(self):
+        record, self.current = self.current, None
+        if record is not None:
+            # Memory is sampled on the render thread, bpy.data is not thread safe
+            record["rss_mb"] = round(get_rss_mb(), 1)
+            record["images"] = len(bpy.data.images)
+            record["meshes"] = len(bpy.data.meshes)
+        return record
+
+    def write(self, record):
+        if self.file is None or record is None:
+            return
+
+        with self.lock:
+            for key, value in record.items():
+                if isinstance(value, float) and key != "rss_mb":
+                    self.stages.setdefault(f"{record['type']}.{key}", []).append(value)
+                    record[key] = round(value, 6)
+
+            self.file.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        '''
+        Percentiles of every stage in milliseconds.
+        '''
+        report = {}
+        for stage, values in self.stages.items():
+            ms = np.array(values) * 1000
+            report[stage] = {
+                "count": int(ms.size),
+                "mean": round(float(ms.mean()), 2),
+                "p50": round(float(np.percentile(ms, 50)), 2),
+                "p90": round(float(np.percentile(ms, 90)), 2),
+                "p99": round(float(np.percentile(ms, 99)), 2),
+                "max": round(float(ms.max()), 2),
+                "total_s": round(float(ms.sum()) / 1000, 2),
+            }
+        return report
+
+    def close(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+        report = self.summary()
+
+        # Summary next to the records
+        summary_path = os.path.splitext(self.path)[0] + "_summary.yaml"
+        with open(summary_path, "w") as f:
+            yaml.dump(report, f, sort_keys=False)
+
+        print(f"{'stage':<32}{'count':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}  (ms)")
+        for stage, row in report.items():
+            print(f"{stage:<32}{row['count']:>8}{row['mean']:>10}{row['p50']:>10}{row['p90']:>10}{row['p99']:>10}")
+        print(f"Profile: {self.path}\n")
+
+profiler = FrameProfiler()
+
+
+
+# === CHECKPOINTS ===
+
+def derive_seed(*parts):
+    '''
+    64-bit seed of one unit of work, e.g. (seed, iteration, arrangement, view), so any frame
+    can be rendered again without replaying the frames before it.
+    '''
+    digest = hashlib.sha256("/".join(str(part) for part in parts).encode()).digest()
+    return int.from_bytes(digest[:8], "little")
 
-def get_bounding_box_for_all(all_objects):
-    # Initialize min and max coordinates
-    min_coord = mathutils.Vector((float('inf'), float('inf'), float('inf')))
-    max_coord = mathutils.Vector((float('-inf'), float('-inf'), float('-inf')))
+def frame_name(atmpt, seed, iter, arngmnt, view):
+    return f"{atmpt}({seed})_{iter+1}_{arngmnt+1}_{view+1}"
 
-    # Loop through all mesh objects
-    for obj, _label in all_objects:
-        for vertex in obj.bound_box:
-            world_vertex = obj.matrix_world @ mathutils.Vector(vertex)
-            min_coord.x = min(min_coord.x, world_vertex.x)
-            min_coord.y = min(min_coord.y, world_vertex.y)
-            min_coord.z = min(min_coord.z, world_vertex.z)
-
-            max_coord.x = max(max_coord.x, world_vertex.x)
-            max_coord.y = max(max_coord.y, world_vertex.y)
-            max_coord.z = max(max_coord.z, world_vertex.z)
-
-    # Calculate the corners of the bounding box
-    all_corners = [
-        mathutils.Vector((min_coord.x, min_coord.y, min_coord.z)),
-        mathutils.Vector((min_coord.x, min_coord.y, max_coord.z)),
-        mathutils.Vector((min_coord.x, max_coord.y, min_coord.z)),
-        mathutils.Vector((min_coord.x, max_coord.y, max_coord.z)),
-        mathutils.Vector((max_coord.x, min_coord.y, min_coord.z)),
-        mathutils.Vector((max_coord.x, min_coord.y, max_coord.z)),
-        mathutils.Vector((max_coord.x, max_coord.y, min_coord.z)),
-        mathutils.Vector((max_coord.x, max_coord.y, max_coord.z)),
-    ]
+class FrameManifest:
+    '''
+    Append-only manifest.jsonl of the frames of an attempt whose files are completely on disk.
+    '''
+    def __init__(self):
+        self.file = None
+        self.done = set()
+        self.lock = threading.Lock()
 
-    return all_corners
+    def open(self, path):
+        self.done = set()
 
-def capture_views(camera, scene, depsgraph, selected_targets, selected_distractors, 
-                  atmpt, iter, seed, arngmnt, all_classes, num_pics, 
-                  min_exposure, max_exposure, output_folder, save_files):
-    
-    # Get the bounding box for all objects (so that the camera can zoom out to fit)
-    all_objects = selected_targets + selected_distractors
-    all_corners = get_bounding_box_for_all(all_objects)
-    
-    # Iterate through the number of pictures to take
-    for i in range(num_pics):
-        # Randomly select one object to focus on
-        focus_obj, _label = random.choice(all_objects)
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+
+                # Drop a line cut short by a crash so the next entry starts on its own line
+                if data and not data.endswith(b"\n"):
+                    data = data[:data.rfind(b"\n") + 1]
+                    f.truncate(len(data))
+
+            for line in data.decode().splitlines():
+                self.done.add(json.loads(line)["frame"])
+
+        self.file = open(path, "a")
+
+    def add(self, entry):
+        if self.file is None:
+            return
+
+        with self.lock:
+            # One write per line, synced before the frame counts as done
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.done.add(entry["frame"])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+manifest = FrameManifest()
+
+
+
+# === BACKGROUND FILE WRITER ===
+
+def write_atomic(path, data):
+    '''
+    Write next to the final file first so a crash never leaves a partial file behind.
+    '''
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def encode_image(image, file_name, image_format, jpeg_quality):
+    # Transfer RGB image to opencv's BGR
+    params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if image_format == "jpg" else []
+    ok, encoded = cv2.imencode(f".{image_format}", image[..., ::-1], params)
+    if not ok:
+        raise RuntimeError(f"Failed to encode {file_name} as {image_format}")
+    return encoded.tobytes()
+
+def format_labels(bboxes):
+    lines = []
+    for annotation in bboxes:
+        x_center, y_center, width, height = annotation["bbox"]
+        lines.append(f"{annotation['label']} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
+    return "".join(lines)
+
+def write_frame(output_folder, file_name, image, bboxes, image_format, jpeg_quality, depth=None):
+    '''
+    Save one frame and return the time spent encoding and writing it.
+    '''
+    # === SAVE THE IMAGE ===
+
+    # Make sure the image folder exists
+    img_path = os.path.join(output_folder, "images")
+    os.makedirs(img_path, exist_ok=True)
+
+    # Encode the image
+    start_time = time.perf_counter()
+    encoded = encode_image(image, file_name, image_format, jpeg_quality)
+    encode_time = time.perf_counter() - start_time
+
+    # Save the image
+    start_time = time.perf_counter()
+    img_file_path = os.path.join(img_path, f"{file_name}.{image_format}")
+
+    write_atomic(img_file_path, encoded)
+
+    # === SAVE THE LABEL ===
+
+    # Make sure the labels folder exists
+    label_path = os.path.join(output_folder, "labels")
+    os.makedirs(label_path, exist_ok=True)
+
+    # Save the annotation file
+    label_file_path = os.path.join(label_path, f"{file_name}.txt")
 
-        # Get bounding box corners in world space
-        bbox_corners = [focus_obj.matrix_world @ mathutils.Vector(corner) for corner in focus_obj.bound_box]
+    write_atomic(label_file_path, format_labels(bboxes).encode())
 
-        # Get center and size
-        center = sum(bbox_corners, mathutils.Vector((0, 0, 0))) / 8
-        max_dist = max((corner - center).length for corner in bbox_corners)
+    # === SAVE THE DEPTH (only when requested) ===
 
-        # Get a random viewpoint and distance
-        camera.location = get_viewpoint(center, max_dist)
-        min_distance = zoom_on_object(camera, center, all_corners, depsgraph)
+    if depth is not None:
+        depth_path = os.path.join(output_folder, "depth")
+        os.makedirs(depth_path, exist_ok=True)
+        depth_file_path = os.path.join(depth_path, f"{file_name}.npy")
+        with open(f"{depth_file_path}.tmp", "wb") as f:
+            np.save(f, depth)
+        os.replace(f"{depth_file_path}.tmp", depth_file_path)
 
-        # If the camera is too close to any object, get a new viewpoint
-        while distance_too_close(camera, selected_targets + selected_distractors, min_distance * 0.4):
-            camera.location = get_viewpoint(center, max_dist)
-            min_distance = zoom_on_object(camera, center, all_corners, depsgraph)
+    return {"encode": encode_time, "write": time.perf_counter() - start_time}
 
-        # Change the exposure of the background
-        if random.random() < 0.5:
-            brightness = random.uniform(min_exposure, 1)
+def write_frame_to_shard(shards, output_folder, file_name, image, bboxes, image_format, jpeg_quality,
+                         depth=None, entry=None):
+    '''
+    Add one frame to the open tar shard and return the time spent encoding and writing it.
+    '''
+    start_time = time.perf_counter()
+
+    # WebDataset groups the files of a sample by the key before the first dot
+    key = f"{os.path.basename(output_folder)}/{file_name}"
+    files = {
+        image_format: encode_image(image, file_name, image_format, jpeg_quality),
+        "txt": format_labels(bboxes).encode(),
+        "json": json.dumps(entry or {"frame": file_name}).encode(),
+    }
+
+    if depth is not None:
+        buffer = io.BytesIO()
+        np.save(buffer, depth)
+        files["depth.npy"] = buffer.getvalue()
+
+    encode_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    shards.add(key, files, entry)
+    return {"encode": encode_time, "write": time.perf_counter() - start_time}
+
+class ShardWriter:
+    '''
+    Stream frames into fixed-size tar shards under shards/. A shard is written as .tar.tmp and
+    only renamed, indexed and added to the manifest once it is complete, so readers can
+    consume finished shards while generation continues.
+    '''
+    def __init__(self, max_frames=SHARD_MAX_FRAMES, max_mb=SHARD_MAX_MB):
+        self.max_frames = max_frames
+        self.max_bytes = max_mb * 1024 * 1024
+        self.folder = None
+        self.prefix = None
+        self.number = 0
+        self.tar = None
+        self.lock = threading.Lock()
+
+    def open(self, output_folder, prefix):
+        self.folder = os.path.join(output_folder, "shards")
+        self.prefix = prefix
+        os.makedirs(self.folder, exist_ok=True)
+
+        # A shard left open by a crash is incomplete, its frames are not in the manifest
+        for tmp_path in glob.glob(os.path.join(self.folder, "*.tar.tmp")):
+            os.remove(tmp_path)
+
+        # Continue the numbering when resuming
+        self.number = len(glob.glob(os.path.join(self.folder, f"{prefix}-*.tar")))
+
+    def _shard_path(self):
+        return os.path.join(self.folder, f"{self.prefix}-{self.number:06d}.tar")
+
+    def _start(self):
+        self.tar = tarfile.open(f"{self._shard_path()}.tmp", "w")
+        self.keys = []
+        self.entries = []
+        self.size = 0
+
+    def _finalize(self):
+        if self.tar is None:
+            return
+
+        self.tar.close()
+        self.tar = None
+
+        shard_path = self._shard_path()
+        with open(f"{shard_path}.tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(f"{shard_path}.tmp", shard_path)
+
+        shard_name = os.path.basename(shard_path)
+        with open(os.path.join(self.folder, "index.jsonl"), "a") as f:
+            f.write(json.dumps({"shard": shard_name, "frames": len(self.keys),
+                                "bytes": os.path.getsize(shard_path), "keys": self.keys}) + "\n")
+
+        # The frames only count as done once their shard is final
+        for entry in self.entries:
+            if entry is not None:
+                manifest.add(dict(entry, shard=shard_name))
+
+        self.number += 1
+
+    def add(self, key, files, entry=None):
+        with self.lock:
+            if self.tar is None:
+                self._start()
+
+            for ext, data in files.items():
+                info = tarfile.TarInfo(f"{key}.{ext}")
+                info.size = len(data)
+                info.mtime = int(time.time())
+                self.tar.addfile(info, io.BytesIO(data))
+                self.size += len(data)
+
+            self.keys.append(key)
+            self.entries.append(entry)
+
+            if len(self.keys) >= self.max_frames or self.size >= self.max_bytes:
+                self._finalize()
+
+    def close(self):
+        with self.lock:
+            self._finalize()
+
+shard_writer = ShardWriter()
+
+class AsyncWriter:
+    '''
+    Encode and write frames on a bounded thread pool so the render loop doesn't wait on I/O.
+    '''
+    def __init__(self, num_threads=WRITER_THREADS, queue_size=WRITER_QUEUE_SIZE,
+                 image_format=IMAGE_FORMAT, jpeg_quality=JPEG_QUALITY, shards=None):
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        self.shards = shards    # ShardWriter when frames go into tar shards instead of files
+        self.annotations = None # AnnotationStoreWriter of the current attempt
+
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.errors = []
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        self.slots.release()
+
+    def _raise_errors(self):
+        with self.lock:
+            if self.errors:
+                raise self.errors[0]
+
+    def _write(self, output_folder, file_name, image, bboxes, depth, record, entry):
+        # The store skips frames it already holds, so a resumed frame is never added twice.
+        # It is committed once per arrangement and on flush, not per frame
+        if self.annotations is not None:
+            self.annotations.add(f"{os.path.basename(output_folder)}/{file_name}", bboxes, commit=False)
+
+        if self.shards is not None:
+            # The shard adds its frames to the manifest when it is finalized
+            timings = write_frame_to_shard(self.shards, output_folder, file_name, image, bboxes,
+                                           self.image_format, self.jpeg_quality, depth, entry)
         else:
-            brightness = random.uniform(1, max_exposure)
-        update_hdri_settings(scene, brightness=brightness)
+            timings = write_frame(output_folder, file_name, image, bboxes, self.image_format, self.jpeg_quality, depth)
 
-        print(f"\n-------------------- Attempt {atmpt}; Iteration {iter+1}; Arrangment {arngmnt+1}; View angle {i+1} --------------------\n")
-        
-        # Set up objects isntance id for BOTH targets and non-targets
-        index = 0
-        for obj, label in selected_targets + selected_distractors:
-            obj["inst_id"] = (all_classes.index(label) + 1) * 1000 + index
-            index += 1
+            # Only frames with every file in place go into the manifest
+            if entry is not None:
+                manifest.add(entry)
 
-        # render image, instance annoatation and depth
-        result = bpycv.render_data()
+        # The frame's profile record is complete once it is on disk
+        if record is not None:
+            record.update(timings)
+            profiler.write(record)
 
-        # Get instance map from the result
-        inst_map = result["inst"]
-        h, w = inst_map.shape
+    def submit(self, output_folder, file_name, image, bboxes, depth=None, record=None, entry=None):
+        self._raise_errors()
 
-        bboxes = dict()
+        # Backpressure: block the render loop while the queue is full
+        self.slots.acquire()
 
-        # Get bounding box annotations for BOTH targets and non-targets
-        for obj, label in selected_targets + selected_distractors:
-            inst_id = obj["inst_id"]
+        future = self.pool.submit(self._write, output_folder, file_name, image, bboxes, depth, record, entry)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
 
-            ys, xs = np.where(inst_map == inst_id)
-            if xs.size == 0 or ys.size == 0:
-                # No pixels for this object — skip it
-                continue
-            minX, maxX = xs.min() / w, xs.max() / w
-            minY, maxY = ys.min() / h, ys.max() / h
+    def flush(self):
+        '''
+        Wait until every submitted frame is on disk.
+        '''
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()  # Wait without raising, errors are collected in _done
+
+        self.commit()
+        self._raise_errors()
+
+    def commit(self):
+        '''
+        Commit the annotations of the frames written so far.
+        '''
+        if self.annotations is not None:
+            self.annotations.commit()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+
+# === RENDER AND SAVE FILES ===
+
+def assign_instance_ids(all_objects, all_classes):
+    index = 0
+    for obj, label in all_objects:
+        obj["inst_id"] = (all_classes.index(label) + 1) * 1000 + index
+        index += 1
+
+        # Compact pass indices 1..n for the "index_pass" render mode, set once per arrangement
+        # since a changed object property invalidates the persistent render data
+        obj.pass_index = index
 
-            # Convert to YOLO format
-            x_center = (minX + maxX) / 2
-            y_center = (minY + maxY) / 2
-            width = maxX - minX
-            height = maxY - minY
+render_tmp_folder = None # Scratch folder of the "index_pass" render mode
 
-            # Store label {bbox : label}
-            bboxes.update({
-                (x_center, y_center, width, height) : label
-            })
+def setup_index_pass(scene, depth=False):
+    '''
+    Route the object index pass (and depth if requested) of the normal render to EXR files,
+    so one Cycles render gives both the image and the instance map.
+    '''
+    global render_tmp_folder
+    render_tmp_folder = tempfile.mkdtemp(prefix="3d_rp_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    atexit.register(shutil.rmtree, render_tmp_folder, ignore_errors=True)
+
+    view_layer = scene.view_layers[0]
+    view_layer.use_pass_object_index = True
+    view_layer.use_pass_z = depth
+
+    # Compositor: image to the render result, passes to a file output node
+    scene.use_nodes = True
+    tree = scene.node_tree
+    tree.nodes.clear()
+
+    render_layers = tree.nodes.new(type="CompositorNodeRLayers")
+    composite = tree.nodes.new(type="CompositorNodeComposite")
+    tree.links.new(render_layers.outputs["Image"], composite.inputs["Image"])
+
+    file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+    file_output.base_path = render_tmp_folder
+    file_output.format.file_format = 'OPEN_EXR'
+    file_output.format.color_depth = '32'
+    file_output.format.exr_codec = 'NONE'
+    file_output.file_slots[0].path = "index_"
+    tree.links.new(render_layers.outputs["IndexOB"], file_output.inputs[0])
+
+    if depth:
+        file_output.file_slots.new("depth_")
+        tree.links.new(render_layers.outputs["Depth"], file_output.inputs["depth_"])
+
+    # The image itself is written uncompressed next to the passes
+    scene.render.image_settings.file_format = 'PNG'
+    scene.render.image_settings.color_mode = 'RGB'
+    scene.render.image_settings.color_depth = '8'
+    scene.render.image_settings.compression = 0
+    scene.render.use_file_extension = True
+    scene.render.filepath = os.path.join(render_tmp_folder, "image")
+
+def read_exr_channel(path):
+    # Load through Blender so no OpenEXR support is needed in OpenCV
+    image = bpy.data.images.load(path)
+    image.colorspace_settings.name = 'Non-Color'
+
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+
+    # Blender stores rows bottom-up
+    return pixels.reshape(height, width, -1)[::-1, :, 0]
+
+def render_frame(scene, all_objects):
+    if RENDER_MODE == "bpycv":
+        return bpycv.render_data()
+
+    # Map the pass indices (see assign_instance_ids) back to the instance ids
+    inst_lookup = np.zeros(len(all_objects) + 1, dtype=np.int64)
+    for obj, _label in all_objects:
+        inst_lookup[obj.pass_index] = obj["inst_id"]
+
+    bpy.ops.render.render(write_still=True)
+
+    frame = scene.frame_current
+    image = cv2.imread(scene.render.filepath + ".png", cv2.IMREAD_COLOR)[..., ::-1]  # opencv's BGR to RGB
+    index_map = read_exr_channel(os.path.join(render_tmp_folder, f"index_{frame:04d}.exr"))
+
+    result = {
+        "image": np.ascontiguousarray(image),
+        "inst": inst_lookup[np.clip(np.rint(index_map).astype(np.int64), 0, len(all_objects))],
+    }
 
-        if save_files:
-            file_name = f"{atmpt}({seed})_{iter+1}_{arngmnt+1}_{i+1}"
+    if RENDER_DEPTH:
+        result["depth"] = read_exr_channel(os.path.join(render_tmp_folder, f"depth_{frame:04d}.exr"))
 
-            # === SAVE THE IMAGE ===
+    return result
 
-            # Make sure the image folder exists
-            img_path = os.path.join(output_folder, "images")
-            os.makedirs(img_path, exist_ok=True)
+def get_instance_stats(inst_map):
+    '''
+    Compute pixel bounds and visible area of every instance id in one pass over the map.
+    Returns {inst_id: (min_x, max_x, min_y, max_y, num_pixels)} in pixel units.
+    '''
+    h, w = inst_map.shape
+    flat = inst_map.ravel().astype(np.int64, copy=False)
+
+    # Map instance ids to compact labels 0..n-1
+    if flat.size and flat.min() >= 0:
+        pixel_counts = np.bincount(flat)
+        ids = np.flatnonzero(pixel_counts)
+        lookup = np.zeros(pixel_counts.size, dtype=np.int64)
+        lookup[ids] = np.arange(ids.size)
+        labels = lookup[flat].reshape(h, w)
+        pixel_counts = pixel_counts[ids]
+    else:
+        ids, labels, pixel_counts = np.unique(flat, return_inverse=True, return_counts=True)
+        labels = labels.reshape(h, w)
+    n = ids.size
+
+    # Which rows and columns each label occupies
+    rows = np.bincount((labels * h + np.arange(h)[:, None]).ravel(), minlength=n * h).reshape(n, h) > 0
+    cols = np.bincount((labels * w + np.arange(w)[None, :]).ravel(), minlength=n * w).reshape(n, w) > 0
+
+    min_y = rows.argmax(axis=1)
+    max_y = h - 1 - rows[:, ::-1].argmax(axis=1)
+    min_x = cols.argmax(axis=1)
+    max_x = w - 1 - cols[:, ::-1].argmax(axis=1)
+
+    return {
+        int(inst_id): (int(min_x[i]), int(max_x[i]), int(min_y[i]), int(max_y[i]), int(pixel_counts[i]))
+        for i, inst_id in enumerate(ids)
+    }
+
+def get_bboxes(all_objects, inst_map):
+    h, w = inst_map.shape
+
+    # A list, so objects with identical boxes keep one label each
+    bboxes = []
+
+    # Pixel bounds and visible area of all instances at once
+    inst_stats = get_instance_stats(inst_map)
+
+    # Get bounding box annotations for BOTH targets and non-targets
+    for obj, label in all_objects:
+        inst_id = obj["inst_id"]
+
+        if inst_id not in inst_stats:
+            # No pixels for this object — skip it
+            continue
+
+        min_x, max_x, min_y, max_y, num_pixels = inst_stats[inst_id]
+        if num_pixels < MIN_VISIBLE_PIXELS:
+            # Only a sliver is visible — skip it
+            continue
+
+        minX, maxX = min_x / w, max_x / w
+        minY, maxY = min_y / h, max_y / h
+
+        # Convert to YOLO format
+        x_center = (minX + maxX) / 2
+        y_center = (minY + maxY) / 2
+        width = maxX - minX
+        height = maxY - minY
+
+        bboxes.append({
+            "label": label,
+            "class_id": ALL_CLASSES.index(label),
+            "inst_id": inst_id,
+            "bbox": (x_center, y_center, width, height),
+            "pixels": num_pixels,
+        })
+
+    return bboxes
+
+@contextlib.contextmanager
+def persistent_views(scene, enabled, max_rss_mb):
+    '''
+    Keep the render data of the arrangement alive between its views, and free it before the objects move.
+    '''
+    use_persistent = enabled and not (max_rss_mb > 0 and get_rss_mb() > max_rss_mb)
+    if enabled and not use_persistent:
+        print(f"Resident memory above {max_rss_mb} MB, rendering views without persistent data")
+
+    scene.render.use_persistent_data = use_persistent
+    try:
+        yield use_persistent
+    finally:
+        # Switching it off frees the data held by the render engine
+        scene.render.use_persistent_data = False
+
+def capture_views(camera, scene, selected_targets, selected_distractors, 
+                  atmpt, iter, seed, arngmnt, all_classes, num_pics, 
+                  min_exposure, max_exposure, output_folder, save_files, writer, base_seed, views=None):
+    
+    # Object centers and extents are computed once per arrangement
+    all_objects = selected_targets + selected_distractors
+    corners = get_world_corners(all_objects)
+    centers = corners.mean(axis=1)
 
-            # Save the image
-            img_file_path = os.path.join(img_path, f"{file_name}.jpg")
+    # The bounding box for all objects (so that the camera can zoom out to fit)
+    all_corners = scene_geometry.aabb_corners(corners)
+    tan_half_x, tan_half_y = get_camera_tan_half_fov(camera, scene)
 
-            cv2.imwrite(
-                img_file_path, result["image"][..., ::-1]
-            )  # transfer RGB image to opencv's BGR
+    # Set up objects isntance id and pass index for BOTH targets and non-targets (the same for every view)
+    assign_instance_ids(all_objects, all_classes)
 
-            # === SAVE THE LABEL ===
+    # Camera and exposure of every view still to render (or the planned ones), drawn up front so
+    # the levels of detail are picked once for the whole arrangement
+    profiler.begin("views", attempt=atmpt, iteration=iter+1, arrangement=arngmnt+1)
+    pending = []
+    for i in range(num_pics):
+        file_name = frame_name(atmpt, seed, iter, arngmnt, i)
 
-            # Make sure the labels folder exists
-            label_path = os.path.join(output_folder, "labels")
-            os.makedirs(label_path, exist_ok=True)
+        # Already on disk from an earlier (interrupted) run
+        if file_name in manifest.done:
+            continue
 
-            # Save the annotation file
-            label_file_path = os.path.join(label_path, f"{file_name}.txt")
+        # Every view has its own random stream, so skipping views doesn't shift the others
+        frame_seed = derive_seed(base_seed, iter, arngmnt, i)
+        if views:
+            view = views[i]
+        else:
+            random.seed(frame_seed)
+            with profiler.stage("camera"):
+                location, target = sample_camera(corners, centers, all_corners, tan_half_x, tan_half_y)
+            view = {"camera": location, "target": target, "exposure": sample_exposure(min_exposure, max_exposure)}
+        pending.append((i, file_name, frame_seed, view))
+
+    # Swapping meshes between views would make the render engine sync the geometry again
+    if LOD_ENABLED:
+        with profiler.stage("lod"):
+            select_lods(all_objects, corners, centers, [view["camera"] for *_rest, view in pending],
+                        tan_half_x, RESOLUTION_X, LOD_MIN_PIXELS)
+    profiler.write(profiler.end())
+
+    with persistent_views(scene, PERSISTENT_DATA, PERSISTENT_MAX_RSS) as use_persistent:
+        for i, file_name, frame_seed, view in pending:
+            capture_view(camera, scene, all_objects, atmpt, iter, arngmnt, i, file_name, frame_seed,
+                         output_folder, save_files, writer, use_persistent, view)
+
+            # Memory grew during the views: drop the kept data and render the rest without it
+            if use_persistent and PERSISTENT_MAX_RSS > 0 and get_rss_mb() > PERSISTENT_MAX_RSS:
+                print(f"Resident memory above {PERSISTENT_MAX_RSS} MB, disabling persistent data")
+                scene.render.use_persistent_data = use_persistent = False
+
+def sample_exposure(min_exposure, max_exposure):
+    # As likely darker as brighter than the original background
+    if random.random() < 0.5:
+        return random.uniform(min_exposure, 1)
+    return random.uniform(1, max_exposure)
+
+def capture_view(camera, scene, all_objects, atmpt, iter, arngmnt, i, file_name, frame_seed,
+                 output_folder, save_files, writer, use_persistent, view):
+    profiler.begin("frame", attempt=atmpt, iteration=iter+1, arrangement=arngmnt+1, view=i+1,
+                   persistent=use_persistent)
+
+    # Move the camera to the sampled (or planned) viewpoint
+    with profiler.stage("look_at"):
+        camera.location = tuple(view["camera"])
+        look_at(camera, mathutils.Vector(tuple(view["target"])))
+
+    # Change the exposure of the background
+    with profiler.stage("exposure"):
+        update_hdri_settings(scene, brightness=view["exposure"])
+
+    print(f"\n-------------------- Attempt {atmpt}; Iteration {iter+1}; Arrangment {arngmnt+1}; View angle {i+1} --------------------\n")
+
+    # render image, instance annoatation (and depth)
+    with profiler.stage("render"):
+        result = render_frame(scene, all_objects)
+
+    # Get bounding box annotations from the instance map
+    with profiler.stage("bbox"):
+        bboxes = get_bboxes(all_objects, result["inst"])
+
+    if CLASS_BALANCE or CLASS_QUOTAS:
+        class_balancer.update(bboxes, {obj["inst_id"]: obj["catalog_index"] for obj, _label in all_objects})
+
+    record = profiler.end()
 
-            with open(label_file_path, "w") as f:
-                for bbox, label in bboxes.items():
-                    x_center, y_center, width, height = bbox
-                    f.write(f"{label} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
+    if save_files:
+        entry = {
+            "frame": file_name,
+            "folder": os.path.basename(output_folder),
+            "iteration": iter+1,
+            "arrangement": arngmnt+1,
+            "view": i+1,
+            "seed": frame_seed,
+            "objects": len(bboxes),
+        }
+
+        # Encoding and writing happen in the background
+        writer.submit(output_folder, file_name, result["image"], bboxes,
+                      result.get("depth") if RENDER_DEPTH else None, record, entry)
+    else:
+        profiler.write(record)
 
-        print()
+    print()
 
 
 
@@ -442,11 +1232,336 @@ def add_default_obj(scene):
 
     return camera_object, light_object
 
-def import_obj(scene, obj_path):
+def hash_model_folder(obj_folder):
+    '''
+    Hash every file of a model (obj, mtl, textures) together with the normalization settings.
+    '''
+    sha = hashlib.sha1(f"{ASSET_CACHE_VERSION}_{RESCALE_SIZE}".encode())
+
+    for file_path in sorted(glob.glob(os.path.join(obj_folder, "**", "*"), recursive=True)):
+        if not os.path.isfile(file_path):
+            continue
+
+        sha.update(os.path.relpath(file_path, obj_folder).encode())
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+
+    return sha.hexdigest()[:16]
+
+def import_obj_file(file_path, obj_name):
+    # Import the object 
+    bpy.ops.wm.obj_import(filepath=file_path)
+    
+    # Rename the object to the folder name (optional)
+    new_obj = bpy.context.view_layer.objects.active
+    new_obj.name = obj_name  
+
+    # Set the origin to center  (optional)
+    bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='BOUNDS')
+
+    return new_obj
+
+def compile_asset(file_path, obj_name, cache_file):
+    '''
+    Import a model once, normalize it and save it with its materials into a .blend library.
+    '''
+    new_obj = import_obj_file(file_path, obj_name)
+
+    # Exactly RESCALE_SIZE: every arrangement rescales it again with the seeded stream
+    rescale_object(new_obj, eps=0)
+
+    # Pack the textures so the library doesn't depend on the source folder
+    for slot in new_obj.material_slots:
+        if slot.material is None or slot.material.node_tree is None:
+            continue
+        for node in slot.material.node_tree.nodes:
+            if node.type == 'TEX_IMAGE' and node.image is not None and not node.image.packed_file:
+                node.image.pack()
+
+    # Write next to the final file first so readers never see a partial library
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    bpy.data.libraries.write(tmp_file, {new_obj}, fake_user=True, compress=True)
+    os.replace(tmp_file, cache_file)
+
+    print(f"Compiled {obj_name} -> {cache_file}")
+    return new_obj
+
+def load_cached_asset(cache_file, obj_name):
+    # Append (not link) since the meshes are rescaled in place later
+    with bpy.data.libraries.load(cache_file, link=False) as (data_from, data_to):
+        data_to.objects = list(data_from.objects)
+
+    new_obj = data_to.objects[0]
+    new_obj.name = obj_name
+    return new_obj
+
+def load_model(file_path, class_name, obj_name, asset_cache_path=None):
+    if not asset_cache_path:
+        return import_obj_file(file_path, obj_name)
+
+    # Cached entries are keyed by the hash of the source files
+    obj_folder = os.path.dirname(file_path)
+    cache_folder = os.path.join(asset_cache_path, class_name)
+    cache_file = os.path.join(cache_folder, f"{obj_name}_{hash_model_folder(obj_folder)}.blend")
+
+    if os.path.exists(cache_file):
+        return load_cached_asset(cache_file, obj_name)
+
+    # The source changed (or was never compiled): drop stale entries and rebuild
+    stale_pattern = re.compile(re.escape(obj_name) + r"_[0-9a-f]{16}\.blend")
+    for stale_file in glob.glob(os.path.join(cache_folder, "*.blend")):
+        if stale_pattern.fullmatch(os.path.basename(stale_file)):
+            os.remove(stale_file)
+
+    return compile_asset(file_path, obj_name, cache_file)
+
+# Randomness of model loads only, kept apart from the seeded scene sampling stream
+model_catalog_rng = random.Random(0)
+
+class ModelCatalog:
+    '''
+    Index of every model under the objects folder. Models are imported when first requested
+    and the least recently used ones are unloaded once over the resident limits.
+    '''
+    def __init__(self):
+        self.asset_cache_path = None
+        self.max_resident = 0
+        self.max_resident_mb = 0
+
+        self.entries = []           # [(label, obj_name, file_path)]
+        self.objects = []           # Loaded object per entry, None while not resident
+        self.by_label = {}          # {label : [entry indices]}
+        self.by_name = {}           # {(label, obj_name) : entry index}
+        self.collections = {}       # {label : class collection}
+        self.resident = OrderedDict() # {entry index : approximate size in MB}, least recently used first
+
+        # Compact index built once after import (see build_index)
+        self.class_ids = np.zeros(0, dtype=np.int16)            # Class id per entry
+        self.dims = np.zeros((0, 3), dtype=np.float32)          # Bounding box dimensions per entry, NaN while not loaded
+        self.target_indices = np.zeros(0, dtype=np.int64)       # Entries of the target classes
+        self.distractor_indices = np.zeros(0, dtype=np.int64)   # Entries of all other classes
+        self.visible = set()                                    # Entries currently visible to the renderer
+
+        # Level of detail (see convert_ply_to_obj.py)
+        self.use_lods = False
+        self.lods = {}              # {entry index : [mesh of LOD 0, 1, ...]}, only models that have levels
+        self.lod_levels = {}        # {entry index : level currently assigned to the object}
+
+    def add(self, label, obj_name, file_path):
+        self.by_label.setdefault(label, []).append(len(self.entries))
+        self.by_name[(label, obj_name)] = len(self.entries)
+        self.entries.append((label, obj_name, file_path))
+        self.objects.append(None)
+
+    @staticmethod
+    def model_size_mb(mesh):
+        size = len(mesh.vertices) * 32 + len(mesh.loops) * 24 + len(mesh.polygons) * 16
+
+        for material in mesh.materials:
+            if material is None or material.node_tree is None:
+                continue
+            for node in material.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image is not None:
+                    width, height = node.image.size
+                    size += width * height * node.image.channels * (4 if node.image.is_float else 1)
+
+        return size / 2**20
+
+    def build_index(self, target_classes, all_classes):
+        self.class_ids = np.array([all_classes.index(label) for label, _name, _file in self.entries], dtype=np.int16)
+        self.dims = np.full((len(self.entries), 3), np.nan, dtype=np.float32)
+
+        # Same order as the collections were walked before: by class, then by import order
+        self.target_indices = np.array(
+            [index for label in target_classes for index in self.by_label.get(label, [])], dtype=np.int64)
+        self.distractor_indices = np.array(
+            [index for label in all_classes if label not in target_classes for index in self.by_label.get(label, [])], dtype=np.int64)
+
+        # Hide everything once, afterwards only the changes are toggled
+        for index in self.resident:
+            self.objects[index].hide_render = True
+            self.update_dims(index)
+        self.visible = set()
+
+    def update_dims(self, index):
+        if index < len(self.dims):
+            self.dims[index] = tuple(self.objects[index].dimensions)
+
+    def label(self, index):
+        return self.entries[index][0]
+
+    def show_only(self, indices):
+        '''
+        Make exactly these entries visible, touching only objects whose visibility changes.
+        '''
+        indices = set(indices)
+
+        for index in self.visible - indices:
+            if self.objects[index] is not None:
+                self.objects[index].hide_render = True
+
+        for index in indices - self.visible:
+            self.objects[index].hide_render = False
+
+        self.visible = indices
+
+    def load(self, index):
+        label, obj_name, file_path = self.entries[index]
+
+        # Import the object, or append it from the asset cache
+        new_obj = load_model(file_path, label, obj_name, self.asset_cache_path)
+        
+        # Unlink from the default collection (if any)
+        for coll in new_obj.users_collection:
+            coll.objects.unlink(new_obj)
+        
+        # Link the object to its class collection
+        self.collections[label].objects.link(new_obj)
+
+        # Move the object away from the origin to avoid unintentional occlusion. Loads depend on
+        # the cache and the resident limits, so they draw from their own stream, not the seeded one
+        translate_object(new_obj, center=mathutils.Vector((100, 100, 100)), rng=model_catalog_rng)
+
+        # Compiled assets are normalized already, direct imports still need it
+        if not self.asset_cache_path:
+            rescale_object(new_obj, eps=0)
+        new_obj.hide_render = True
+
+        new_obj["catalog_index"] = index
+
+        self.objects[index] = new_obj
+        self.resident[index] = self.model_size_mb(new_obj.data)
+        self.update_dims(index)
+
+        if self.use_lods:
+            self.load_lods(index)
+
+    def load_lods(self, index):
+        '''
+        Import the decimated levels of a model and keep only their meshes (with their materials).
+        '''
+        label, obj_name, file_path = self.entries[index]
+        lod_files = glob.glob(os.path.join(os.path.dirname(file_path), "lod", f"{obj_name}_lod*.obj"))
+        if not lod_files:
+            return
+
+        obj = self.objects[index]
+        meshes = [obj.data]
+        for lod_file in sorted(lod_files, key=lambda f: int(re.search(r"_lod(\d+)\.obj$", f).group(1))):
+            lod_obj = load_model(lod_file, label, os.path.basename(lod_file)[:-4], self.asset_cache_path)
+            mesh = lod_obj.data
+            bpy.data.objects.remove(lod_obj, do_unlink=True)
+
+            # Swapped out meshes have no users, the fake user keeps them from being purged
+            mesh.use_fake_user = True
+            meshes.append(mesh)
+            self.resident[index] += self.model_size_mb(mesh)
+
+        obj.data.use_fake_user = True
+        self.lods[index] = meshes
+        self.lod_levels[index] = 0
+
+    @staticmethod
+    def fit_mesh(mesh, reference):
+        '''
+        Scale and move a mesh so its bounding box matches the reference mesh's
+        (arrangements rescale the LOD 0 mesh in place, and decimation moves the bounds slightly).
+        '''
+        def bounds(m):
+            co = np.empty(len(m.vertices) * 3, dtype=np.float32)
+            m.vertices.foreach_get("co", co)
+            co = co.reshape(-1, 3)
+            return co, co.min(axis=0), co.max(axis=0)
+
+        _ref_co, ref_min, ref_max = bounds(reference)
+        co, mesh_min, mesh_max = bounds(mesh)
+
+        size = mesh_max - mesh_min
+        scale = np.divide(ref_max - ref_min, size, out=np.ones(3, dtype=np.float32), where=size > 0)
+        if np.allclose(scale, 1) and np.allclose(mesh_min, ref_min):
+            return
+
+        co = (co - mesh_min) * scale + ref_min
+        mesh.vertices.foreach_set("co", co.ravel())
+        mesh.update()
+
+    def set_lod(self, index, level):
+        meshes = self.lods.get(index)
+        if meshes is None:
+            return
+
+        level = min(level, len(meshes) - 1)
+        if level == self.lod_levels[index]:
+            return
+
+        if level > 0:
+            self.fit_mesh(meshes[level], meshes[0])
+        self.objects[index].data = meshes[level]
+        self.lod_levels[index] = level
+
+    def unload(self, index):
+        obj = self.objects[index]
+        meshes = self.lods.pop(index, [obj.data])
+        self.lod_levels.pop(index, None)
+        materials = {material for mesh in meshes for material in mesh.materials if material is not None}
+
+        bpy.data.objects.remove(obj, do_unlink=True)
+
+        # Free the data only used by this model (cached assets carry a fake user)
+        for mesh in meshes:
+            mesh.use_fake_user = False
+            if mesh.users == 0:
+                bpy.data.meshes.remove(mesh)
+
+        for material in materials:
+            material.use_fake_user = False
+            if material.users > 0:
+                continue
+
+            images = []
+            if material.node_tree is not None:
+                images = [node.image for node in material.node_tree.nodes if node.type == 'TEX_IMAGE' and node.image is not None]
+            bpy.data.materials.remove(material)
+
+            for image in images:
+                image.use_fake_user = False
+                if image.users == 0:
+                    bpy.data.images.remove(image)
+
+        self.objects[index] = None
+        del self.resident[index]
+        self.visible.discard(index)
+
+    def get(self, index):
+        if self.objects[index] is None:
+            self.load(index)
+
+        self.resident.move_to_end(index)
+        return self.objects[index]
+
+    def over_limit(self):
+        if self.max_resident and len(self.resident) > self.max_resident:
+            return True
+        return bool(self.max_resident_mb) and sum(self.resident.values()) > self.max_resident_mb
+
+    def evict(self, keep=()):
+        # Unload the least recently used models, but never the ones in use
+        while self.over_limit():
+            candidates = [index for index in self.resident if index not in keep]
+            if not candidates:
+                break
+            self.unload(candidates[0])
+
+model_catalog = ModelCatalog()
+
+def import_obj(scene, obj_path, asset_cache_path=None, lazy=False):
     all_classes = []
+    model_catalog.asset_cache_path = asset_cache_path
     
     # Get all object class folders
-    class_folders = glob.glob(f"{obj_path}/*/")
+    class_folders = sorted(glob.glob(f"{obj_path}/*/"))
 
     # Iterate through all the class folders under the objects folder
     for class_folder in class_folders:
@@ -455,6 +1570,7 @@ def import_obj(scene, obj_path):
         # Create new collection for each class
         class_coll = bpy.data.collections.new(class_name)
         scene.collection.children.link(class_coll)
+        model_catalog.collections[class_name] = class_coll
 
         # Save the class name
         all_classes.append(class_name)
@@ -467,86 +1583,183 @@ def import_obj(scene, obj_path):
             obj_name = os.path.basename(os.path.dirname(obj_folder))
 
             # Iterate through all files in the object folder and try to find the .obj file
-            for file_path in glob.glob(f"{obj_folder}/*"):
-                # Get the file extensio
-                obj_ext = os.path.splitext(file_path)[1].lower()
-
-                if obj_ext == ".obj":
-                    # Import the object 
-                    bpy.ops.wm.obj_import(filepath=file_path)
-                    
-                    # Rename the object to the folder name (optional)
-                    new_obj = bpy.context.view_layer.objects.active
-                    new_obj.name = obj_name  
-
-                    # Set the origin to center  (optional)
-                    bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='BOUNDS')
-
-                    break  # Stop the loop after finding the .obj file
-            
-            # Unlink from the default collection (if any)
-            for coll in new_obj.users_collection:
-                coll.objects.unlink(new_obj)
-            
-            # Link the object to its class collection
-            class_coll.objects.link(new_obj)
-
-            # Move the object away from the origin to avoid unintentional occlusion
-            translate_object(new_obj, center=mathutils.Vector((100, 100, 100)))  
-            rescale_object(new_obj)  
+            obj_files = [f for f in glob.glob(f"{obj_folder}/*") if os.path.splitext(f)[1].lower() == ".obj"]
+            if obj_files:
+                model_catalog.add(class_name, obj_name, obj_files[0])
+
+    # Without lazy loading every model is imported up front
+    if not lazy:
+        for index in range(len(model_catalog.entries)):
+            model_catalog.load(index)
+
+    print(f"Found {len(model_catalog.entries)} models, {len(model_catalog.resident)} loaded")
 
     # Update the global variable
     global ALL_CLASSES
     ALL_CLASSES = all_classes
 
-def get_selected_objects():
-    target_objects = [] # (obj, label)
-    distractor_objects = [] # (obj, label)
-
-    # Get all objects with labels from the scene (excluding distractors)
-    for label in TARGET_CLASSES:
-        # Get the collection of each label
-        collection = bpy.data.collections[label]
-
-        # Add the object to target list and hide from renderer
-        for obj in collection.objects:
-            if obj.type == 'MESH':
-                obj.hide_render = True
-                target_objects.append((obj, label))
+    model_catalog.build_index(TARGET_CLASSES, ALL_CLASSES)
 
+def get_selected_objects():
     # Randomly select some of the target objects
     ran_num_target = random.randint(MIN_TARGET_OBJ, MAX_TARGET_OBJ)
-    selected_targets = random.sample(target_objects, ran_num_target)
-
-    # Get all other objects from the scene (act as distractors)
-    for label in ALL_CLASSES:
-        # Exclude target classes to avoid repetition
-        if label not in TARGET_CLASSES:
-            collection = bpy.data.collections[label]
-
-            # Add the object to other list and hide from renderer
-            for distr in collection.objects:
-                if distr.type == 'MESH':
-                    distr.hide_render = True
-                    distractor_objects.append((distr, label))
-        
-    # Randomly determine a total object number select other objects to reach that number
+    if CLASS_BALANCE or CLASS_QUOTAS:
+        # Weighted towards the classes and models seen least so far
+        target_indices = class_balancer.pick_targets(ran_num_target)
+    else:
+        target_picks = random.sample(range(len(model_catalog.target_indices)), ran_num_target)
+        target_indices = [int(model_catalog.target_indices[i]) for i in target_picks]
+    
+    # Randomly determine a total object number select other objects (distractors) to reach that number
     ran_num_distractors = random.randint(MIN_TOTAL_OBJ, MAX_TOTAL_OBJ) - ran_num_target
-    selected_distractors = random.sample(distractor_objects, ran_num_distractors)
+    distractor_picks = random.sample(range(len(model_catalog.distractor_indices)), ran_num_distractors)
+
+    distractor_indices = [int(model_catalog.distractor_indices[i]) for i in distractor_picks]
+
+    # Load the selected models if needed and unload old ones over the limit
+    for index in target_indices + distractor_indices:
+        model_catalog.get(index)
+    model_catalog.evict(keep=set(target_indices + distractor_indices))
+
+    # Objects already placed in this arrangement (non-overlapping mode only)
+    placement_index = scene_geometry.PlacementIndex() if PLACEMENT_MODE == "non_overlapping" else None
+    placed = set()
+
+    for index in target_indices + distractor_indices:
+        obj = model_catalog.objects[index]
 
-    # Let selected objects to be see in the renderer
-    for obj, _label in selected_targets + selected_distractors:
-        obj.hide_render = False
+        # The rescale is applied to the full detail mesh, the other levels follow it when swapped in
+        model_catalog.set_lod(index, 0)
 
         # Add augmentation to both target objects and distractors
         rescale_object(obj)
-        translate_object(obj)
-        rotate_object(obj)
+
+        if placement_index is None:
+            translate_object(obj)
+            rotate_object(obj)
+        elif not place_without_overlap(obj, placement_index, PLACEMENT_TOLERANCE):
+            # Rejected before rendering instead of producing an image with interpenetrating meshes
+            print(f"No free pose for {obj.name}, leaving it out of this arrangement")
+            continue
+
+        placed.add(index)
+        model_catalog.update_dims(index)
+
+    # Let only the placed objects be seen in the renderer
+    model_catalog.show_only(placed)
+
+    selected_targets = [(model_catalog.objects[index], model_catalog.label(index)) for index in target_indices if index in placed]
+    selected_distractors = [(model_catalog.objects[index], model_catalog.label(index)) for index in distractor_indices if index in placed]
 
     return selected_targets, selected_distractors
 
 
 
+# === CLASS BALANCE ===
+
+class ClassBalancer:
+    '''
+    Running counts of visible instances and pixels per class and per model, taken from the labels
+    produced so far, which weight the choice of targets for the next arrangements.
+    '''
+    def __init__(self):
+        self.strength = BALANCE_STRENGTH
+        self.quotas = {}            # {label : visible instances wanted}
+        self.instances = {}         # {label : visible instances}
+        self.pixels = {}            # {label : visible pixels}
+        self.model_pixels = {}      # {entry index : visible pixels}, counted in this session only
+
+    def load(self, output_path, run_id):
+        '''
+        Count the labels of the attempts of this run under the output folder from their annotation
+        stores (the counts of this session are kept if there are none). Other runs, including
+        parallel workers with their own run id, are not counted.
+        '''
+        instances, pixels = {}, {}
+        for meta_path in glob.glob(os.path.join(output_path, "attempt_*", "annotations", "meta.json")):
+            attempt_folder = os.path.dirname(os.path.dirname(meta_path))
+            config_path = os.path.join(attempt_folder, f"configs_{attempt_folder.split('_')[-1]}.yaml")
+            if not os.path.exists(config_path):
+                continue
+            with open(config_path) as f:
+                if (yaml.full_load(f) or {}).get("RUN_ID") != run_id:
+                    continue
+
+            store = annotation_store.AnnotationStore(os.path.dirname(meta_path))
+            class_id = np.asarray(store.columns["class_id"])
+            counts = np.bincount(class_id, minlength=len(store.classes))
+            sums = np.bincount(class_id, weights=np.asarray(store.columns["pixels"]), minlength=len(store.classes))
+
+            for c, label in enumerate(store.classes):
+                instances[label] = instances.get(label, 0) + int(counts[c])
+                pixels[label] = pixels.get(label, 0) + int(sums[c])
+
+        if instances:
+            self.instances, self.pixels = instances, pixels
+
+    def update(self, bboxes, models):
+        '''
+        Add the labels of a frame; models maps the instance ids to catalog entries.
+        '''
+        for bbox in bboxes:
+            label = bbox["label"]
+            self.instances[label] = self.instances.get(label, 0) + 1
+            self.pixels[label] = self.pixels.get(label, 0) + bbox["pixels"]
+
+            index = models.get(bbox["inst_id"])
+            if index is not None:
+                self.model_pixels[index] = self.model_pixels.get(index, 0) + bbox["pixels"]
+
+    def quotas_met(self):
+        return bool(self.quotas) and all(self.instances.get(label, 0) >= quota for label, quota in self.quotas.items())
+
+    def class_weights(self, labels):
+        '''
+        Weight per class from its visible instances relative to its share: the quota if it has
+        one, otherwise the mean quota (or an equal share without quotas). Classes at their quota get 0.
+        '''
+        mean_quota = np.mean(list(self.quotas.values())) if self.quotas else 1.0
+        shares = np.array([self.quotas.get(label, mean_quota) for label in labels], dtype=np.float64)
+        counts = np.array([self.instances.get(label, 0) for label in labels], dtype=np.float64)
+
+        fill = (counts + 1) / shares
+        weights = (fill.mean() / fill) ** self.strength
+        weights[[label in self.quotas and self.instances.get(label, 0) >= self.quotas[label] for label in labels]] = 0
+        return weights
+
+    def pick_targets(self, num_targets):
+        '''
+        Draw target entries without replacement: every class gets its class weight in total,
+        split between its models by how few of their pixels were visible so far.
+        '''
+        indices = model_catalog.target_indices
+        labels = [model_catalog.label(index) for index in indices]
+        classes = sorted(set(labels))
+        class_weights = dict(zip(classes, self.class_weights(classes)))
+
+        pixels = np.array([self.model_pixels.get(int(index), 0) for index in indices], dtype=np.float64)
+        weights = np.zeros(len(indices))
+        for label in classes:
+            members = np.array([l == label for l in labels])
+            model_weights = ((pixels[members].mean() + 1) / (pixels[members] + 1)) ** self.strength
+            weights[members] = class_weights[label] * model_weights / model_weights.sum()
+
+        num_targets = min(num_targets, int(np.count_nonzero(weights)))
+        if num_targets == 0:
+            return []
+
+        rng = np.random.default_rng(random.getrandbits(64))
+        picks = rng.choice(len(indices), num_targets, replace=False, p=weights / weights.sum())
+        return [int(indices[i]) for i in picks]
+
+    def summary(self):
+        return {label: {"instances": self.instances[label], "pixels": self.pixels.get(label, 0),
+                        "quota": self.quotas.get(label)} for label in sorted(self.instances)}
+
+class_balancer = ClassBalancer()
+
+
+
 # === INITIAL SETUPS ===
 
 def traverse_tree(t):
@@ -571,31 +1784,76 @@ def clear_stage(scene):
 
     bpy.ops.outliner.orphans_purge()
 
-def render_setup(scene):
-    scene.render.engine = 'CYCLES' # Only this CYCLES supports headless rendering
-
+def setup_device(scene, device):
+    '''
+    Enable the requested Cycles device and return the one actually used.
+    '''
     prefs = bpy.context.preferences.addons['cycles'].preferences
-    prefs.compute_device_type = 'CUDA'
-    prefs.get_devices()  # Populate available devices
-    prefs.use_cuda = True
 
-    # Activate all GPU devices (optional but common)
-    for device in prefs.devices:
-        device.use = True
-    
-    scene.cycles.samples = SAMPLES
-    scene.cycles.tile_size = TILE_SIZE
+    backends = ["OPTIX", "CUDA", "HIP", "METAL", "ONEAPI"] if device == "AUTO" else [device]
+    if device != "CPU":
+        for backend in backends:
+            try:
+                prefs.compute_device_type = backend
+            except TypeError:
+                continue  # Backend not supported by this Blender build
+
+            prefs.get_devices()  # Populate available devices
+            if not any(d.type == backend for d in prefs.devices):
+                continue
+
+            # Activate all devices of the backend (optional but common)
+            for d in prefs.devices:
+                d.use = True
+
+            scene.cycles.device = "GPU"
+            return backend
+
+        if device != "AUTO":
+            print(f"Device {device} is not available, rendering on the CPU")
+
+    prefs.compute_device_type = 'NONE'
+    scene.cycles.device = "CPU"
+    return "CPU"
+
+def apply_render_settings(scene, device, threads, tile_size, samples, adaptive_threshold, denoiser, used_device=None):
+    # used_device: the device is already enabled (by setup_device), only change the settings
+    if used_device is None:
+        used_device = setup_device(scene, device)
+
+    scene.cycles.samples = samples
+    scene.cycles.tile_size = tile_size
+
+    scene.cycles.use_adaptive_sampling = adaptive_threshold > 0
+    if adaptive_threshold > 0:
+        scene.cycles.adaptive_threshold = adaptive_threshold
+
+    scene.cycles.use_denoising = denoiser != "NONE"
+    if denoiser != "NONE":
+        scene.cycles.denoiser = denoiser
+
+    # Pin the number of render threads so parallel workers don't oversubscribe the CPU
+    if threads > 0:
+        scene.render.threads_mode = 'FIXED'
+        scene.render.threads = threads
+    else:
+        scene.render.threads_mode = 'AUTO'
+
+    return used_device
+
+def render_setup(scene, threads=0):
+    scene.render.engine = 'CYCLES' # Only this CYCLES supports headless rendering
+
+    used_device = apply_render_settings(scene, DEVICE, threads, TILE_SIZE, SAMPLES, ADAPTIVE_THRESHOLD, DENOISER)
+    print(f"Rendering on {used_device}")
 
-    scene.cycles.use_adaptive_sampling = True
-    scene.cycles.use_denoising = True
     scene.cycles.use_progressive_refine = False
-    scene.cycles.device = "GPU"
 
-    scene.render.use_persistent_data = False # Set to True for faster render but more GPU usage
+    scene.render.use_persistent_data = False # Only enabled while the views of one arrangement render (persistent_views)
     scene.render.resolution_x = RESOLUTION_X
     scene.render.resolution_y = RESOLUTION_Y
 
-def setup_output_folder(output_path, save_files):
+def setup_output_folder(output_path, save_files, attempt=None, resume=False):
     # Regex to match folders like: attempt_#
     pattern = re.compile(r"attempt_(\d+)")
 
@@ -608,7 +1866,14 @@ def setup_output_folder(output_path, save_files):
             if attempt_num > max_attempt:
                 max_attempt = attempt_num
 
-    next_attempt = max_attempt + 1
+    # Parallel workers get their attempt number assigned by the coordinator,
+    # resuming without one continues the latest attempt
+    if attempt is not None:
+        next_attempt = attempt
+    elif resume and max_attempt > 0:
+        next_attempt = max_attempt
+    else:
+        next_attempt = max_attempt + 1
 
     # Prepare output directories
     output_folder = os.path.join(output_path, f"attempt_{next_attempt}")
@@ -619,6 +1884,12 @@ def setup_output_folder(output_path, save_files):
 
         yaml_path = os.path.join(output_folder, f"configs_{next_attempt}.yaml")
 
+        # Keep the configs of the run being resumed
+        if resume and os.path.exists(yaml_path):
+            with open(yaml_path, "a") as f:
+                f.write(f"\n# Resumed at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+            return output_folder, yaml_path, next_attempt
+
         basic_types = (int, float, str, bool, list, tuple, dict)
         current_module = sys.modules[__name__]
         all_vars = {k: v for k, v in vars(current_module).items() if not k.startswith("__") and isinstance(v, basic_types)}
@@ -630,78 +1901,494 @@ def setup_output_folder(output_path, save_files):
 
 
 
+# === ARRANGEMENTS ===
+
+def arrange_scene(scene, light, hdri_path):
+    # Randomly select target and distractor objects to render (and augment them)
+    with profiler.stage("select"):
+        selected_targets, selected_distractors = get_selected_objects()
+
+    # Update the background to the selected one
+    with profiler.stage("hdri"):
+        update_hdri_settings(scene, hdri_path=hdri_path)
+
+    # Add random lighting
+    translate_object_on_surface(light, 
+                            x_range = 6, 
+                            y_range = 6, 
+                            z_range = 6)
+    look_at(light, CENTER)
+
+    # Update the scene
+    with profiler.stage("view_layer_update"):
+        bpy.context.view_layer.update()
+
+    return selected_targets, selected_distractors
+
+def apply_planned_pose(obj, planned):
+    '''
+    Give the object the planned size (its largest side), rotation and location.
+    '''
+    # Scale relative to the mesh itself, so the object's current rotation doesn't matter
+    local_dims = [d / s for d, s in zip(obj.dimensions, obj.scale)]
+    obj.scale = (planned["size"] / max(local_dims),) * 3
+
+    obj.rotation_mode = 'XYZ'
+    obj.rotation_euler = tuple(planned["rotation"])
+    obj.location = tuple(planned["location"])
+
+def arrange_planned_scene(scene, light, plan, hdri_path):
+    '''
+    Set up the objects, background and light of a scene from scene_planner.py.
+    '''
+    with profiler.stage("select"):
+        indices = []
+        for planned in plan["objects"]:
+            index = model_catalog.by_name.get((planned["label"], planned["name"]))
+            if index is None:
+                raise KeyError(f"Model {planned['label']}/{planned['name']} of the plan is not under the objects folder")
+            indices.append(index)
+
+        # Load the planned models if needed and unload old ones over the limit
+        for index in indices:
+            model_catalog.get(index)
+        model_catalog.evict(keep=set(indices))
+
+        for index, planned in zip(indices, plan["objects"]):
+            model_catalog.set_lod(index, 0)
+            apply_planned_pose(model_catalog.objects[index], planned)
+            model_catalog.update_dims(index)
+
+        model_catalog.show_only(indices)
+
+    # Targets first, as with sampled scenes (instance ids follow this order)
+    selected_targets = [(model_catalog.objects[index], model_catalog.label(index)) for index in indices if model_catalog.label(index) in TARGET_CLASSES]
+    selected_distractors = [(model_catalog.objects[index], model_catalog.label(index)) for index in indices if model_catalog.label(index) not in TARGET_CLASSES]
+
+    with profiler.stage("hdri"):
+        update_hdri_settings(scene, hdri_path=hdri_path)
+
+    light.location = tuple(plan["light"]["location"])
+    light.data.energy = plan["light"]["energy"]
+    look_at(light, CENTER)
+
+    with profiler.stage("view_layer_update"):
+        bpy.context.view_layer.update()
+
+    return selected_targets, selected_distractors
+
+def clear_arrangement(all_objects):
+    # Move the objects away from the origin to avoid unintentional occlusion
+    for obj, _label in all_objects:
+        translate_object(obj, center=mathutils.Vector((100, 100, 100)))  
+
+    # Clean up the storage and update the scene
+    bpy.context.view_layer.update()
+
+
+
+# === RENDER AUTOTUNE ===
+
+def autotune_render_settings(scene, camera, light, hdri_files, default_threads=0, grid=AUTOTUNE_GRID,
+                             num_frames=AUTOTUNE_FRAMES, reference_samples=AUTOTUNE_REFERENCE_SAMPLES,
+                             max_noise=AUTOTUNE_MAX_NOISE):
+    '''
+    Render a few calibration frames with every configuration in the grid and apply the fastest
+    one whose noise against a high-sample reference stays below max_noise.
+    '''
+    # Calibration must not change the images generated afterwards
+    random_state = random.getstate()
+
+    keys = list(grid)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+    # threads = 0 in the grid keeps the thread count the process was started with
+    for config in configs:
+        config["threads"] = config["threads"] or default_threads
+    seconds = [0.0] * len(configs)
+    squared_errors = [0.0] * len(configs)
+
+    tan_half_x, tan_half_y = get_camera_tan_half_fov(camera, scene)
+
+    def arrange_frame(frame):
+        # One random arrangement and view per calibration frame, the same every time it is set up
+        random.seed(derive_seed("autotune", frame))
+        selected_targets, selected_distractors = arrange_scene(scene, light, random.choice(hdri_files))
+        all_objects = selected_targets + selected_distractors
+        corners = get_world_corners(all_objects)
+        centers = corners.mean(axis=1)
+        point_camera(camera, corners, centers, scene_geometry.aabb_corners(corners), tan_half_x, tan_half_y)
+        assign_instance_ids(all_objects, ALL_CLASSES)
+        return all_objects
+
+    # Many samples and no denoiser, so denoised candidates aren't closer to it by construction
+    references = []
+    reference_device = setup_device(scene, "AUTO")
+    for frame in range(num_frames):
+        all_objects = arrange_frame(frame)
+        apply_render_settings(scene, "AUTO", default_threads, 2048, reference_samples, 0.0, "NONE", used_device=reference_device)
+        references.append(render_frame(scene, all_objects)["image"].astype(np.float32) / 255)
+        clear_arrangement(all_objects)
+
+    # Every device is enabled once, its configurations then take turns on each frame
+    by_device = {}
+    for i, config in enumerate(configs):
+        by_device.setdefault(config["device"], []).append(i)
+
+    for device, indices in by_device.items():
+        used_device = setup_device(scene, device)
+
+        for frame in range(num_frames):
+            all_objects = arrange_frame(frame)
+
+            for i in indices:
+                config = configs[i]
+                print(f"Autotune frame {frame+1}/{num_frames}, configuration {i+1}/{len(configs)}: {config}")
+                apply_render_settings(scene, **config, used_device=used_device)
+
+                # The first render of a configuration also compiles kernels and builds the BVH
+                if frame == 0:
+                    render_frame(scene, all_objects)
+
+                start_time = time.perf_counter()
+                image = render_frame(scene, all_objects)["image"]
+                seconds[i] += time.perf_counter() - start_time
+
+                squared_errors[i] += float(np.mean((image.astype(np.float32) / 255 - references[frame]) ** 2))
+
+            clear_arrangement(all_objects)
+
+    results = [
+        dict(config, seconds_per_image=round(seconds[i] / num_frames, 4),
+             noise=round((squared_errors[i] / num_frames) ** 0.5, 5))
+        for i, config in enumerate(configs)
+    ]
+
+    # Fastest configuration under the noise target, or the least noisy one if none qualifies
+    accepted = [r for r in results if r["noise"] <= max_noise]
+    if accepted:
+        best = min(accepted, key=lambda r: r["seconds_per_image"])
+    else:
+        print(f"No configuration reached a noise of {max_noise}, using the least noisy one")
+        best = min(results, key=lambda r: r["noise"])
+
+    # Make the choice part of the attempt configs
+    global DEVICE, SAMPLES, TILE_SIZE, ADAPTIVE_THRESHOLD, DENOISER, AUTOTUNE_RESULT
+    DEVICE = apply_render_settings(scene, **{k: best[k] for k in keys})
+    SAMPLES = best["samples"]
+    TILE_SIZE = best["tile_size"]
+    ADAPTIVE_THRESHOLD = best["adaptive_threshold"]
+    DENOISER = best["denoiser"]
+    AUTOTUNE_RESULT = dict(best, device=DEVICE, max_noise=max_noise, frames=num_frames, candidates=results)
+
+    print(f"Autotune picked {best}")
+    random.setstate(random_state)
+
+    return best
+
+
+
+# === GENERATION DAEMON ===
+
+def parse_quotas(text):
+    '''
+    Parse class quotas such as "can=5000,toy_car=5000" into a dict.
+    '''
+    quotas = {}
+    for part in (text or "").split(","):
+        if part.strip():
+            label, quota = part.split("=")
+            quotas[label.strip()] = int(quota)
+            if quotas[label.strip()] <= 0:
+                raise ValueError(f"The quota of {label.strip()} has to be positive")
+    return quotas
+
+def get_rss_mb():
+    '''
+    Current resident memory of this process in MB.
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        # Not Linux: fall back to the peak RSS (kilobytes on Linux, bytes on macOS)
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+class MemoryMonitor:
+    '''
+    Track memory of a long-lived Blender session and decide when it must restart.
+    '''
+    def __init__(self, watermark_mb):
+        self.watermark_mb = watermark_mb
+        self.restart_needed = False
+
+    def check(self):
+        # Free datablocks that lost all their users (old HDRIs, meshes, materials)
+        bpy.data.orphans_purge(do_local_ids=True, do_linked_ids=True, do_recursive=True)
+
+        rss = get_rss_mb()
+        print(f"Memory: {rss:.0f} MB RSS; images {len(bpy.data.images)}; "
+              f"meshes {len(bpy.data.meshes)}; materials {len(bpy.data.materials)}")
+
+        if self.watermark_mb and rss > self.watermark_mb:
+            self.restart_needed = True
+        return self.restart_needed
+
+def strip_args(script_args, flags):
+    '''
+    Remove flags from an argument list; flags maps each flag to whether it takes a value.
+    '''
+    new_args = []
+    skip = False
+    for arg in script_args:
+        name = arg.split("=", 1)[0]
+        if skip:
+            skip = False
+        elif name in flags:
+            skip = flags[name] and "=" not in arg
+        else:
+            new_args.append(arg)
+    return new_args
+
+def restart_daemon(remaining_seeds=None, attempt=None):
+    '''
+    Replace the current process with a fresh one that continues with the remaining seeds,
+    or (plan mode) resumes the given attempt.
+    '''
+    argv = list(sys.argv)
+
+    if "--" in argv:
+        # Launched through the Blender binary: keep everything before "--"
+        split = argv.index("--") + 1
+        program, prefix, script_args = bpy.app.binary_path, argv[:split], argv[split:]
+    else:
+        # Launched with the standalone bpy module
+        program, prefix, script_args = sys.executable, [sys.executable, argv[0]], argv[1:]
+
+    new_args = strip_args(script_args, {"--seeds": True, "--resume": False, "--no-resume": False, "--run_id": True})
+    new_args += ["--run_id", RUN_ID]
+    if remaining_seeds is not None:
+        # Drop the old seed list, the first remaining seed continues the latest attempt
+        new_args += ["--seeds", ",".join(str(s) for s in remaining_seeds), "--resume"]
+    else:
+        # The same plan (slice) continues in its own attempt
+        new_args = strip_args(new_args, {"--attempt": True})
+        new_args += ["--attempt", str(attempt), "--resume"]
+
+    # Keep the autotuned render settings instead of tuning again
+    if AUTOTUNE_RESULT:
+        new_args = strip_args(new_args, {"--autotune": False, "--no-autotune": False, "--device": True, "--samples": True,
+                                         "--tile_size": True, "--adaptive_threshold": True, "--denoiser": True, "--threads": True})
+        new_args += ["--device", DEVICE, "--samples", str(SAMPLES), "--tile_size", str(TILE_SIZE),
+                     "--adaptive_threshold", str(ADAPTIVE_THRESHOLD), "--denoiser", DENOISER,
+                     "--threads", str(AUTOTUNE_RESULT["threads"])]
+
+    remaining = f"seeds {remaining_seeds}" if remaining_seeds is not None else f"attempt {attempt}"
+    print(f"\nMemory watermark crossed, restarting with {remaining}\n")
+    sys.stdout.flush()
+
+    # exec skips atexit handlers, so remove the scratch folder now
+    if render_tmp_folder is not None:
+        shutil.rmtree(render_tmp_folder, ignore_errors=True)
+    os.execv(program, prefix + new_args)
+
+
+
 # === MAIN FUNCTION ===
 
-def main(args):
-    start_time = time.time()
-    random.seed(args.seed)  # Set the random seed for reproducibility
-    scene = bpy.context.scene
+def setup_session(scene, args):
+    hdri_cache.budget_mb = args.hdri_cache_budget
+
+    global PLACEMENT_MODE, PLACEMENT_TOLERANCE, RENDER_MODE, RENDER_DEPTH
+    PLACEMENT_MODE = args.placement
+    PLACEMENT_TOLERANCE = args.placement_tolerance
+    RENDER_MODE = args.render_mode
+    RENDER_DEPTH = args.depth
+
+    global PERSISTENT_DATA, PERSISTENT_MAX_RSS
+    PERSISTENT_DATA = args.persistent_data
+    PERSISTENT_MAX_RSS = args.persistent_max_rss
+
+    global RESOLUTION_X, RESOLUTION_Y
+    RESOLUTION_X = args.resolution_x
+    RESOLUTION_Y = args.resolution_y
+
+    global DEVICE, SAMPLES, TILE_SIZE, ADAPTIVE_THRESHOLD, DENOISER
+    DEVICE = args.device
+    SAMPLES = args.samples
+    TILE_SIZE = args.tile_size
+    ADAPTIVE_THRESHOLD = args.adaptive_threshold
+    DENOISER = args.denoiser
 
     clear_stage(scene)
-    render_setup(scene)
+    render_setup(scene, args.threads)
+
+    if RENDER_MODE == "index_pass":
+        setup_index_pass(scene, RENDER_DEPTH)
     
-    # Import objects
-    import_obj(scene, args.obj_path)
+    global CLASS_BALANCE, BALANCE_STRENGTH, CLASS_QUOTAS
+    CLASS_BALANCE = args.class_balance
+    BALANCE_STRENGTH = args.balance_strength if CLASS_BALANCE else 0.0
+    CLASS_QUOTAS = parse_quotas(args.class_quotas)
+    if set(CLASS_QUOTAS) - set(TARGET_CLASSES):
+        raise ValueError(f"Class quotas only apply to the target classes {TARGET_CLASSES}")
+    class_balancer.strength = BALANCE_STRENGTH
+    class_balancer.quotas = CLASS_QUOTAS
+
+    # Set before the first attempt writes its configs, where the id is recorded
+    global RUN_ID
+    RUN_ID = args.run_id or uuid.uuid4().hex[:12]
+
+    global LOD_ENABLED, LOD_MIN_PIXELS
+    LOD_ENABLED = args.lod
+    LOD_MIN_PIXELS = [float(p) for p in args.lod_min_pixels.split(",") if p.strip()]
+    model_catalog.use_lods = LOD_ENABLED
+
+    # Import objects (or only index them with lazy loading)
+    if args.lazy_loading:
+        model_catalog.max_resident = args.max_resident_models
+        model_catalog.max_resident_mb = args.max_resident_mb
+    import_obj(scene, args.obj_path, args.asset_cache_path, args.lazy_loading)
+
+    # Add default camera and light
+    camera, light = add_default_obj(scene)
+
+    # Use the preprocessed background variants when there are any
+    global HDRI_INDEX, HDRI_MIN_PIXEL_RATIO, HDRI_TARGET_LUMINANCE
+    HDRI_INDEX = args.hdri_index or os.path.join(args.hdri_path, "preprocessed", "hdri_index.json")
+    HDRI_MIN_PIXEL_RATIO = args.hdri_min_pixel_ratio
+    HDRI_TARGET_LUMINANCE = args.hdri_target_luminance
+
+    if os.path.exists(HDRI_INDEX):
+        hdri_index.load(HDRI_INDEX)
+        hdri_index.set_required_width(camera, scene, HDRI_MIN_PIXEL_RATIO)
+        hdri_index.target_luminance = HDRI_TARGET_LUMINANCE
+        print(f"Using hdri variants at least {hdri_index.required_width} pixels wide")
 
     # Collect hdri files and build the world tree
     hdri_files = glob.glob(os.path.join(args.hdri_path, "*.exr"))
     add_hdri_background(scene, hdri_files[0])  # Add the first hdri as a default background
 
-    # Add default camera and light
-    camera, light = add_default_obj(scene)
-    depsgraph = bpy.context.evaluated_depsgraph_get()
+    # Measure and pick the render settings before anything is generated
+    if args.autotune:
+        autotune_render_settings(scene, camera, light, hdri_files, args.threads)
+
+    return camera, light, hdri_files
+
+def run_attempt(scene, camera, light, hdri_files, args, seed, writer, monitor=None, resume=False, plan=None):
+    start_time = time.time()
+
+    # Every random decision is seeded from (seed, shard, iteration, arrangement, view) so an
+    # interrupted attempt can be resumed at any frame (shards of the same seed get their own stream)
+    base_seed = seed if args.shard is None else f"{seed}_{args.shard}"
+
+    # Planned scenes name their backgrounds, only sampled scenes need the list below
+    hdri_by_name = {os.path.basename(f).split('.')[0]: f for f in hdri_files}
+
+    if plan is None and args.hdri_names is not None:
+        # A shard renders exactly the backgrounds it was given, in order
+        hdri_files = [hdri_by_name[name] for name in args.hdri_names.split(",")]
+    elif plan is None:
+        # Pick the backgrounds without repetition
+        hdri_files = random.Random(derive_seed(base_seed, "hdri")).sample(hdri_files, min(args.iteration, len(hdri_files)))
 
     # Setup light energy
-    light_energy_ran = random.randint(0, MAX_LIGHT_ENERGY)
+    light_energy_ran = random.Random(derive_seed(base_seed, "light")).randint(0, MAX_LIGHT_ENERGY)
     light.data.energy = light_energy_ran
 
     # Set the output folder
-    output_folder, yaml_path, atmpt = setup_output_folder(args.output_path, SAVE_FILES) 
+    output_folder, yaml_path, atmpt = setup_output_folder(args.output_path, SAVE_FILES, args.attempt, resume) 
+
+    if SAVE_FILES:
+        manifest.open(os.path.join(output_folder, "manifest.jsonl"))
+        if writer.shards is not None:
+            writer.shards.open(output_folder, f"attempt_{atmpt}")
+        if args.annotation_store:
+            writer.annotations = annotation_store.AnnotationStoreWriter(
+                os.path.join(output_folder, "annotations"), ALL_CLASSES, RESOLUTION_X, RESOLUTION_Y)
+            # A crash between the manifest entry and the next store commit leaves frames
+            # without boxes; render those again
+            stored = {name.rsplit("/", 1)[-1] for name in writer.annotations.names}
+            manifest.done &= stored
+        if manifest.done:
+            print(f"Resuming attempt {atmpt}: {len(manifest.done)} frames already done\n")
+
+    # A resumed attempt keeps counting with the run it was started in
+    global RUN_ID
+    if resume and not args.run_id and SAVE_FILES:
+        with open(yaml_path) as f:
+            RUN_ID = (yaml.full_load(f) or {}).get("RUN_ID") or RUN_ID
+
+    # Class counts of everything this run produced so far, including the frames of a resumed attempt
+    if SAVE_FILES and ANNOTATION_STORE and (CLASS_BALANCE or CLASS_QUOTAS):
+        class_balancer.load(args.output_path, RUN_ID)
+
+    if args.profile and SAVE_FILES:
+        profiler.open(os.path.join(output_folder, f"profile_{atmpt}.jsonl"))
+        profiler.write({"type": "session", "startup": float(STARTUP_TIME)})
+
+    if plan is not None:
+        # Planned scenes carry their own seed, background, light and views
+        jobs = ((job["seed"], job["iteration"], job["arrangement"], hdri_by_name[job["hdri"]], job) for job in plan)
+    else:
+        jobs = ((seed, iter, arngmnt, hdri_files[iter], None)
+                for iter in range(min(args.iteration, len(hdri_files))) for arngmnt in range(args.arrangement))
+
+    # Iterate through the backgrounds and the object arrangements of each of them
+    for job_seed, iter, arngmnt, selected_hdri, job in jobs:
+        if class_balancer.quotas_met():
+            print(f"Class quotas met: {class_balancer.summary()}")
+            break
 
-    # Iterate through the number of background we want to generate
-    for iter in range(min(args.iteration, len(hdri_files))):
-        # Pick a background
-        selected_hdri = random.choice(hdri_files)
-        hdri_files.remove(selected_hdri)  # Remove the selected hdri to avoid repetition
+        num_pics = len(job["views"]) if job is not None else args.num_pics
 
         # Make a subfolder for each iteration
         hdri_name = os.path.basename(selected_hdri).split('.')[0]
         output_subfolder = os.path.join(output_folder, f"{iter+1}_{hdri_name}")
 
-        # Iterate through different object arrangements of the same scene
-        for arngmnt in range(args.arrangement):
-            
-            # Randomly select target and distractor objects to render
-            selected_targets, selected_distractors = get_selected_objects()
+        # Nothing to do if every view of the arrangement is on disk already
+        if all(frame_name(atmpt, job_seed, iter, arngmnt, i) in manifest.done for i in range(num_pics)):
+            continue
 
-            # Update the background to the selected one
-            update_hdri_settings(scene, hdri_path=selected_hdri)
+        # Stop the attempt early if the session has grown past the memory watermark. Checked before
+        # an arrangement that still has frames, so a restart always has work left to do
+        if monitor is not None and monitor.check():
+            break
 
-            # Add random lighting
-            translate_object_on_surface(light, 
-                                    x_range = 6, 
-                                    y_range = 6, 
-                                    z_range = 6)
-            look_at(light, CENTER)
+        # The arrangement only depends on its own seed, not on the ones before it
+        job_base_seed = base_seed if job is None else job_seed
+        random.seed(derive_seed(job_base_seed, iter, arngmnt))
 
-            # Update the scene
-            bpy.context.view_layer.update()
-
-            # Capture selected objects
-            capture_views(camera, scene, depsgraph, selected_targets, selected_distractors, 
-                          atmpt, iter, args.seed, arngmnt, ALL_CLASSES, args.num_pics, 
-                          MIN_EXPOSURE, MAX_EXPOSURE, output_subfolder, SAVE_FILES)
-            
-            # Move the objects away from the origin to avoid unintentional occlusion
-            for obj, _label in selected_targets + selected_distractors:
-                translate_object(obj, center=mathutils.Vector((100, 100, 100)))  
-
-            # Clean up the storage and update the scene
-            bpy.context.view_layer.update()
-
-        # End of arrangement loop
-
-    # End of iteration loop
+        # Randomly select and place objects, background and light (or set up the planned ones)
+        profiler.begin("arrangement", attempt=atmpt, iteration=iter+1, arrangement=arngmnt+1)
+        if job is None:
+            selected_targets, selected_distractors = arrange_scene(scene, light, selected_hdri)
+        else:
+            selected_targets, selected_distractors = arrange_planned_scene(scene, light, job, selected_hdri)
+        profiler.write(profiler.end())
+
+        # Capture selected objects
+        capture_views(camera, scene, selected_targets, selected_distractors, 
+                      atmpt, iter, job_seed, arngmnt, ALL_CLASSES, num_pics, 
+                      MIN_EXPOSURE, MAX_EXPOSURE, output_subfolder, SAVE_FILES, writer, job_base_seed,
+                      job["views"] if job is not None else None)
+        writer.commit()
+        
+        # Move the objects away and update the scene
+        clear_arrangement(selected_targets + selected_distractors)
+
+    # Make sure every image and label is written before the attempt counts as finished
+    writer.flush()
+    if writer.shards is not None:
+        writer.shards.close()
+    if writer.annotations is not None:
+        writer.annotations.close()
+        writer.annotations = None
+    manifest.close()
+    profiler.close()
 
     print(f"Output folder: {output_folder}")
     print("\n======================================== Render loop is finished ========================================\n")
@@ -711,8 +2398,74 @@ def main(args):
     print(f"Total execution time: {execution_time:.2f} seconds\n")
 
     with open(yaml_path, "a") as f:
+        if monitor is not None and monitor.restart_needed:
+            f.write(f"\n# Stopped early: memory watermark of {monitor.watermark_mb} MB crossed\n")
+        if class_balancer.quotas_met():
+            f.write(f"\n# Class quotas met: {json.dumps(class_balancer.summary())}\n")
         f.write(f"\n# Total execution time: {execution_time:.2f} seconds\n")
 
+    return atmpt
+
+def main(args):
+    start_time = time.time()
+    scene = bpy.context.scene
+    camera, light, hdri_files = setup_session(scene, args)
+
+    global STARTUP_TIME
+    STARTUP_TIME = round(time.time() - start_time, 2)
+    print(f"Startup time: {STARTUP_TIME:.2f} seconds\n")
+    global OUTPUT_FORMAT, SHARD_MAX_FRAMES, SHARD_MAX_MB, ANNOTATION_STORE
+    OUTPUT_FORMAT = args.output_format
+    ANNOTATION_STORE = args.annotation_store
+    SHARD_MAX_FRAMES = args.shard_max_frames
+    SHARD_MAX_MB = args.shard_max_mb
+    shard_writer.max_frames = SHARD_MAX_FRAMES
+    shard_writer.max_bytes = SHARD_MAX_MB * 1024 * 1024
+
+    writer = AsyncWriter(image_format=args.image_format, jpeg_quality=args.jpeg_quality,
+                         shards=shard_writer if OUTPUT_FORMAT == "tar" else None)
+
+    if args.plan:
+        # Render the planned scenes (or this worker's slice of them) as one attempt
+        global PLAN_FILE, PLAN_SLICE
+        PLAN_FILE = os.path.abspath(args.plan)
+        PLAN_SLICE = args.plan_slice or ""
+
+        plan = scene_planner.read_plan(args.plan, args.plan_slice)
+        monitor = MemoryMonitor(args.memory_watermark)
+        atmpt = run_attempt(scene, camera, light, hdri_files, args, args.seed, writer, monitor, resume=args.resume, plan=plan)
+        writer.close()
+
+        if monitor.restart_needed:
+            # The new process skips the planned frames that are already in the manifest
+            restart_daemon(attempt=atmpt)
+        return
+
+    if args.seeds is None:
+        # Single attempt, the process exits afterwards
+        run_attempt(scene, camera, light, hdri_files, args, args.seed, writer, resume=args.resume)
+        writer.close()
+        return
+
+    # Daemon mode: run all seeds in the same Blender session
+    seeds = scene_geometry.parse_seeds(args.seeds)
+    monitor = MemoryMonitor(args.memory_watermark)
+
+    for i, seed in enumerate(seeds):
+        # Only the first seed can be a resumed (interrupted) attempt
+        run_attempt(scene, camera, light, hdri_files, args, seed, writer, monitor, resume=args.resume and i == 0)
+
+        if monitor.restart_needed:
+            # The attempt was cut short, the new process resumes it before the remaining seeds
+            writer.close()
+            restart_daemon(seeds[i:])
+
+        # The remaining seeds aren't needed once every class has its labels
+        if class_balancer.quotas_met():
+            break
+
+    writer.close()
+
 
 
 # === ARGUMENT PARSING ===
@@ -730,6 +2483,10 @@ def parse_args(argv):
         help = "The directory which contains 3D object files.", 
         default = OBJ_PATH)
     
+    parser.add_argument("--asset_cache_path",
+        help = "The directory for compiled .blend copies of the 3D objects (empty string to import the .obj files directly).", 
+        default = ASSET_CACHE_PATH)
+    
     parser.add_argument("--output_path",
         help = "The directory where images and labels will be created and stored.", 
         default = OUTPUT_PATH)
@@ -753,8 +2510,225 @@ def parse_args(argv):
         help = "Number of pictures taken around per object", 
         default = NUM_PICS, 
         type=int)
+
+    parser.add_argument("--seeds",
+        help = "Run as a daemon over a list of seeds (e.g. \"0-9\" or \"0,3,5-7\"), one attempt per seed in the same Blender session.",
+        default = None)
+
+    parser.add_argument("--plan",
+        help = "Render the scenes of a plan file written by scene_planner.py instead of sampling them.",
+        default = None)
+
+    parser.add_argument("--plan_slice",
+        help = "Render only worker k's scenes of the plan, given as \"k/N\".",
+        default = None)
+
+    parser.add_argument("--memory_watermark",
+        help = "Daemon mode: restart the process once its resident memory exceeds this many MB (0 to disable).",
+        default = MEMORY_WATERMARK,
+        type = float)
+
+    parser.add_argument("--class_balance",
+        help = "Pick targets of the classes and models with the fewest visible labels so far more often.",
+        default = CLASS_BALANCE,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--balance_strength",
+        help = "Exponent of the balancing weights (0 picks uniformly).",
+        default = BALANCE_STRENGTH,
+        type = float)
+
+    parser.add_argument("--run_id",
+        help = "Only the labels of attempts with this run id count towards --class_balance and --class_quotas "
+               "(default: a new id per run, kept across daemon restarts and taken over by --resume).",
+        default = RUN_ID)
+
+    parser.add_argument("--class_quotas",
+        help = "Visible instances wanted per target class, e.g. \"can=5000,toy_car=5000\"; generation stops once all are met.",
+        default = ",".join(f"{label}={quota}" for label, quota in CLASS_QUOTAS.items()))
+
+    parser.add_argument("--lazy_loading",
+        help = "Import models the first time they are selected instead of all at startup.",
+        default = LAZY_LOADING,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--max_resident_models",
+        help = "Lazy loading: number of models kept in memory at most (0 for no limit).",
+        default = MAX_RESIDENT_MODELS,
+        type = int)
+
+    parser.add_argument("--max_resident_mb",
+        help = "Lazy loading: approximate memory (MB) of resident models at most (0 for no limit).",
+        default = MAX_RESIDENT_MB,
+        type = float)
+
+    parser.add_argument("--lod",
+        help = "Render the decimated levels of the models (made by convert_ply_to_obj.py) by their projected size, picked once per arrangement.",
+        default = LOD_ENABLED,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--lod_min_pixels",
+        help = "Projected sizes (px) below which LOD 1, 2, ... is used, separated by commas.",
+        default = ",".join(str(p) for p in LOD_MIN_PIXELS))
+
+    parser.add_argument("--placement",
+        help = "How objects are placed: anywhere in the box (uniform) or without overlapping each other (non_overlapping).",
+        default = PLACEMENT_MODE,
+        choices = ["uniform", "non_overlapping"])
+
+    parser.add_argument("--placement_tolerance",
+        help = "Non-overlapping placement: allowed overlap as a fraction of the smaller bounding box.",
+        default = PLACEMENT_TOLERANCE,
+        type = float)
+
+    parser.add_argument("--render_mode",
+        help = "bpycv: separate renders for image and instances; index_pass: one Cycles render with the object index pass.",
+        default = RENDER_MODE,
+        choices = ["bpycv", "index_pass"])
+
+    parser.add_argument("--depth",
+        help = "Produce and save depth maps next to the images.",
+        default = RENDER_DEPTH,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--persistent_data",
+        help = "Keep Cycles' scene data between the views of one arrangement.",
+        default = PERSISTENT_DATA,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--persistent_max_rss",
+        help = "Render views without persistent data once the resident memory exceeds this many MB (0 for no limit).",
+        default = PERSISTENT_MAX_RSS,
+        type = float)
+
+    parser.add_argument("--resolution_x",
+        help = "Width of the rendered images.",
+        default = RESOLUTION_X,
+        type = int)
+
+    parser.add_argument("--resolution_y",
+        help = "Height of the rendered images.",
+        default = RESOLUTION_Y,
+        type = int)
+
+    parser.add_argument("--device",
+        help = "Cycles device: AUTO (first available GPU backend, else CPU), CPU, CUDA, OPTIX, HIP, METAL or ONEAPI.",
+        default = DEVICE)
+
+    parser.add_argument("--samples",
+        help = "Number of samples per image.",
+        default = SAMPLES,
+        type = int)
+
+    parser.add_argument("--tile_size",
+        help = "Tile size for rendering.",
+        default = TILE_SIZE,
+        type = int)
+
+    parser.add_argument("--adaptive_threshold",
+        help = "Noise threshold of adaptive sampling (0 disables adaptive sampling).",
+        default = ADAPTIVE_THRESHOLD,
+        type = float)
+
+    parser.add_argument("--denoiser",
+        help = "Cycles denoiser (OPENIMAGEDENOISE, OPTIX) or NONE.",
+        default = DENOISER)
+
+    parser.add_argument("--autotune",
+        help = "Render calibration frames with every configuration in AUTOTUNE_GRID and use the fastest one under AUTOTUNE_MAX_NOISE.",
+        default = False,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--hdri_index",
+        help = "hdri_index.json written by preprocess_hdri.py (default: <hdri_path>/preprocessed/hdri_index.json if it exists).",
+        default = HDRI_INDEX)
+
+    parser.add_argument("--hdri_min_pixel_ratio",
+        help = "Background texels per rendered pixel the chosen hdri variant has to provide at least.",
+        default = HDRI_MIN_PIXEL_RATIO,
+        type = float)
+
+    parser.add_argument("--hdri_target_luminance",
+        help = "Mean luminance every indexed background is scaled to before the random exposure (0 keeps the original brightness).",
+        default = HDRI_TARGET_LUMINANCE,
+        type = float)
+
+    parser.add_argument("--hdri_cache_budget",
+        help = "Memory budget (MB) for loaded hdri images before the least recently used are freed.",
+        default = HDRI_CACHE_BUDGET,
+        type = float)
+
+    parser.add_argument("--image_format",
+        help = "Format of the saved images.",
+        default = IMAGE_FORMAT,
+        choices = ["jpg", "png"])
+
+    parser.add_argument("--output_format",
+        help = "\"files\" writes images/ and labels/ folders, \"tar\" streams frames into WebDataset-style tar shards.",
+        default = OUTPUT_FORMAT,
+        choices = ["files", "tar"])
+
+    parser.add_argument("--shard_max_frames",
+        help = "Frames per tar shard.",
+        default = SHARD_MAX_FRAMES,
+        type = int)
+
+    parser.add_argument("--shard_max_mb",
+        help = "Close a tar shard once it holds this many MB.",
+        default = SHARD_MAX_MB,
+        type = float)
+
+    parser.add_argument("--annotation_store",
+        help = "Also write every frame's boxes to the columnar store in attempt_<num>/annotations.",
+        default = ANNOTATION_STORE,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--jpeg_quality",
+        help = "JPEG quality (0-100) of the saved images.",
+        default = JPEG_QUALITY,
+        type = int)
+
+    parser.add_argument("--profile",
+        help = "Write per-stage timings and memory of every frame to profile_<num>.jsonl and a percentile summary.",
+        default = PROFILE,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--threads",
+        help = "Number of CPU threads used by Cycles (0 lets Blender decide).",
+        default = 0,
+        type = int)
+
+    parser.add_argument("--attempt",
+        help = "Use this attempt number instead of the next free one (set by run_parallel.py).",
+        default = None,
+        type = int)
+
+    parser.add_argument("--resume",
+        help = "Continue an interrupted attempt (--attempt, or the latest one) and skip the frames in its manifest.jsonl.",
+        default = False,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--shard",
+        help = "Shard id within the seed; each shard gets its own random stream (set by run_parallel.py).",
+        default = None,
+        type = int)
+
+    parser.add_argument("--hdri_names",
+        help = "Comma-separated HDRI names (file names without extension) to render in order, instead of a random pick.",
+        default = None)
     
     args = parser.parse_args(argv)
+    if args.plan and args.seeds:
+        parser.error("--plan and --seeds can't be combined, a plan already names the seed of every scene")
+    if args.seeds and args.attempt is not None:
+        # Every daemon seed gets its own attempt folder and manifest
+        parser.error("--seeds and --attempt can't be combined, each seed starts a new attempt")
+    if args.plan_slice and args.attempt is None:
+        # Concurrent slices must not share an attempt folder (run_parallel.py --plan assigns them)
+        parser.error("--plan_slice needs its own --attempt")
+    if args.class_quotas and not args.annotation_store:
+        # The counts of earlier attempts and daemon restarts are only known from the stores
+        parser.error("--class_quotas needs --annotation_store, otherwise the counts start over on every restart")
     return args
 
 def handle_argv():
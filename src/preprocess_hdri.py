@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# OpenCV only reads and writes EXR files when this is set before it is imported
+os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
+
+import cv2
+import numpy as np
+
+HDRI_PATH = "/home/data/raw/[dataset_name]/backgrounds/HDRI" # Example
+OUTPUT_FOLDER = "preprocessed" # Inside HDRI_PATH, where generate_data.py looks for hdri_index.json
+WIDTHS = [1024, 2048, 4096] # Equirectangular widths of the variants (height is half)
+NUM_WORKERS = 4             # Processes; each holds one full-size map (~400 MB for 8k) at a time
+INDEX_FILE = "hdri_index.json"
+
+
+
+# === PREPROCESSING ===
+
+def mean_luminance(image):
+    '''
+    Mean Rec. 709 luminance of an equirectangular map, weighted by the solid angle of each row.
+    '''
+    b, g, r = image[..., 0], image[..., 1], image[..., 2]
+    luminance = (0.2126 * r + 0.7152 * g + 0.0722 * b).mean(axis=1)
+
+    # Rows near the poles cover less of the sphere
+    height = image.shape[0]
+    latitude = (np.arange(height) + 0.5) / height * np.pi - np.pi / 2
+    weights = np.cos(latitude)
+
+    return float((luminance * weights).sum() / weights.sum())
+
+def variant_path(output_path, name, width):
+    return os.path.join(output_path, f"{name}_{width}.exr")
+
+def preprocess(source, output_path, widths, previous=None):
+    '''
+    Write the half-float variants of one map that are smaller than it and return its index entry.
+    Up-to-date variants are kept, and the map is only read if something has to be written.
+    '''
+    name = os.path.basename(source).split('.')[0]
+    source_mtime = os.path.getmtime(source)
+
+    if previous is not None and previous.get("source_mtime") == source_mtime:
+        wanted = [w for w in widths if w < previous["source_width"]]
+        if all(os.path.exists(variant_path(output_path, name, w)) for w in wanted):
+            return name, dict(previous, variants={str(w): os.path.basename(variant_path(output_path, name, w)) for w in wanted})
+
+    image = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise RuntimeError(f"Could not read {source} (OpenCV built without OpenEXR?)")
+    image = image[..., :3].astype(np.float32)
+    height, width = image.shape[:2]
+
+    variants = {}
+    for w in sorted(widths):
+        if w >= width:
+            continue
+
+        # Area averaging keeps the energy of small bright spots like the sun
+        resized = cv2.resize(image, (w, w // 2), interpolation=cv2.INTER_AREA)
+
+        path = variant_path(output_path, name, w)
+        tmp_path = f"{path}.tmp.exr"
+        cv2.imwrite(tmp_path, resized, [cv2.IMWRITE_EXR_TYPE, cv2.IMWRITE_EXR_TYPE_HALF])
+        os.replace(tmp_path, path)
+        variants[str(w)] = os.path.basename(path)
+
+    entry = {
+        "source": os.path.abspath(source),
+        "source_mtime": source_mtime,
+        "source_width": width,
+        "source_height": height,
+        "mean_luminance": mean_luminance(image),
+        "variants": variants,
+    }
+    return name, entry
+
+
+
+# === MAIN FUNCTION ===
+
+def main(args):
+    start_time = time.time()
+    output_path = args.output_path or os.path.join(args.hdri_path, OUTPUT_FOLDER)
+    os.makedirs(output_path, exist_ok=True)
+    index_path = os.path.join(output_path, INDEX_FILE)
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    # Only the maps generate_data.py and run_parallel.py pick up (*.exr) are worth indexing
+    sources = sorted(os.path.join(args.hdri_path, f) for f in os.listdir(args.hdri_path) if f.endswith(".exr"))
+    widths = [int(w) for w in args.widths.split(",")]
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for source in sources:
+            name = os.path.basename(source).split('.')[0]
+            futures[pool.submit(preprocess, source, output_path, widths, index.get(name))] = source
+
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                name, entry = future.result()
+                index[name] = entry
+                print(f"[{i + 1}/{len(futures)}] {name}: {sorted(entry['variants'], key=int)} mean luminance {entry['mean_luminance']:.3f}")
+            except Exception as e:
+                print(f"Failed for {futures[future]}: {e}")
+                failed += 1
+
+    # Sources that were deleted leave the index
+    names = {os.path.basename(s).split('.')[0] for s in sources}
+    index = {name: entry for name, entry in sorted(index.items()) if name in names}
+
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(f"{index_path}.tmp", index_path)
+
+    print(f"\nIndex: {index_path}")
+    print(f"Total execution time: {time.time() - start_time:.2f} seconds\n")
+    return 1 if failed else 0
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Downscale HDRI backgrounds into half-float variants and index their mean luminance.")
+
+    parser.add_argument("--hdri_path",
+        help = "The directory that contains hdri backgrounds.",
+        default = HDRI_PATH)
+
+    parser.add_argument("--output_path",
+        help = f"Where the variants and {INDEX_FILE} are written (default: <hdri_path>/{OUTPUT_FOLDER}).",
+        default = None)
+
+    parser.add_argument("--widths",
+        help = "Equirectangular widths of the variants, separated by commas.",
+        default = ",".join(str(w) for w in WIDTHS))
+
+    parser.add_argument("--workers",
+        help = "Number of processes.",
+        default = NUM_WORKERS,
+        type = int)
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(main(args))
@@ -1,11 +1,10 @@
-# Run a for loop 10 times to call the generate_data.py script using different seeds
-for i in {0..9}
-do
-    echo "Running iteration $i"
-    python3 generate_data.py --seed $i
-    if [ $? -ne 0 ]; then
-        echo "Error occurred in iteration $i"
-        exit 1
-    fi
-    echo "Iteration $i completed successfully"
-done
+# Run generate_data.py as a daemon over 10 seeds (one attempt per seed).
+# The Blender session is kept alive between attempts and only restarts itself
+# once the memory watermark (--memory_watermark, in MB) is crossed.
+echo "Running seeds 0-9"
+python3 generate_data.py --seeds 0-9
+if [ $? -ne 0 ]; then
+    echo "Error occurred while generating data"
+    exit 1
+fi
+echo "All seeds completed successfully"
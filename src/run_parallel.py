@@ -0,0 +1,343 @@
+import os
+import sys
+import re
+import glob
+import json
+import time
+import random
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+import combine_output
+import scene_geometry
+
+# === ADJUSTABLE VARIABLES ===
+
+HDRI_PATH = "/home/data/raw/[dataset_name]/backgrounds/HDRI" # Example
+OBJ_PATH = "/home/data/raw/[dataset_name]/3d_models" # Example
+OUTPUT_PATH = "/home/data/3D_RP/output" # Example
+
+SEEDS = "0-9"               # Seeds to generate, one or more shards each
+ITERATION = 10              # Number of scene/backgrounds per seed
+ARRANGEMENT = 10            # Number of arrangements per iteration
+NUM_PICS = 10               # Number of pictures taken around per object
+
+NUM_WORKERS = 4             # Number of bpy worker processes running at the same time
+HDRIS_PER_SHARD = 2         # Backgrounds handled by one worker process
+ARRANGEMENTS_PER_SHARD = 10 # Arrangements per background handled by one worker process
+RETRIES = 1                 # Times a failed shard is run again, resuming its attempt
+COMBINE = True              # Merge the finished attempts into combined_<output folder> afterwards (see combine_output.py)
+
+GENERATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate_data.py")
+
+
+
+# === SHARD PLANNING ===
+
+def next_attempt_number(output_path):
+    pattern = re.compile(r"attempt_(\d+)")
+
+    max_attempt = 0
+    for name in os.listdir(output_path):
+        match = pattern.fullmatch(name)
+        if match:
+            max_attempt = max(max_attempt, int(match.group(1)))
+
+    return max_attempt + 1
+
+def plan_shards(seeds, hdri_names, iteration, arrangement, hdris_per_shard, arrangements_per_shard):
+    '''
+    Split the (seed, HDRI, arrangement) space into independent shards.
+    '''
+    shards = []
+    for seed in seeds:
+        # Same backgrounds per seed no matter how many workers are used
+        chosen = random.Random(seed).sample(hdri_names, min(iteration, len(hdri_names)))
+
+        shard_id = 0
+        for i in range(0, len(chosen), hdris_per_shard):
+            for start in range(0, arrangement, arrangements_per_shard):
+                shards.append({
+                    "seed": seed,
+                    "shard": shard_id,
+                    "hdris": chosen[i:i + hdris_per_shard],
+                    "arrangement": min(arrangements_per_shard, arrangement - start),
+                })
+                shard_id += 1
+
+    return shards
+
+def plan_slices(num_workers):
+    '''
+    One shard per slice of a scene plan; scene_planner.py already balanced them.
+    '''
+    return [{"shard": k, "plan_slice": f"{k}/{num_workers}"} for k in range(num_workers)]
+
+
+
+# === WORKERS ===
+
+def build_command(args, shard, threads):
+    script_args = [
+        "--hdri_path", args.hdri_path,
+        "--obj_path", args.obj_path,
+        "--output_path", args.output_path,
+        "--attempt", str(shard["attempt"]),
+        "--threads", str(threads),
+    ]
+
+    # A retried shard continues its attempt and skips the frames already in its manifest
+    if shard.get("retries"):
+        script_args.append("--resume")
+
+    if "plan_slice" in shard:
+        script_args += ["--plan", args.plan, "--plan_slice", shard["plan_slice"]]
+    else:
+        script_args += [
+            "--seed", str(shard["seed"]),
+            "--shard", str(shard["shard"]),
+            "--hdri_names", ",".join(shard["hdris"]),
+            "--iteration", str(len(shard["hdris"])),
+            "--arrangement", str(shard["arrangement"]),
+            "--num_pics", str(args.num_pics),
+        ]
+
+    if args.blender:
+        # Run through the Blender binary
+        return [args.blender, "-b", "-P", GENERATE_SCRIPT, "--"] + script_args
+
+    # Run with the standalone bpy module
+    return [sys.executable, GENERATE_SCRIPT] + script_args
+
+def run_shard(args, shard, threads, log_folder):
+    cmd = build_command(args, shard, threads)
+    log_path = os.path.join(log_folder, f"attempt_{shard['attempt']}.log")
+
+    source = f"plan slice {shard['plan_slice']}" if "plan_slice" in shard else f"seed {shard['seed']}"
+    action = f"Retrying ({shard['retries']})" if shard.get("retries") else "Starting"
+    print(f"{action} shard {shard['shard']} of {source} as attempt {shard['attempt']}")
+    start_time = time.time()
+
+    # Retries append to the log so the output of the failed run is kept
+    with open(log_path, "a" if shard.get("retries") else "w") as log:
+        returncode = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+
+    shard["returncode"] = returncode
+    shard["seconds"] = round(time.time() - start_time, 2)
+    shard["log"] = log_path
+
+    status = "finished" if returncode == 0 else f"FAILED ({returncode})"
+    print(f"Attempt {shard['attempt']} {status} in {shard['seconds']:.2f} seconds")
+
+    return shard
+
+
+
+# === MANIFEST ===
+
+def count_frames(attempt_folder):
+    '''
+    Frames of an attempt that are completely on disk, from its manifest (files, shards or neither).
+    '''
+    manifest_path = os.path.join(attempt_folder, "manifest.jsonl")
+    if not os.path.exists(manifest_path):
+        return 0
+
+    with open(manifest_path) as f:
+        # A frame rendered again after a crash has a second entry
+        return len({json.loads(line)["frame"] for line in f if line.strip()})
+
+def merge_outputs(output_path, shards, manifest_path):
+    '''
+    Collect the frame counts and configs of the workers into one manifest.
+    '''
+    base_config = None
+    total_frames = 0
+
+    for shard in shards:
+        attempt_folder = os.path.join(output_path, f"attempt_{shard['attempt']}")
+        config_path = os.path.join(attempt_folder, f"configs_{shard['attempt']}.yaml")
+
+        shard["frames"] = count_frames(attempt_folder)
+        shard["complete"] = combine_output.is_complete(Path(attempt_folder))
+        total_frames += shard["frames"]
+
+        if not os.path.exists(config_path):
+            continue
+
+        with open(config_path) as f:
+            config = yaml.full_load(f)
+
+        shard["config"] = config_path
+
+        # Keep the shared config once and only the differing keys per shard
+        if base_config is None:
+            base_config = config
+        else:
+            shard["config_diff"] = {k: v for k, v in config.items() if base_config.get(k) != v}
+
+    manifest = {
+        "num_shards": len(shards),
+        "failed_shards": sum(1 for shard in shards if shard["returncode"] != 0),
+        "total_frames": total_frames,
+        "config": base_config,
+        "shards": shards,
+    }
+
+    with open(manifest_path, "w") as f:
+        yaml.dump(manifest, f, sort_keys=False)
+
+    return manifest
+
+
+
+# === MAIN FUNCTION ===
+
+def main(args):
+    start_time = time.time()
+    os.makedirs(args.output_path, exist_ok=True)
+
+    hdri_files = sorted(glob.glob(os.path.join(args.hdri_path, "*.exr")))
+    hdri_names = [os.path.basename(f).split('.')[0] for f in hdri_files]
+
+    if args.plan:
+        shards = plan_slices(args.workers)
+    else:
+        shards = plan_shards(scene_geometry.parse_seeds(args.seeds), hdri_names, args.iteration, args.arrangement,
+                             args.hdris_per_shard, args.arrangements_per_shard)
+
+    # Reserve one attempt number per shard so workers never race on folder names
+    first_attempt = next_attempt_number(args.output_path)
+    for i, shard in enumerate(shards):
+        shard["attempt"] = first_attempt + i
+
+    # Partition the cores between workers instead of letting each one use all of them
+    num_workers = max(1, min(args.workers, len(shards)))
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    log_folder = os.path.join(args.output_path, "logs")
+    os.makedirs(log_folder, exist_ok=True)
+
+    print(f"{len(shards)} shards on {num_workers} workers with {threads} threads each")
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        list(pool.map(lambda shard: run_shard(args, shard, threads, log_folder), shards))
+
+        # Failed shards resume their own attempt instead of starting over
+        for retry in range(1, args.retries + 1):
+            failed = [shard for shard in shards if shard["returncode"] != 0]
+            if not failed:
+                break
+            for shard in failed:
+                shard["retries"] = retry
+            list(pool.map(lambda shard: run_shard(args, shard, threads, log_folder), failed))
+
+    last_attempt = first_attempt + len(shards) - 1
+    manifest_path = os.path.join(args.output_path, f"manifest_{first_attempt}-{last_attempt}.yaml")
+    manifest = merge_outputs(args.output_path, shards, manifest_path)
+
+    print(f"\nManifest: {manifest_path}")
+    print(f"number of frames: {manifest['total_frames']}, failed shards: {manifest['failed_shards']}")
+
+    # Images, labels, shard indexes and annotation stores of every complete attempt in one folder
+    if args.combine:
+        combine_output.combine(args.output_path, args.combined_path)
+
+    print(f"Total execution time: {time.time() - start_time:.2f} seconds\n")
+
+    return 1 if manifest["failed_shards"] else 0
+
+
+
+# === ARGUMENT PARSING ===
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Run generate_data.py in parallel bpy worker processes.")
+
+    parser.add_argument("--hdri_path",
+        help = "The directory that contains hdri backgrounds.",
+        default = HDRI_PATH)
+
+    parser.add_argument("--obj_path",
+        help = "The directory which contains 3D object files.",
+        default = OBJ_PATH)
+
+    parser.add_argument("--output_path",
+        help = "The directory where images and labels will be created and stored.",
+        default = OUTPUT_PATH)
+
+    parser.add_argument("--seeds",
+        help = "Seeds to generate, e.g. \"0-9\" or \"0,3,5-7\".",
+        default = SEEDS)
+
+    parser.add_argument("--iteration",
+        help = "Number of scene/backgrounds per seed.",
+        default = ITERATION,
+        type = int)
+
+    parser.add_argument("--arrangement",
+        help = "Number of arrangements per iteration.",
+        default = ARRANGEMENT,
+        type = int)
+
+    parser.add_argument("--num_pics",
+        help = "Number of pictures taken around per object",
+        default = NUM_PICS,
+        type = int)
+
+    parser.add_argument("--workers",
+        help = "Number of bpy worker processes running at the same time.",
+        default = NUM_WORKERS,
+        type = int)
+
+    parser.add_argument("--hdris_per_shard",
+        help = "Backgrounds handled by one worker process.",
+        default = HDRIS_PER_SHARD,
+        type = int)
+
+    parser.add_argument("--arrangements_per_shard",
+        help = "Arrangements per background handled by one worker process.",
+        default = ARRANGEMENTS_PER_SHARD,
+        type = int)
+
+    parser.add_argument("--plan",
+        help = "Render a plan of scene_planner.py instead of seeds, one slice (and attempt) per worker; plan it with the same --workers.",
+        default = None)
+
+    parser.add_argument("--retries",
+        help = "Times a failed shard is run again with --resume on its attempt.",
+        default = RETRIES,
+        type = int)
+
+    parser.add_argument("--combine",
+        help = "Merge the complete attempts into one folder afterwards (see combine_output.py).",
+        default = COMBINE,
+        action = argparse.BooleanOptionalAction)
+
+    parser.add_argument("--combined_path",
+        help = "The directory the attempts are merged into (default: combined_<output folder> next to it).",
+        default = None)
+
+    parser.add_argument("--blender",
+        help = "Path to the Blender binary; if omitted the workers use the standalone bpy module.",
+        default = None)
+
+    args = parser.parse_args(argv)
+    if args.combined_path is None:
+        args.combined_path = os.path.join(os.path.dirname(os.path.abspath(args.output_path)),
+                                          "combined_" + os.path.basename(os.path.normpath(args.output_path)))
+    return args
+
+
+
+# === ENTRY POINT ===
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(main(args))
@@ -0,0 +1,254 @@
+import numpy as np
+
+# Pure NumPy scene math (and seed lists) shared by generate_data.py and tools that run without bpy.
+
+# === BOUNDING BOXES ===
+
+def transform_points(matrices, points):
+    '''
+    Apply (n, 4, 4) world matrices to (n, k, 3) local points.
+    '''
+    return points @ matrices[:, :3, :3].transpose(0, 2, 1) + matrices[:, None, :3, 3]
+
+def aabb_corners(points):
+    '''
+    The 8 corners of the axis-aligned box around (..., 3) points.
+    '''
+    points = points.reshape(-1, 3)
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    return np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+
+
+
+# === CAMERA ===
+
+def camera_tan_half_fov(angle, sensor_fit, res_x, res_y):
+    '''
+    Tangents of the horizontal and vertical half field of view of a Blender camera.
+    '''
+    if sensor_fit == 'VERTICAL' or (sensor_fit == 'AUTO' and res_y > res_x):
+        tan_y = np.tan(angle / 2)
+        return tan_y * res_x / res_y, tan_y
+
+    tan_x = np.tan(angle / 2)
+    return tan_x, tan_x * res_y / res_x
+
+def sample_directions(rng, n):
+    '''
+    Uniform random unit vectors on the sphere.
+    '''
+    z = 2 * rng.random(n) - 1  # z is in [-1, 1]
+    theta = 2 * np.pi * rng.random(n)
+    r_xy = np.sqrt(1 - z * z)
+
+    return np.stack([r_xy * np.cos(theta), r_xy * np.sin(theta), z], axis=1)
+
+def look_at_basis(forward):
+    '''
+    Right and up vectors of cameras looking along (n, 3) forward vectors with +Z up
+    (the same convention as to_track_quat('-Z', 'Y')).
+    '''
+    world_up = np.broadcast_to([0.0, 0.0, 1.0], forward.shape)
+    right = np.cross(forward, world_up)
+
+    # Looking straight up or down: any horizontal right vector works
+    degenerate = np.linalg.norm(right, axis=1) < 1e-6
+    right[degenerate] = [1.0, 0.0, 0.0]
+    right /= np.linalg.norm(right, axis=1, keepdims=True)
+
+    up = np.cross(right, forward)
+    return right, up
+
+def fit_distances(forward, center, points, tan_half_x, tan_half_y):
+    '''
+    Distance from the center at which cameras looking at it along each forward vector
+    see all the points.
+    '''
+    right, up = look_at_basis(forward)
+    rel = points - center
+
+    x = np.abs(rel @ right.T)   # (k, n)
+    y = np.abs(rel @ up.T)
+    z = rel @ forward.T         # How far beyond the center each point lies
+
+    return np.maximum(x / tan_half_x - z, y / tan_half_y - z).max(axis=0)
+
+def solve_viewpoint(rng, focus_center, focus_radius, object_centers, fit_points, tan_half_x, tan_half_y,
+                    num_candidates=32, max_batches=8, min_distance_ratio=0.4, fill_range=(0.3, 1.3)):
+    '''
+    Sample batches of camera positions around the focus object and return the first one
+    that keeps every object at least min_distance_ratio * fit distance away.
+    Returns (location, fit distance, found); if no batch succeeds the candidate with the
+    most clearance is used as a fallback.
+    '''
+    best = None
+
+    for _batch in range(max_batches):
+        # Start on a sphere around the focus object, looking at its center
+        directions = sample_directions(rng, num_candidates)
+        start = focus_center + focus_radius * directions
+        forward = focus_center - start
+        forward /= np.linalg.norm(forward, axis=1, keepdims=True)
+
+        # Move back until everything fits, then randomly zoom in or out
+        distances = fit_distances(forward, focus_center, fit_points, tan_half_x, tan_half_y)
+        fill_ratio = rng.uniform(*fill_range, num_candidates)
+        locations = focus_center - forward * distances[:, None] + forward * (1 - 1 / fill_ratio)[:, None]
+
+        # Clearance to the closest object, relative to the fit distance
+        gaps = np.linalg.norm(locations[:, None, :] - object_centers[None, :, :], axis=2).min(axis=1)
+        clearance = gaps / distances
+
+        valid = np.flatnonzero(clearance >= min_distance_ratio)
+        if valid.size:
+            i = valid[0]
+            return locations[i], distances[i], True
+
+        i = clearance.argmax()
+        if best is None or clearance[i] > best[2]:
+            best = (locations[i], distances[i], clearance[i])
+
+    return best[0], best[1], False
+
+def solve_viewpoints(rng, focus_centers, focus_radii, object_centers, fit_points, tan_half_x, tan_half_y,
+                     num_candidates=32, max_batches=8, min_distance_ratio=0.4, fill_range=(0.3, 1.3)):
+    '''
+    solve_viewpoint for many views of the same scene at once, one (n, 3) focus center and
+    radius per view. Returns ((n, 3) locations, (n,) found).
+    '''
+    n = len(focus_centers)
+    locations = np.zeros((n, 3))
+    best_clearance = np.full(n, -np.inf)
+    found = np.zeros(n, dtype=bool)
+    pending = np.arange(n)
+
+    for _batch in range(max_batches):
+        if pending.size == 0:
+            break
+
+        # (views, candidates, 3), the same construction as solve_viewpoint
+        centers = focus_centers[pending][:, None]
+        directions = sample_directions(rng, pending.size * num_candidates).reshape(pending.size, num_candidates, 3)
+        forward = -directions  # From the start on the sphere towards the center
+
+        right, up = look_at_basis(forward.reshape(-1, 3).copy())
+        right = right.reshape(forward.shape)
+        up = up.reshape(forward.shape)
+
+        rel = fit_points[None] - centers                    # (views, k, 3)
+        x = np.abs(np.einsum("vkd,vcd->vck", rel, right))
+        y = np.abs(np.einsum("vkd,vcd->vck", rel, up))
+        z = np.einsum("vkd,vcd->vck", rel, forward)
+        distances = np.maximum(x / tan_half_x - z, y / tan_half_y - z).max(axis=2)
+
+        fill_ratio = rng.uniform(*fill_range, distances.shape)
+        candidates = centers - forward * distances[..., None] + forward * (1 - 1 / fill_ratio)[..., None]
+
+        gaps = np.linalg.norm(candidates[:, :, None] - object_centers[None, None], axis=3).min(axis=2)
+        clearance = gaps / distances
+        valid = clearance >= min_distance_ratio
+
+        # First valid candidate per view, or the one with the most clearance as a fallback
+        has_valid = valid.any(axis=1)
+        pick = np.where(has_valid, valid.argmax(axis=1), clearance.argmax(axis=1))
+        rows = np.arange(pending.size)
+
+        better = has_valid | (clearance[rows, pick] > best_clearance[pending])
+        locations[pending[better]] = candidates[rows, pick][better]
+        best_clearance[pending[better]] = clearance[rows, pick][better]
+
+        found[pending[has_valid]] = True
+        pending = pending[~has_valid]
+
+    return locations, found
+
+
+
+# === OBJECT PLACEMENT ===
+
+def euler_xyz_matrices(angles):
+    '''
+    Rotation matrices of (n, 3) Euler angles in Blender's 'XYZ' mode (X applied first).
+    '''
+    cx, cy, cz = np.cos(angles).T
+    sx, sy, sz = np.sin(angles).T
+
+    m = np.empty((len(angles), 3, 3))
+    m[:, 0, 0] = cy * cz
+    m[:, 0, 1] = sx * sy * cz - cx * sz
+    m[:, 0, 2] = cx * sy * cz + sx * sz
+    m[:, 1, 0] = cy * sz
+    m[:, 1, 1] = sx * sy * sz + cx * cz
+    m[:, 1, 2] = cx * sy * sz - sx * cz
+    m[:, 2, 0] = -sy
+    m[:, 2, 1] = sx * cy
+    m[:, 2, 2] = cx * cy
+    return m
+
+class PlacementIndex:
+    '''
+    Axis-aligned boxes of the objects already placed in a scene.
+    '''
+    def __init__(self):
+        self.lo = np.zeros((0, 3))
+        self.hi = np.zeros((0, 3))
+
+    def add(self, lo, hi):
+        self.lo = np.vstack([self.lo, lo])
+        self.hi = np.vstack([self.hi, hi])
+
+    def overlap_ratios(self, lo, hi):
+        '''
+        For (k, 3) candidate boxes, the largest overlap with any placed box as a fraction
+        of the smaller of the two volumes.
+        '''
+        if len(self.lo) == 0:
+            return np.zeros(len(lo))
+
+        sides = np.minimum(hi[:, None], self.hi[None]) - np.maximum(lo[:, None], self.lo[None])
+        intersection = np.clip(sides, 0, None).prod(axis=2)
+
+        volumes = (hi - lo).prod(axis=1)
+        placed_volumes = (self.hi - self.lo).prod(axis=1)
+        smaller = np.maximum(np.minimum(volumes[:, None], placed_volumes[None]), 1e-12)
+
+        return (intersection / smaller).max(axis=1)
+
+def sample_placement(rng, local_corners, index, center, ranges, num_candidates=64, max_batches=8, tolerance=0.0):
+    '''
+    Sample random rotations and positions inside center +- ranges for an object with the
+    given (8, 3) local corners, and keep the first pose that overlaps the placed objects by
+    at most tolerance. Returns (euler angles, location) or None if no pose fits.
+    '''
+    for _batch in range(max_batches):
+        angles = rng.uniform(0, 2 * np.pi, (num_candidates, 3))
+        locations = center + rng.uniform(-1, 1, (num_candidates, 3)) * ranges
+
+        corners = local_corners @ euler_xyz_matrices(angles).transpose(0, 2, 1) + locations[:, None]
+        lo, hi = corners.min(axis=1), corners.max(axis=1)
+
+        fits = np.flatnonzero(index.overlap_ratios(lo, hi) <= tolerance)
+        if fits.size:
+            i = fits[0]
+            index.add(lo[i], hi[i])
+            return angles[i], locations[i]
+
+    return None
+
+
+
+# === SEEDS ===
+
+def parse_seeds(text):
+    '''
+    Parse a seed list such as "0-9" or "0,3,5-7" into a list of integers.
+    '''
+    seeds = []
+    for part in text.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-")
+            seeds.extend(range(int(start), int(end) + 1))
+        elif part:
+            seeds.append(int(part))
+    return seeds
@@ -0,0 +1,473 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scene_geometry
+
+# Plans complete scenes without bpy: the objects with their poses, light, background, exposure and
+# camera of every view. generate_data.py --plan renders them (or a worker's slice of them).
+
+# === ADJUSTABLE VARIABLES ===
+
+HDRI_PATH = "/home/data/raw/[dataset_name]/backgrounds/HDRI" # Example
+OBJ_PATH = "/home/data/raw/[dataset_name]/3d_models" # Example
+PLAN_PATH = "/home/data/3D_RP/plans/plan.jsonl" # Example
+
+# Same defaults as generate_data.py
+SEEDS = "0-9"               # Seeds to plan, each one like an attempt of generate_data.py
+ITERATION = 10              # Number of scene/backgrounds per seed
+ARRANGEMENT = 10            # Number of arrangements per iteration
+NUM_PICS = 10               # Number of pictures taken around per object
+
+TARGET_CLASSES = ["can", "toy_car"]
+MIN_TARGET_OBJ = 0          # Minimum target objects appearing in a scene
+MAX_TARGET_OBJ = 2          # Maximum target objects appearing in a scene
+MIN_TOTAL_OBJ = 3           # Minimum total objects appearing in a scene
+MAX_TOTAL_OBJ = 6           # Maximum total objects appearing in a scene
+
+MAX_LIGHT_ENERGY = 50       # Maximum light intensity for the scene
+LIGHT_RANGE = 6             # The light is placed on the surface of a cube of this half size
+MIN_EXPOSURE = 0.5          # Minimum exposure rate for hdri backgrounds
+MAX_EXPOSURE = 10           # Maximum exposure rate for hdri backgrounds
+
+RESOLUTION_X = 1920 // 2
+RESOLUTION_Y = 1080 // 2
+LENS = 50                   # Focal length (mm) of the camera, Blender's default
+SENSOR_WIDTH = 36           # Sensor width (mm) of the camera, Blender's default
+
+CENTER = (0, 0, 0)          # Center of the box where objects will be placed
+RANGES = (0.4, 0.4, 0.2)    # Half size of that box along X, Y and Z
+PLACEMENT_MODE = "uniform"  # "uniform" places objects anywhere in the box, "non_overlapping" rejects overlapping poses
+PLACEMENT_TOLERANCE = 0.0   # Non-overlapping mode: allowed overlap as a fraction of the smaller bounding box
+PLACEMENT_CANDIDATES = 64   # Non-overlapping mode: poses tested together per object
+PLACEMENT_MAX_BATCHES = 8   # Non-overlapping mode: batches tried before leaving the object out of the scene
+
+RESCALE_SIZE = 0.2          # Mean size for objects after scaling
+EPS = 0.05                  # Size deviation for randomness
+
+CAMERA_CANDIDATES = 32      # Viewpoints sampled and scored together
+CAMERA_MAX_BATCHES = 8      # Batches of viewpoints tried before falling back to the best one
+MIN_CAMERA_DISTANCE = 0.4   # Minimum camera-to-object distance, relative to the distance that fits all objects in view
+
+NUM_WORKERS = 1             # Render workers the scenes are balanced over (generate_data.py --plan_slice k/N)
+NUM_PROCESSES = 4           # Planning processes
+OBJECT_COST = 0.1           # Estimated render cost of one object, relative to the cost of a view
+
+ASSET_INDEX = "asset_bboxes.json" # Inside OBJ_PATH: bounding box of every model, updated when a model changes
+POSE_DECIMALS = 5           # Rounding of poses in the deduplication key
+
+
+
+# === ASSETS ===
+
+def obj_dimensions(file_path):
+    '''
+    Bounding box size of the vertices of an .obj file, in Blender's axes after import
+    (the importer's default forward -Z / up Y maps (x, y, z) to (x, -z, y)).
+    '''
+    vertices = []
+    with open(file_path, "rb") as f:
+        for line in f:
+            if line.startswith(b"v "):
+                vertices.append(line.split()[1:4])
+
+    if not vertices:
+        raise ValueError(f"{file_path} has no vertices")
+
+    points = np.array(vertices, dtype=np.float64)
+    dx, dy, dz = points.max(axis=0) - points.min(axis=0)
+    return [float(dx), float(dz), float(dy)]
+
+def find_models(obj_path):
+    '''
+    [(label, name, file path)] with the same folder layout and .obj choice as generate_data.py.
+    '''
+    models = []
+    for class_folder in sorted(glob.glob(f"{obj_path}/*/")):
+        label = os.path.basename(os.path.dirname(class_folder))
+
+        for obj_folder in sorted(glob.glob(f"{class_folder}/*/")):
+            name = os.path.basename(os.path.dirname(obj_folder))
+            obj_files = [f for f in glob.glob(f"{obj_folder}/*") if os.path.splitext(f)[1].lower() == ".obj"]
+            if obj_files:
+                models.append((label, name, obj_files[0]))
+
+    return models
+
+def load_assets(obj_path, index_file=ASSET_INDEX):
+    '''
+    Bounding boxes of all models, read from the .obj files only for models that are new or changed.
+    Returns [{"label", "name", "dims"}].
+    '''
+    index_path = os.path.join(obj_path, index_file)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    assets, new_index, parsed = [], {}, 0
+    for label, name, file_path in find_models(obj_path):
+        key = f"{label}/{name}"
+        stat = os.stat(file_path)
+        entry = index.get(key)
+
+        if entry is None or entry["file"] != os.path.basename(file_path) or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            entry = {"file": os.path.basename(file_path), "mtime": stat.st_mtime, "size": stat.st_size,
+                     "dims": obj_dimensions(file_path)}
+            parsed += 1
+
+        new_index[key] = entry
+        assets.append({"label": label, "name": name, "dims": entry["dims"]})
+
+    if parsed or new_index.keys() != index.keys():
+        with open(f"{index_path}.tmp", "w") as f:
+            json.dump(new_index, f, indent=2)
+        os.replace(f"{index_path}.tmp", index_path)
+
+    print(f"{len(assets)} models ({parsed} bounding boxes read from .obj files)")
+    return assets
+
+
+
+# === PLANNING ===
+
+BOX_SIGNS = np.array([[x, y, z] for x in (-0.5, 0.5) for y in (-0.5, 0.5) for z in (-0.5, 0.5)])
+
+def rounded(values):
+    return np.round(values, POSE_DECIMALS).tolist()
+
+def sample_light(rng, light_range=LIGHT_RANGE, center=CENTER):
+    '''
+    Random point on the surface of the cube around the center (see translate_object_on_surface).
+    '''
+    location = rng.uniform(-light_range, light_range, 3)
+    axis = rng.integers(3)
+    location[axis] = light_range if rng.random() < 0.5 else -light_range
+    return location + np.array(center)
+
+def sample_objects(rng, config):
+    '''
+    Pick the models of a scene and give them a size, rotation and location.
+    Returns (indices into the assets, sizes, (n, 3) angles, (n, 3) locations, (n, 8, 3) world corners).
+    '''
+    targets, distractors, dims = config["targets"], config["distractors"], config["dims"]
+
+    num_targets = min(int(rng.integers(MIN_TARGET_OBJ, MAX_TARGET_OBJ + 1)), len(targets))
+    num_distractors = min(max(int(rng.integers(MIN_TOTAL_OBJ, MAX_TOTAL_OBJ + 1)) - num_targets, 0), len(distractors))
+    picks = np.concatenate([rng.choice(targets, num_targets, replace=False),
+                            rng.choice(distractors, num_distractors, replace=False)]).astype(np.int64)
+
+    # Objects are scaled so that their largest side has the sampled size
+    sizes = RESCALE_SIZE + rng.uniform(-EPS, EPS, len(picks))
+    local_corners = BOX_SIGNS[None] * (dims[picks] * (sizes / dims[picks].max(axis=1))[:, None])[:, None]
+
+    center, ranges = np.array(CENTER, dtype=np.float64), np.array(RANGES, dtype=np.float64)
+
+    if config["placement"] == "uniform":
+        angles = rng.uniform(0, 2 * np.pi, (len(picks), 3))
+        locations = center + rng.uniform(-1, 1, (len(picks), 3)) * ranges
+        keep = np.arange(len(picks))
+    else:
+        placement_index = scene_geometry.PlacementIndex()
+        angles, locations, keep = [], [], []
+        for i in range(len(picks)):
+            pose = scene_geometry.sample_placement(
+                rng, local_corners[i], placement_index, center, ranges, num_candidates=PLACEMENT_CANDIDATES,
+                max_batches=PLACEMENT_MAX_BATCHES, tolerance=config["tolerance"])
+            if pose is not None:
+                angles.append(pose[0])
+                locations.append(pose[1])
+                keep.append(i)
+        angles, locations, keep = np.array(angles).reshape(-1, 3), np.array(locations).reshape(-1, 3), np.array(keep, dtype=np.int64)
+
+    matrices = scene_geometry.euler_xyz_matrices(angles)
+    corners = local_corners[keep] @ matrices.transpose(0, 2, 1) + locations[:, None]
+    return picks[keep], sizes[keep], angles, locations, corners
+
+def sample_views(rng, corners, num_pics, tan_half_x, tan_half_y):
+    '''
+    Camera location, look-at target and background exposure of every view.
+    '''
+    centers = corners.mean(axis=1)
+    focus = rng.integers(0, len(centers), num_pics)
+    radii = np.linalg.norm(corners[focus] - centers[focus][:, None], axis=2).max(axis=1)
+
+    locations, _found = scene_geometry.solve_viewpoints(
+        rng, centers[focus], radii, centers, scene_geometry.aabb_corners(corners), tan_half_x, tan_half_y,
+        num_candidates=CAMERA_CANDIDATES, max_batches=CAMERA_MAX_BATCHES, min_distance_ratio=MIN_CAMERA_DISTANCE)
+
+    darker = rng.random(num_pics) < 0.5
+    exposures = np.where(darker, rng.uniform(MIN_EXPOSURE, 1, num_pics), rng.uniform(1, MAX_EXPOSURE, num_pics))
+
+    return [{"camera": camera, "target": target, "exposure": exposure}
+            for camera, target, exposure in zip(rounded(locations), rounded(centers[focus]), exposures.tolist())]
+
+def scene_key(scene):
+    '''
+    Hash of what is rendered (background, objects and poses), independent of the scene's seed.
+    '''
+    content = [scene["hdri"], scene["light"]] + [
+        [o["label"], o["name"], o["size"], o["rotation"], o["location"]] for o in scene["objects"]]
+    return hashlib.sha1(json.dumps(content).encode()).hexdigest()[:16]
+
+def plan_seed(seed, config):
+    '''
+    All scenes of one seed: a random set of backgrounds (one per iteration), each with
+    config["arrangement"] object arrangements of config["num_pics"] views.
+    '''
+    assets, hdri_names = config["assets"], config["hdri_names"]
+    tan_half_x, tan_half_y = config["tan_half_fov"]
+
+    # Backgrounds and light energy are drawn once per seed, like an attempt of generate_data.py
+    seed_rng = np.random.default_rng(seed)
+    hdris = seed_rng.permutation(len(hdri_names))[:min(config["iteration"], len(hdri_names))]
+    energy = int(seed_rng.integers(0, MAX_LIGHT_ENERGY + 1))
+
+    scenes = []
+    for iteration, hdri in enumerate(hdris):
+        for arrangement in range(config["arrangement"]):
+            # Every scene has its own stream, so any of them can be planned again on its own
+            rng = np.random.default_rng([seed, iteration, arrangement])
+
+            picks, sizes, angles, locations, corners = sample_objects(rng, config)
+            if len(picks) == 0:
+                continue
+
+            light = sample_light(rng)
+            scene = {
+                "seed": seed,
+                "iteration": iteration,
+                "arrangement": arrangement,
+                "hdri": hdri_names[hdri],
+                "light": {"location": rounded(light), "energy": energy},
+                "objects": [{"label": assets[p]["label"], "name": assets[p]["name"], "size": round(float(s), POSE_DECIMALS),
+                             "rotation": rounded(a), "location": rounded(l)}
+                            for p, s, a, l in zip(picks, sizes, angles, locations)],
+                "views": sample_views(rng, corners, config["num_pics"], tan_half_x, tan_half_y),
+            }
+            scene["key"] = scene_key(scene)
+            scenes.append(scene)
+
+    return scenes
+
+def scene_cost(scene):
+    return len(scene["views"]) * (1 + OBJECT_COST * len(scene["objects"]))
+
+def balance(group_costs, num_workers):
+    '''
+    Assign groups to workers, largest first to the least loaded worker (LPT).
+    Returns ({group : worker}, load per worker).
+    '''
+    loads = [0.0] * num_workers
+    assignment = {}
+    for group, cost in sorted(group_costs.items(), key=lambda item: (-item[1], item[0])):
+        worker = loads.index(min(loads))
+        assignment[group] = worker
+        loads[worker] += cost
+    return assignment, loads
+
+
+
+# === PLAN FILES ===
+
+def read_plan(path, plan_slice=None):
+    '''
+    Yield the scenes of a plan file, only those of worker k with plan_slice "k/N".
+    Scenes are balanced for the number of workers given to the planner; with another N,
+    worker ids are folded modulo N (every scene still belongs to exactly one slice).
+    '''
+    worker, num_workers = 0, 1
+    if plan_slice:
+        worker, num_workers = (int(part) for part in plan_slice.split("/"))
+        if not 0 <= worker < num_workers:
+            raise ValueError(f"Invalid plan slice {plan_slice}")
+
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            scene = json.loads(line)
+            if scene.get("worker", 0) % num_workers == worker:
+                yield scene
+
+def read_keys(paths):
+    '''
+    Scene keys and (seed, iteration, arrangement) ids of existing plans.
+    '''
+    keys, ids = set(), set()
+    for path in paths:
+        for scene in read_plan(path):
+            keys.add(scene["key"])
+            ids.add((scene["seed"], scene["iteration"], scene["arrangement"]))
+    return keys, ids
+
+
+
+# === MAIN FUNCTION ===
+
+def main(args):
+    start_time = time.time()
+
+    assets = load_assets(args.obj_path)
+    hdri_names = sorted(os.path.basename(f).split('.')[0] for f in glob.glob(os.path.join(args.hdri_path, "*.exr")))
+    if not assets or not hdri_names:
+        print("No models or no backgrounds found")
+        return 1
+
+    target_classes = args.target_classes.split(",")
+    angle = 2 * np.arctan(args.sensor_width / 2 / args.lens)
+    config = {
+        "assets": assets,
+        "dims": np.array([asset["dims"] for asset in assets], dtype=np.float64),
+        "targets": np.array([i for i, asset in enumerate(assets) if asset["label"] in target_classes], dtype=np.int64),
+        "distractors": np.array([i for i, asset in enumerate(assets) if asset["label"] not in target_classes], dtype=np.int64),
+        "hdri_names": hdri_names,
+        "iteration": args.iteration,
+        "arrangement": args.arrangement,
+        "num_pics": args.num_pics,
+        "placement": args.placement,
+        "tolerance": args.placement_tolerance,
+        "tan_half_fov": scene_geometry.camera_tan_half_fov(angle, 'AUTO', args.resolution_x, args.resolution_y),
+    }
+
+    # Scenes of earlier plans are not planned again
+    keys, ids = read_keys(args.exclude)
+    seeds = scene_geometry.parse_seeds(args.seeds)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    tmp_path = f"{args.output}.tmp"
+
+    # First pass: plan in parallel and stream the new scenes out, keeping only the costs per group.
+    # A group is one background of one seed, so a worker loads each background once.
+    group_costs = {}
+    counts = {"planned": 0, "duplicates": 0}
+    with ProcessPoolExecutor(max_workers=args.processes) as pool, open(tmp_path, "w") as f:
+        for scenes in pool.map(plan_seed, seeds, [config] * len(seeds), chunksize=max(1, len(seeds) // (4 * args.processes))):
+            for scene in scenes:
+                scene_id = (scene["seed"], scene["iteration"], scene["arrangement"])
+                if scene["key"] in keys or scene_id in ids:
+                    counts["duplicates"] += 1
+                    continue
+                keys.add(scene["key"])
+                ids.add(scene_id)
+
+                group = f"{scene['seed']}/{scene['hdri']}"
+                group_costs[group] = group_costs.get(group, 0.0) + scene_cost(scene)
+                f.write(json.dumps(scene) + "\n")
+                counts["planned"] += 1
+
+    # Second pass: assign the groups to workers
+    assignment, loads = balance(group_costs, args.workers)
+    with open(tmp_path) as fsrc, open(f"{args.output}.part", "w") as fdst:
+        for line in fsrc:
+            scene = json.loads(line)
+            scene["worker"] = assignment[f"{scene['seed']}/{scene['hdri']}"]
+            fdst.write(json.dumps(scene) + "\n")
+    os.replace(f"{args.output}.part", args.output)
+    os.remove(tmp_path)
+
+    print(f"planned: {counts['planned']} scenes, skipped duplicates: {counts['duplicates']}")
+    if loads:
+        print(f"Estimated load per worker: min {min(loads):.0f}, max {max(loads):.0f} (views weighted by objects)")
+    print(f"\nPlan: {args.output}")
+    print(f"Total execution time: {time.time() - start_time:.2f} seconds\n")
+    return 0
+
+def parse_args(argv):
+    '''Parse input arguments
+    '''
+    parser = argparse.ArgumentParser(description = "Plan scenes for generate_data.py --plan without Blender.")
+
+    parser.add_argument("--hdri_path",
+        help = "The directory that contains hdri backgrounds.",
+        default = HDRI_PATH)
+
+    parser.add_argument("--obj_path",
+        help = "The directory which contains 3D object files.",
+        default = OBJ_PATH)
+
+    parser.add_argument("--output",
+        help = "The plan file (JSONL, one scene per line).",
+        default = PLAN_PATH)
+
+    parser.add_argument("--exclude",
+        help = "Earlier plan files; scenes in them are not planned again.",
+        default = [],
+        nargs = "*")
+
+    parser.add_argument("--seeds",
+        help = "Seeds to plan, e.g. \"0-9\" or \"0,3,5-7\".",
+        default = SEEDS)
+
+    parser.add_argument("--iteration",
+        help = "Number of scene/backgrounds per seed.",
+        default = ITERATION,
+        type = int)
+
+    parser.add_argument("--arrangement",
+        help = "Number of arrangements per iteration.",
+        default = ARRANGEMENT,
+        type = int)
+
+    parser.add_argument("--num_pics",
+        help = "Number of pictures taken around per object",
+        default = NUM_PICS,
+        type = int)
+
+    parser.add_argument("--target_classes",
+        help = "Target classes, separated by commas.",
+        default = ",".join(TARGET_CLASSES))
+
+    parser.add_argument("--placement",
+        help = "Object placement: uniform random positions, or rejection of overlapping poses.",
+        choices = ["uniform", "non_overlapping"],
+        default = PLACEMENT_MODE)
+
+    parser.add_argument("--placement_tolerance",
+        help = "Non-overlapping placement: allowed overlap as a fraction of the smaller bounding box.",
+        default = PLACEMENT_TOLERANCE,
+        type = float)
+
+    parser.add_argument("--resolution_x",
+        help = "Width of the rendered images (must match generate_data.py).",
+        default = RESOLUTION_X,
+        type = int)
+
+    parser.add_argument("--resolution_y",
+        help = "Height of the rendered images (must match generate_data.py).",
+        default = RESOLUTION_Y,
+        type = int)
+
+    parser.add_argument("--lens",
+        help = "Focal length of the camera in mm.",
+        default = LENS,
+        type = float)
+
+    parser.add_argument("--sensor_width",
+        help = "Sensor width of the camera in mm.",
+        default = SENSOR_WIDTH,
+        type = float)
+
+    parser.add_argument("--workers",
+        help = "Render workers the scenes are balanced over (generate_data.py --plan_slice k/N).",
+        default = NUM_WORKERS,
+        type = int)
+
+    parser.add_argument("--processes",
+        help = "Planning processes.",
+        default = NUM_PROCESSES,
+        type = int)
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    sys.exit(main(args))